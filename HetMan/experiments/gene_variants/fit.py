@@ -31,7 +31,7 @@ import sys
 sys.path.extend([os.path.join(base_dir, '../../..')])
 
 from HetMan.features.variants import MuType
-from HetMan.features.cohorts import VariantCohort
+from HetMan.features.cohorts import VariantCohort, load_snapshot
 from HetMan.predict.classifiers import Lasso
 
 import numpy as np
@@ -40,6 +40,7 @@ from itertools import product
 from itertools import combinations as combn
 
 import pickle
+import hashlib
 import synapseclient
 
 
@@ -56,15 +57,31 @@ def main(argv):
 
     # loads the expression data and gene mutation data for the given TCGA
     # cohort, with the training/testing cohort split defined by the
-    # cross-validation id for this task
-    syn = synapseclient.Synapse()
-    syn.login()
-    cdata = VariantCohort(
-        syn, cohort=coh_lbl, mut_genes=[argv[1]],
-        mut_levels=['Gene', 'Form_base', 'Exon', 'Location'],
-        cv_seed=(int(argv[2]) + 3) * 19
+    # cross-validation id for this task; the cohort is saved by setup.py
+    # under a directory named after the inputs used to construct it, which
+    # is replaced whenever setup.py is run again, and is otherwise saved by
+    # the first task to get to this point for the other tasks
+    mut_levels = ['Gene', 'Form_base', 'Exon', 'Location']
+    snap_key = (coh_lbl, argv[1], tuple(mut_levels))
+    snap_dir = os.path.join(
+        out_dir, 'tmp', 'cohort__{}'.format(
+            hashlib.md5(repr(snap_key).encode()).hexdigest())
         )
 
+    if os.path.isdir(snap_dir):
+        coh_data = load_snapshot(snap_dir, snap_key=snap_key)
+
+    else:
+        syn = synapseclient.Synapse()
+        syn.login()
+        coh_data = VariantCohort(
+            syn, cohort=coh_lbl, mut_genes=[argv[1]],
+            mut_levels=mut_levels, cv_prop=1.0
+            )
+        coh_data.save_snapshot(snap_dir, snap_key=snap_key)
+
+    cdata = coh_data.split_view(cv_seed=(int(argv[2]) + 3) * 19)
+
     # gets the mutation type representing all of the mutations for the given
     # gene, finds which samples have these mutations in the training and
     # testing cohorts
@@ -82,6 +99,11 @@ def main(argv):
     out_mutex = {tuple(sorted(mtypes)): None
                  for mtypes in combn(mtype_list, 2)}
 
+    # finds the testing mutation status of every sub-variant at once, with
+    # the samples in the same order as the classifiers' predictions
+    test_stats = cdata.test_mut.status_matrix(cdata.test_omics().index,
+                                              mtype_list)
+
     # for each of the gene's sub-variants, check if it has been assigned to
     # this task
     for i, mtype in enumerate(mtype_list):
@@ -91,7 +113,7 @@ def main(argv):
             ex_train = tp53_train_samps - mtype.get_samples(cdata.train_mut)
             ex_test = tp53_test_samps - mtype.get_samples(cdata.test_mut)
 
-            test_stat = cdata.test_pheno(mtype)
+            test_stat = test_stats[:, i]
             out_stat[mtype] = np.where(test_stat)
             print(np.sum(test_stat))
 
@@ -111,8 +133,8 @@ def main(argv):
             out_pred[mtype] = np.array(
                 clf.predict_test(cdata, exclude_genes=[argv[1]]))
 
-            for other_mtype in mtype_list:
-                other_stat = cdata.test_pheno(other_mtype)
+            for j, other_mtype in enumerate(mtype_list):
+                other_stat = test_stats[:, j]
 
                 none_which = ~test_stat & ~other_stat
                 if np.sum(none_which) >= 5:
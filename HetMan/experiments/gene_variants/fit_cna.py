@@ -30,15 +30,15 @@ def main(argv):
         open(os.path.join(out_dir, 'tmp', 'mtype_list.p'), 'rb'))
 
     # loads the expression data and gene mutation data for the given TCGA
-    # cohort, with the training/testing cohort split defined by the
-    # cross-validation id for this task
+    # cohort once, with the training/testing cohort split defined by the
+    # cross-validation id for each iteration
     syn = synapseclient.Synapse()
     syn.login()
+    coh_data = MutCohort(syn, cohort=coh_lbl, mut_genes=[argv[1]],
+                         mut_levels=['Gene', 'Form'], cv_prop=1.0)
 
     for cv_id in range(5):
-        cdata = MutCohort(syn, cohort=coh_lbl, mut_genes=[argv[1]],
-                          mut_levels=['Gene', 'Form'],
-                          cv_seed=(cv_id + 3) * 19)
+        cdata = coh_data.split_view(cv_seed=(cv_id + 3) * 19)
 
         cna_list = [cna_mtype for cna_mtype in
                     [MuType({('Gene', argv[1]): {
@@ -77,6 +77,11 @@ def main(argv):
         out_mutex = {tuple(sorted(mtypes)): None
                      for mtypes in product(cna_list, mtype_list)}
 
+        # finds the testing mutation status of every sub-variant at once,
+        # with the samples in the same order as the classifiers' predictions
+        other_stats = cdata.test_mut.status_matrix(
+            cdata.test_omics().index, mtype_list)
+
         for mtype in cna_list:
             ex_train = tp53_train_samps - mtype.get_samples(cdata.train_mut)
             ex_test = tp53_test_samps - mtype.get_samples(cdata.test_mut)
@@ -101,8 +106,8 @@ def main(argv):
             out_pred[mtype] = np.array(
                 clf.predict_test(cdata, exclude_genes=[argv[1]]))
 
-            for other_mtype in mtype_list:
-                other_stat = cdata.test_pheno(other_mtype)
+            for j, other_mtype in enumerate(mtype_list):
+                other_stat = other_stats[:, j]
 
                 none_which = ~test_stat & ~other_stat
                 if np.sum(none_which) >= 5:
@@ -25,10 +25,8 @@ from HetMan.features.cohorts import VariantCohort, MutCohort
 import numpy as np
 import synapseclient
 import pickle
-
-from itertools import combinations as combn
-from itertools import chain
-from functools import reduce
+import hashlib
+import shutil
 
 # how many samples must contain a mutation for us to consider it?
 freq_cutoff = 20
@@ -47,18 +45,28 @@ def main(argv):
     # for the given cohort
     syn = synapseclient.Synapse()
     syn.login()
+    mut_levels = ['Gene', 'Form_base', 'Exon', 'Location']
     cdata = VariantCohort(
         syn, cohort=coh_lbl, mut_genes=[argv[1]],
-        mut_levels=['Gene', 'Form_base', 'Exon', 'Location'],
-        cv_prop=1.0
+        mut_levels=mut_levels, cv_prop=1.0
+        )
+
+    # saves the cohort for the fitting tasks, replacing any cohort saved by
+    # an earlier run of this script which may have used older input datasets
+    snap_key = (coh_lbl, argv[1], tuple(mut_levels))
+    snap_dir = os.path.join(
+        out_path, 'tmp', 'cohort__{}'.format(
+            hashlib.md5(repr(snap_key).encode()).hexdigest())
         )
 
+    if os.path.isdir(snap_dir):
+        shutil.rmtree(snap_dir)
+    cdata.save_snapshot(snap_dir, snap_key=snap_key)
+
     # finds the sub-types satisfying the sample frequency criterion
     sub_mtypes = cdata.train_mut.subtypes(min_size=freq_cutoff)
-    sub_mtypes |= set(
-        reduce(lambda x, y: x | y, mtypes)
-        for mtypes in chain(combn(sub_mtypes, 2), combn(sub_mtypes, 3))
-        )
+    sub_mtypes |= set(cdata.train_mut.iter_combtypes(
+        sub_mtypes=sub_mtypes, comb_sizes=(2, 3)))
     sub_mtypes |= cdata.train_mut.treetypes(
         min_size=freq_cutoff, sub_levels=['Gene', 'Form_base'])
 
@@ -68,10 +76,8 @@ def main(argv):
 
     exon_mtypes = cdata.train_mut.subtypes(
         min_size=freq_cutoff / 2, sub_levels=['Gene', 'Exon'])
-    sub_mtypes |= set(
-        reduce(lambda x, y: x | y, mtypes)
-        for mtypes in chain(combn(exon_mtypes, 2), combn(exon_mtypes, 3))
-        )
+    sub_mtypes |= set(cdata.train_mut.iter_combtypes(
+        sub_mtypes=exon_mtypes, comb_sizes=(2, 3)))
 
     exon_mtypes = cdata.train_mut.subtypes(
         min_size=freq_cutoff, sub_levels=['Gene', 'Form_base', 'Exon'])
@@ -79,10 +85,8 @@ def main(argv):
 
     exon_mtypes = cdata.train_mut.subtypes(
         min_size=freq_cutoff / 2, sub_levels=['Gene', 'Form_base', 'Exon'])
-    sub_mtypes |= set(
-        reduce(lambda x, y: x | y, mtypes)
-        for mtypes in combn(exon_mtypes, 2)
-        )
+    sub_mtypes |= set(cdata.train_mut.iter_combtypes(
+        sub_mtypes=exon_mtypes, comb_sizes=(2, )))
 
     loc_mtypes = cdata.train_mut.subtypes(
         min_size=freq_cutoff, sub_levels=['Gene', 'Location'])
@@ -90,8 +94,8 @@ def main(argv):
 
     loc_mtypes = cdata.train_mut.subtypes(
         min_size=freq_cutoff / 2, sub_levels=['Gene', 'Location'])
-    sub_mtypes |= set(reduce(lambda x, y: x | y, mtypes)
-                      for mtypes in combn(loc_mtypes, 2))
+    sub_mtypes |= set(cdata.train_mut.iter_combtypes(
+        sub_mtypes=loc_mtypes, comb_sizes=(2, )))
 
     # save the list of sub-types to file
     print(len(sub_mtypes))
@@ -21,12 +21,11 @@ def main(argv):
 
     syn = synapseclient.Synapse()
     syn.login()
-    mc3_data = get_variants_mc3(syn)
     expr_data = get_expr_bmeg(coh_lbl)
+    brca_mc3 = get_variants_mc3(syn, samples=expr_data.index)
     print(expr_data.shape)
 
     freq_cutoff = 20
-    brca_mc3 = mc3_data.ix[mc3_data['Sample'].isin(expr_data.index), :]
     gene_counts = brca_mc3.groupby(by='Gene').count()['Sample']
     common_genes = set(gene_counts[gene_counts >= freq_cutoff].index)
     print(len(common_genes))
@@ -43,9 +42,14 @@ def main(argv):
     mutex_cutoff = 1 / 3.0
     mutex_dict = {}
 
-    for mtype1, mtype2 in combn(sub_mtypes, 2):
-        stat1 = cdata.test_pheno(mtype1)
-        stat2 = cdata.test_pheno(mtype2)
+    # finds the testing mutation status of every sub-type at once
+    sub_mtypes = list(sub_mtypes)
+    test_stats = cdata.test_mut.status_matrix(cdata.test_omics().index,
+                                              sub_mtypes)
+
+    for (i, mtype1), (j, mtype2) in combn(enumerate(sub_mtypes), 2):
+        stat1 = test_stats[:, i]
+        stat2 = test_stats[:, j]
         
         if np.sum(stat1 & ~stat2) >= 5 and np.sum(~stat1 & stat2) >= 5:
             mutex_val = cdata.mutex_test(mtype1, mtype2)
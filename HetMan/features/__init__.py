@@ -10,4 +10,10 @@ sys.path.extend(['../ophion/client/python/'])
 # are stored
 DATA_PATH = os.path.join(os.path.dirname(__file__), '../data/')
 
+# gets directory where parsed versions of large datasets are cached so that
+# they can be quickly re-loaded, can be pointed to a shared location using the
+# HETMAN_CACHE environment variable
+CACHE_PATH = os.environ.get('HETMAN_CACHE',
+                            os.path.join(DATA_PATH, 'cache/'))
+
 __all__ = ['cohorts']
@@ -11,45 +11,165 @@ it into useful data structures.
 import numpy as np
 import pandas as pd
 
-from . import DATA_PATH
+from . import DATA_PATH, CACHE_PATH
+from .utils import get_file_checksum, write_column_store, read_column_store
 
-from re import sub as gsub
+import os
+from collections.abc import Mapping
 
+gencode_file = DATA_PATH + "gencode.v22.annotation.gtf.gz"
 
-def get_gencode():
-    """Gets annotation data for protein-coding genes on non-sex
-       chromosomes from a Gencode file.
+# which version of the annotation index format is stored in the cache, to be
+# incremented whenever the parsing done in parse_gencode changes
+annot_index_version = 1
+
+# annotation indices already loaded by this process
+annot_cache = {}
+
+
+class GeneAnnot(Mapping):
+    """A read-only index of gene annotation data.
+
+    Annotation fields are stored as compact arrays with one entry per gene,
+    which are memory-mapped from the cache. The index can be used as a
+    dictionary with keys corresponding to Ensembl gene IDs and values
+    consisting of dicts with annotation fields, which are only created when
+    a gene's annotation is accessed.
+
+    Args:
+        annot_data (pandas DataFrame), shape = [n_genes, n_fields]
+            Must contain 'ID', 'gene_name', 'chr', 'Start', and 'End' fields.
+
+    Examples:
+        >>> annot = get_gencode()
+        >>> annot['ENSG00000141510']['gene_name']
+            'TP53'
+        >>> annot.name_rows(['TP53', 'PTEN'])
+            array([18823, 7016])
+
+    """
+
+    def __init__(self, annot_data):
+        self.annot_data = annot_data
+        self.gene_ids = annot_data['ID'].values
+        self.gene_names = annot_data['gene_name'].values
+        self.chroms = annot_data['chr'].values
+        self.starts = annot_data['Start'].values
+        self.ends = annot_data['End'].values
+
+        # the lookup tables from genes to array positions are only built
+        # the first time they are needed
+        self._id_indx = None
+        self._name_indx = None
+
+    @property
+    def id_index(self):
+        """Maps each gene ID to its position in the annotation arrays."""
+        if self._id_indx is None:
+            self._id_indx = {gn: i for i, gn in enumerate(self.gene_ids)}
+
+        return self._id_indx
+
+    @property
+    def name_index(self):
+        """Maps each gene name to its position in the annotation arrays."""
+        if self._name_indx is None:
+            self._name_indx = {gn: i for i, gn
+                               in enumerate(self.gene_names)}
+
+        return self._name_indx
+
+    def name_rows(self, gene_names):
+        """Finds the positions of genes in the annotation arrays by name,
+           with -1 for any genes that are not annotated."""
+        return np.array([self.name_index.get(gn, -1) for gn in gene_names],
+                        dtype=int)
+
+    def __getitem__(self, gene_id):
+        i = self.id_index[gene_id]
+
+        return {'chr': self.chroms[i], 'Start': int(self.starts[i]),
+                'End': int(self.ends[i]), 'gene_name': self.gene_names[i],
+                'gene_type': 'protein_coding'}
+
+    def __iter__(self):
+        return iter(self.gene_ids)
+
+    def __len__(self):
+        return len(self.gene_ids)
+
+    def __contains__(self, gene_id):
+        return gene_id in self.id_index
+
+
+def parse_gencode(annot_file):
+    """Parses the records of protein-coding genes on non-sex chromosomes
+       from a Gencode GTF file.
+
+    Args:
+        annot_file (str): The location of the GTF file.
+
+    Returns:
+        annot_data (pandas DataFrame), shape = [n_genes, 5]
 
-    Returns
-    -------
-    annot : dict
-        Dictionary with keys corresponding to Ensembl gene IDs and values
-        consisting of dicts with annotation fields.
     """
-    annot = pd.read_csv(DATA_PATH + "gencode.v22.annotation.gtf.gz",
-                        usecols=[0, 2, 3, 4, 8],
+    annot = pd.read_csv(annot_file, usecols=[0, 2, 3, 4, 8],
                         names=['Chr', 'Type', 'Start', 'End', 'Info'],
                         sep='\t', header=None, comment='#')
 
     # filter out annotation records that aren't
     # protein-coding genes on non-sex chromosomes
     chroms_use = ['chr' + str(i+1) for i in range(22)]
-    annot = annot.loc[annot['Type'] == 'gene', ]
-    chr_indx = np.array([chrom in chroms_use for chrom in annot['Chr']])
-    annot = annot.loc[chr_indx, ]
+    annot = annot.loc[(annot['Type'] == 'gene')
+                      & annot['Chr'].isin(chroms_use), :]
 
     # parse the info field to get each gene's annotation data
-    gn_annot = {gsub('\.[0-9]+', '', z['gene_id']).replace('"', ''): z
-                for z in [dict([['chr', an[0]]]
-                               + [['Start', an[2]]] + [['End', an[3]]] +
-                               [y for y in [x.split(' ')
-                                            for x in an[4].split('; ')]
-                                if len(y) == 2])
-                          for an in annot.values]
-                if z['gene_type'] == '"protein_coding"'}
-
-    for g in gn_annot:
-        gn_annot[g]['gene_name'] = gn_annot[g]['gene_name'].replace('"', '')
-
-    return gn_annot
+    gene_info = annot['Info'].str.extract(
+        'gene_id "(?P<ID>[^".]+)[^"]*";.*gene_type "(?P<gene_type>[^"]+)";'
+        '.*gene_name "(?P<gene_name>[^"]+)";',
+        expand=True
+        )
+    use_indx = (gene_info['gene_type'] == 'protein_coding').values
+
+    return pd.DataFrame({'ID': gene_info['ID'].values[use_indx],
+                         'gene_name': gene_info['gene_name'].values[use_indx],
+                         'chr': pd.Categorical(
+                             annot['Chr'].values[use_indx]),
+                         'Start': annot['Start'].values[use_indx],
+                         'End': annot['End'].values[use_indx]},
+                        columns=['ID', 'gene_name', 'chr', 'Start', 'End'])
+
+
+def get_gencode():
+    """Gets annotation data for protein-coding genes on non-sex
+       chromosomes from a Gencode file.
+
+    The annotation data is parsed from the GTF file once and saved to the
+    cache as an index of compact arrays which are memory-mapped on later
+    loads; the index is only loaded once per process.
+
+    Only the 'chr', 'Start', 'End', 'gene_name', and 'gene_type' fields
+    are kept for each gene, rather than every field of the gene's record in
+    the GTF file, and the value of 'gene_type' is no longer quoted.
+
+    Returns
+    -------
+    annot : GeneAnnot
+        Read-only dictionary with keys corresponding to Ensembl gene IDs
+        without their version suffix and values consisting of dicts with
+        the annotation fields listed above.
+    """
+    if gencode_file not in annot_cache:
+        cache_dir = os.path.join(
+            CACHE_PATH, 'annot', 'gencode.v22_v{}_{}'.format(
+                annot_index_version, get_file_checksum(gencode_file))
+            )
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+            write_column_store(parse_gencode(gencode_file), cache_dir)
+
+        annot_cache[gencode_file] = GeneAnnot(read_column_store(cache_dir))
+
+    return annot_cache[gencode_file]
 
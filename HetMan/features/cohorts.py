@@ -12,20 +12,175 @@ Author: Michal Grzadkowski <grzadkow@ohsu.edu>
 """
 
 from .expression import get_expr_bmeg
-from .variants import get_variants_mc3, MuTree
+from .variants import get_variants_mc3, MuTree, SampleBits
 from .copies import get_copies_firehose
-from .pathways import parse_sif
-from .annot import get_gencode
+from .pathways import (get_pathway_graph, PathwayGraph, path_graph_cache,
+                       write_pathway_graph, read_pathway_graph)
+from .annot import get_gencode, GeneAnnot
 from .drugs import get_expr_ioria, get_drug_ioria, get_drug_bmeg
+from .utils import write_matrix_store, read_matrix_store
 
 import numpy as np
+import pandas as pd
 from scipy.stats import fisher_exact
 import random
 
-from functools import reduce
+import os
+import copy
+import pickle
+import shutil
+
 from abc import abstractmethod
 
 
+def filter_omics(omic_mat,
+                 min_var=None, gene_missing=None, samp_missing=None,
+                 use_genes=None, block_size=256):
+    """Finds which samples and genetic features of an -omic dataset to use.
+
+    The missing values and the variance of each feature are found a block of
+    rows at a time in the dataset's own type, so that no copy of the entire
+    dataset is made, which allows for memory-mapped datasets to be filtered
+    while only reading each row from disk once, or twice when removing
+    samples with any missing values. Samples with all of their values
+    missing are removed first, after which genetic features are checked for
+    membership in the given list of features, for missing values, and for
+    their variance across the remaining samples; finally, samples with any
+    missing values among the features that passed the missing value and
+    variance filters are removed. As in the original constructor of
+    :class:`VariantCohort`, this includes features that are not in the given
+    list, whose samples are thus also checked for missing values.
+
+    Args:
+        omic_mat (pandas DataFrame), shape = [n_samples, n_features]
+        min_var (float, optional): Features whose variance across samples
+                                   is not greater than this are removed.
+        gene_missing (str, optional): If 'any', features with any missing
+                                      values are removed.
+        samp_missing (str, optional): If 'all', samples with no values are
+                                      removed, if 'any', samples with any
+                                      missing values are removed.
+        use_genes (iterable of str, optional): Features not in this list,
+                                               e.g. because they are not in
+                                               an annotation dataset, are
+                                               removed.
+        block_size (int, optional): How many rows to read at a time.
+
+    Returns:
+        samp_mask (array of bool), shape = [n_samples]
+        gene_mask (array of bool), shape = [n_features]
+        filter_report (dict): The samples or features removed by each of the
+                              filters, each of which is only listed under
+                              the first filter that removed it.
+
+    Examples:
+        >>> samp_mask, gene_mask, filter_report = filter_omics(
+        >>>     expr, min_var=0.005, samp_missing='any',
+        >>>     use_genes=get_gencode().gene_names
+        >>>     )
+        >>> print(filter_report['low_var_genes'])
+
+    """
+    if samp_missing not in (None, 'any', 'all'):
+        raise ValueError("Unknown missing sample filter " + str(samp_missing)
+                         + " specified!")
+    if gene_missing not in (None, 'any'):
+        raise ValueError("Unknown missing feature filter "
+                         + str(gene_missing) + " specified!")
+
+    omic_vals = omic_mat.values
+    n_samps, n_genes = omic_vals.shape
+    filter_report = {}
+
+    samp_mask = np.ones(n_samps, dtype=bool)
+    gene_nan = np.zeros(n_genes, dtype=bool)
+    samp_counts = np.zeros(n_genes)
+    gene_means = np.zeros(n_genes)
+    gene_sqdevs = np.zeros(n_genes)
+
+    for i in range(0, n_samps, block_size):
+        blk_vals = omic_vals[i:(i + block_size)]
+        blk_nan = np.isnan(blk_vals)
+
+        if samp_missing == 'all':
+            blk_mask = ~blk_nan.all(axis=1)
+            samp_mask[i:(i + block_size)] = blk_mask
+
+            if not blk_mask.all():
+                blk_vals = blk_vals[blk_mask]
+                blk_nan = blk_nan[blk_mask]
+
+        gene_nan |= blk_nan.any(axis=0)
+
+        # finds the mean and the sum of squared deviations of each feature's
+        # non-missing values in the block, and merges them with those of the
+        # previous blocks using the pairwise update of Chan et al.
+        if min_var is not None:
+            blk_counts = np.sum(~blk_nan, axis=0)
+            new_counts = samp_counts + blk_counts
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                blk_means = np.nansum(blk_vals, axis=0,
+                                      dtype=np.float64) / blk_counts
+                blk_sqdevs = np.nansum((blk_vals - blk_means) ** 2, axis=0)
+
+                mean_diffs = blk_means - gene_means
+                blk_wghts = blk_counts / new_counts
+
+            use_blk = blk_counts > 0
+            gene_sqdevs[use_blk] += (
+                blk_sqdevs[use_blk] + mean_diffs[use_blk] ** 2
+                * samp_counts[use_blk] * blk_wghts[use_blk]
+                )
+            gene_means[use_blk] += mean_diffs[use_blk] * blk_wghts[use_blk]
+            samp_counts = new_counts
+
+    if samp_missing == 'all':
+        filter_report['missing_samps'] = omic_mat.index[~samp_mask].tolist()
+
+    annot_mask = np.ones(n_genes, dtype=bool)
+    if use_genes is not None:
+        annot_mask = omic_mat.columns.isin(list(use_genes))
+        filter_report['unannotated_genes'] = omic_mat.columns[
+            ~annot_mask].tolist()
+
+    # features not in the given list are still run through the other
+    # filters, but are only reported as having been removed by the first
+    keep_mask = np.ones(n_genes, dtype=bool)
+    if gene_missing == 'any':
+        filter_report['missing_genes'] = omic_mat.columns[
+            gene_nan & annot_mask].tolist()
+        keep_mask &= ~gene_nan
+
+    # the variance of each feature is found across its non-missing values
+    if min_var is not None:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            gene_vars = gene_sqdevs / samp_counts
+
+        var_mask = ~(gene_vars > min_var) & keep_mask
+        filter_report['low_var_genes'] = omic_mat.columns[
+            var_mask & annot_mask].tolist()
+        keep_mask &= ~var_mask
+
+    gene_mask = keep_mask & annot_mask
+
+    # finds the samples with missing values among the features that passed
+    # the missing value and variance filters in a second pass over the data
+    if samp_missing == 'any':
+        gene_indx = np.where(keep_mask)[0]
+        any_mask = np.zeros(n_samps, dtype=bool)
+
+        for i in range(0, n_samps, block_size):
+            any_mask[i:(i + block_size)] = np.isnan(np.take(
+                omic_vals[i:(i + block_size)], gene_indx, axis=1)).any(axis=1)
+
+        any_mask &= samp_mask
+        filter_report['missing_samps'] = omic_mat.index[any_mask].tolist()
+        samp_mask &= ~any_mask
+
+    return samp_mask, gene_mask, filter_report
+
+
 class OmicCohort(object):
     """Base class for cohorts consisting of the features used to learn on.
 
@@ -67,14 +222,99 @@ class OmicCohort(object):
             self.samples = train_samps.copy()
             self.train_samps = frozenset(train_samps)
 
-        # remove duplicate features from the dataset and get
-        # list of genomic features
-        self.omic_mat = omic_mat.loc[self.samples, ~omic_mat.columns.duplicated()]
+        # remove duplicate features from the dataset and get list of genomic
+        # features; the samples are ordered so that the training samples
+        # form a contiguous block of rows which can be retrieved as a view
+        use_samps = sorted(self.train_samps)
+        if test_samps is not None:
+            use_samps += sorted(self.test_samps)
+
+        self.omic_mat = omic_mat.loc[use_samps,
+                                     ~omic_mat.columns.duplicated()]
         self.genes = frozenset(self.omic_mat.columns)
 
         self.cohort = cohort
         self.cv_seed = cv_seed
 
+    def omic_index(self,
+                   include_samps=None, exclude_samps=None,
+                   include_genes=None, exclude_genes=None,
+                   use_test=False):
+        """Gets the positions of a subset of the -omic dataset's dimensions.
+
+        The positions of the training and testing samples in the -omic
+        matrix as well as a map from genes to matrix columns are found the
+        first time they are needed, and the positions matching a given set of
+        inclusion/exclusion criteria are remembered for subsequent calls,
+        until either the matrix or the training/testing split is replaced.
+        See :func:`omic_dims` for how the criteria are applied.
+
+        Returns:
+            samp_indx (array of int): Matrix rows of the samples to be used,
+                                      in increasing order.
+            gene_indx (array of int): Matrix columns of the genetic features
+                                      to be used, in increasing order.
+
+        """
+        samps = self.test_samps if use_test else self.train_samps
+        if getattr(self, '_dims_cache', None) is None:
+            self._dims_cache = {}
+
+        # the remembered positions are discarded if the -omic matrix or the
+        # sample split have been replaced since they were found
+        if (self._dims_cache.get('omic_mat', None) is not self.omic_mat
+                or self._dims_cache.get('train', None) is not self.train_samps
+                or self._dims_cache.get('test', None) is not getattr(
+                    self, 'test_samps', None)):
+            self._dims_cache = {
+                'omic_mat': self.omic_mat, 'train': self.train_samps,
+                'test': getattr(self, 'test_samps', None),
+                'samps': {samp: i for i, samp
+                          in enumerate(self.omic_mat.index)},
+                'genes': {gene: i for i, gene
+                          in enumerate(self.omic_mat.columns)},
+                'index': {}
+                }
+
+        dims_key = tuple(None if dims is None else frozenset(dims)
+                         for dims in (include_samps, exclude_samps,
+                                      include_genes, exclude_genes))
+        dims_key += (use_test, )
+
+        if dims_key not in self._dims_cache['index']:
+            samp_map = self._dims_cache['samps']
+            gene_map = self._dims_cache['genes']
+
+            samp_mask = np.zeros(self.omic_mat.shape[0], dtype=bool)
+            samp_mask[[samp_map[samp] for samp in samps]] = True
+            gene_mask = np.ones(self.omic_mat.shape[1], dtype=bool)
+
+            # remove samples as necessary
+            if include_samps is not None:
+                incl_mask = np.zeros(self.omic_mat.shape[0], dtype=bool)
+                incl_mask[[samp_map[samp] for samp in dims_key[0]
+                           if samp in samp_map]] = True
+                samp_mask &= incl_mask
+
+            if exclude_samps is not None:
+                samp_mask[[samp_map[samp] for samp in dims_key[1]
+                           if samp in samp_map]] = False
+
+            # remove genetic features as necessary
+            if include_genes is not None:
+                gene_mask[:] = False
+                gene_mask[[gene_map[gene] for gene in dims_key[2]
+                           if gene in gene_map]] = True
+
+            if exclude_genes is not None:
+                gene_mask[[gene_map[gene] for gene in dims_key[3]
+                           if gene in gene_map]] = False
+
+            self._dims_cache['index'][dims_key] = (np.where(samp_mask)[0],
+                                                   np.where(gene_mask)[0])
+
+        return self._dims_cache['index'][dims_key]
+
     def omic_dims(self,
                   include_samps=None, exclude_samps=None,
                   include_genes=None, exclude_genes=None,
@@ -101,53 +341,179 @@ class OmicCohort(object):
                 samples, default is to use the training cohort.
 
         Returns:
-            samps (list): The samples to be used.
-            genes (list): The genetic features to be used.
+            samps (list): The samples to be used, in the order they appear
+                          in the -omic dataset.
+            genes (list): The genetic features to be used, in the order they
+                          appear in the -omic dataset.
+
+        """
+        samp_indx, gene_indx = self.omic_index(
+            include_samps, exclude_samps, include_genes, exclude_genes,
+            use_test
+            )
+
+        return (self.omic_mat.index[samp_indx].tolist(),
+                self.omic_mat.columns[gene_indx].tolist())
+
+    def omic_slice(self, samp_indx, gene_indx):
+        """Gets the values of the -omic dataset at the given positions.
+
+        Contiguous blocks of samples using all of the genetic features are
+        returned as read-only views of the -omic matrix, otherwise only the
+        given rows and columns are copied from it.
 
         """
+        omic_vals = self.omic_mat.values
 
-        # get samples and genes available in the given cohort
-        if use_test:
-            samps = self.test_samps.copy()
+        if (len(samp_indx) > 0
+                and samp_indx[-1] - samp_indx[0] + 1 == len(samp_indx)):
+            omic_vals = omic_vals[samp_indx[0]:(samp_indx[-1] + 1)]
         else:
-            samps = self.train_samps.copy()
-        genes = self.genes.copy()
+            omic_vals = np.take(omic_vals, samp_indx, axis=0)
 
-        # remove samples samples as necessary
-        if include_samps is not None:
-            samps &= set(include_samps)
-        if exclude_samps is not None:
-            samps -= set(exclude_samps)
+        if len(gene_indx) < self.omic_mat.shape[1]:
+            omic_vals = np.take(omic_vals, gene_indx, axis=1)
 
-        # remove genetic features as necessary
-        if include_genes is not None:
-            genes &= set(include_genes)
-        if exclude_genes is not None:
-            genes -= set(exclude_genes)
+        if omic_vals.base is not None:
+            omic_vals = omic_vals.view()
+            omic_vals.flags.writeable = False
 
-        return samps, genes
+        return pd.DataFrame(omic_vals,
+                            index=self.omic_mat.index[samp_indx],
+                            columns=self.omic_mat.columns[gene_indx],
+                            copy=False)
 
     def train_omics(self,
                     include_samps=None, exclude_samps=None,
                     include_genes=None, exclude_genes=None):
         """Retrieval of the training cohort from the -omic dataset."""
 
-        samps, genes = self.omic_dims(include_samps, exclude_samps,
-                                      include_genes, exclude_genes,
-                                      use_test=False)
-
-        return self.omic_mat.loc[samps, genes]
+        return self.omic_slice(*self.omic_index(
+            include_samps, exclude_samps, include_genes, exclude_genes,
+            use_test=False
+            ))
 
     def test_omics(self,
                    include_samps=None, exclude_samps=None,
                    include_genes=None, exclude_genes=None):
         """Retrieval of the testing cohort from the -omic dataset."""
 
-        samps, genes = self.omic_dims(include_samps, exclude_samps,
-                                      include_genes, exclude_genes,
-                                      use_test=True)
+        return self.omic_slice(*self.omic_index(
+            include_samps, exclude_samps, include_genes, exclude_genes,
+            use_test=True
+            ))
+
+    def split_view(self, cv_seed, cv_prop=2.0/3):
+        """Gets a view of the cohort with a new training/testing split.
+
+        The view shares the -omic dataset and all other data of the cohort,
+        and only differs from it in its sets of training and testing samples,
+        so that many splits of a cohort can be considered while only having to
+        load its datasets once. The split is done in the same way as when
+        cohorts are constructed, so that a view of a cohort that uses all of
+        its samples for training has the same split as a cohort constructed
+        with the same random seed. For this purpose, cohorts that remove
+        samples after having split them, such as :class:`MutCohort`, keep
+        the samples they split in their `split_samples` attribute; the view
+        splits these samples and then removes the same samples.
+
+        Args:
+            cv_seed (int): A random seed used for the split.
+            cv_prop (float): Proportion of samples to use for training.
+
+        Returns:
+            coh_view (OmicCohort)
+
+        Examples:
+            >>> cdata = MutCohort(syn, cohort='TCGA-OV', mut_genes=['RB1'],
+            >>>                   cv_prop=1.0)
+            >>> for cv_id in range(5):
+            >>>     cv_data = cdata.split_view(cv_seed=(cv_id + 3) * 19)
+
+        """
+        if cv_prop <= 0 or cv_prop > 1:
+            raise ValueError("Improper cross-validation ratio that is "
+                             "not > 0 and <= 1.0")
+
+        if getattr(self, 'test_samps', None):
+            raise ValueError("Views can only be made of cohorts that use "
+                             "all of their samples for training!")
 
-        return self.omic_mat.loc[samps, genes]
+        use_samples = list(getattr(self, 'split_samples',
+                                   sorted(self.samples)))
+        random.seed(a=cv_seed)
+
+        if cv_prop < 1:
+            train_samps = set(
+                random.sample(population=use_samples,
+                              k=int(round(len(use_samples) * cv_prop)))
+                )
+        else:
+            train_samps = set(use_samples)
+
+        coh_view = copy.copy(self)
+        coh_view._dims_cache = None
+        coh_view.train_samps = frozenset(train_samps & self.samples)
+        coh_view.test_samps = frozenset(
+            (set(use_samples) - train_samps) & self.samples)
+        coh_view.cv_seed = cv_seed
+        coh_view.cv_prop = cv_prop
+
+        return coh_view
+
+    def save_snapshot(self, snap_dir, snap_key=None):
+        """Saves the cohort as a bundle that can be loaded without having
+           to retrieve and process its datasets again.
+
+        The -omic dataset is saved as a matrix that is memory-mapped when the
+        bundle is loaded. A pathway graph shared through the cache, such as
+        the one given by :func:`.get_pathway_graph`, is only referred to by
+        the bundle and is loaded from the cache again, while any other
+        pathway graph is saved alongside the matrix in the cache's format.
+        All other attributes of the cohort, such as its training/testing
+        split and its mutation trees, are pickled. As with the stores in the
+        cache, the bundle is written to a temporary directory which is then
+        renamed, so that many tasks can safely try to create the same bundle
+        at the same time.
+
+        Args:
+            snap_dir (str): Where the bundle is to be saved.
+            snap_key (optional): The inputs the cohort was constructed from,
+                                 which are checked by :func:`load_snapshot`
+                                 before loading the bundle.
+
+        Examples:
+            >>> cdata.save_snapshot('snapshots/BRCA_TP53',
+            >>>                     snap_key=('TCGA-BRCA', 'TP53'))
+            >>> cdata = load_snapshot('snapshots/BRCA_TP53',
+            >>>                       snap_key=('TCGA-BRCA', 'TP53'))
+
+        """
+        tmp_dir = '{}.{}.tmp'.format(snap_dir.rstrip('/'), os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        write_matrix_store(self.omic_mat, os.path.join(tmp_dir, 'omics'))
+        coh_state = {k: v for k, v in self.__dict__.items()
+                     if k not in ('omic_mat', '_dims_cache')}
+
+        path_graph = coh_state.get('path', None)
+        shared_path = any(path_graph is graph
+                          for graph in path_graph_cache.values())
+
+        if shared_path:
+            del coh_state['path']
+        elif isinstance(path_graph, PathwayGraph):
+            write_pathway_graph(coh_state.pop('path'),
+                                os.path.join(tmp_dir, 'pathways'))
+
+        with open(os.path.join(tmp_dir, 'cohort.p'), 'wb') as fl:
+            pickle.dump({'class': type(self), 'state': coh_state,
+                         'key': snap_key, 'shared_path': shared_path}, fl)
+
+        try:
+            os.rename(tmp_dir, snap_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir)
 
     @abstractmethod
     def train_pheno(self, pheno):
@@ -158,6 +524,47 @@ class OmicCohort(object):
         """Returns the testing values of a phenotype."""
 
 
+def load_snapshot(snap_dir, snap_key=None):
+    """Loads a cohort saved using :meth:`OmicCohort.save_snapshot`.
+
+    Args:
+        snap_dir (str): Where the cohort bundle was saved.
+        snap_key (optional): The inputs the cohort is expected to have been
+                             constructed from, as given when it was saved.
+
+    Returns:
+        cdata (OmicCohort): The cohort, whose -omic dataset is a read-only
+                            view of the memory-mapped matrix in the bundle.
+
+    Raises:
+        IOError: If no complete cohort bundle exists at the given location.
+        ValueError: If the bundle was saved with different inputs.
+
+    """
+    coh_file = os.path.join(snap_dir, 'cohort.p')
+    if not os.path.isfile(coh_file):
+        raise IOError("No cohort snapshot found at " + snap_dir + " !")
+
+    with open(coh_file, 'rb') as fl:
+        coh_data = pickle.load(fl)
+
+    if coh_data.get('key', None) != snap_key:
+        raise ValueError("Cohort snapshot at " + snap_dir + " was saved "
+                         "with inputs " + repr(coh_data.get('key', None))
+                         + " instead of " + repr(snap_key) + " !")
+
+    cdata = coh_data['class'].__new__(coh_data['class'])
+    cdata.__dict__.update(coh_data['state'])
+    cdata.omic_mat = read_matrix_store(os.path.join(snap_dir, 'omics'))
+
+    if coh_data.get('shared_path', False):
+        cdata.path = get_pathway_graph()
+    elif os.path.isdir(os.path.join(snap_dir, 'pathways')):
+        cdata.path = read_pathway_graph(os.path.join(snap_dir, 'pathways'))
+
+    return cdata
+
+
 class LabelCohort(OmicCohort):
     """A matched pair of omics and discrete phenotypic data."""
 
@@ -184,9 +591,14 @@ class VariantCohort(LabelCohort):
         cv_prop (float): Proportion of samples to use for cross-validation.
 
     Attributes:
-        path (dict): Pathway Commons neighbourhood for the mutation genes.
+        path (.pathways.PathwayGraph): Pathway Commons interactions, which
+                                       can be indexed to get the
+                                       neighbourhood of a mutation gene.
         train_mut (.variants.MuTree): Training cohort mutations.
         test_mut (.variants.MuTree): Testing cohort mutations.
+        split_samples (tuple of str): The samples that were split into the
+                                      training and testing cohorts, in the
+                                      order they were sampled from.
 
     Examples:
         >>> import synapseclient
@@ -199,6 +611,9 @@ class VariantCohort(LabelCohort):
 
     """
 
+    # how the expression data is filtered, see :func:`filter_omics`
+    omic_filters = {'min_var': 0.005, 'samp_missing': 'any'}
+
     def __init__(self,
                  syn, cohort, mut_genes, mut_levels=('Gene', 'Form'),
                  cv_seed=None, cv_prop=2.0/3):
@@ -210,35 +625,44 @@ class VariantCohort(LabelCohort):
 
         # loads gene expression and mutation data
         expr = get_expr_bmeg(cohort)
-        variants = get_variants_mc3(syn)
+        variants = get_variants_mc3(syn, genes=mut_genes)
 
         # loads the pathway neighbourhood of the variant genes, as well as
         # annotation data for all genes
-        self.path = parse_sif(mut_genes)
+        self.path = get_pathway_graph()
         annot = get_gencode()
 
         # filters out genes that don't have any variation across the samples
-        # or are not included in the annotation data
-        expr = expr.loc[:, expr.apply(lambda x: np.var(x) > 0.005)].dropna()
-        annot = {g: a for g,a in annot.items()
-                 if a['gene_name'] in expr.columns}
-        annot_genes = [a['gene_name'] for g, a in annot.items()]
-        expr = expr.loc[:, annot_genes]
+        # or are not included in the annotation data, as well as samples
+        # with missing expression values
+        samp_mask, gene_mask, self.filter_report = filter_omics(
+            expr, use_genes=annot.gene_names, **self.omic_filters)
+        expr = expr.iloc[np.where(samp_mask)[0], np.where(gene_mask)[0]]
 
         # gets set of samples shared across expression and mutation datasets,
         # subsets these datasets to use only these samples
-        use_samples = list(set(variants['Sample']) & set(expr.index))
+        use_samples = list(set(variants['Sample'].cat.categories)
+                           & set(expr.index))
         use_samples.sort()
-        variants = variants.loc[variants['Gene'].isin(mut_genes), :]
-
-        # gets annotation data for the genes whose mutations
-        # are under consideration
-        annot_data = {a['gene_name']: {'ID': g, 'Chr': a['chr'],
-                                       'Start': a['Start'], 'End': a['End']}
-                      for g, a in annot.items()
-                      if a['gene_name'] in mut_genes}
-        self.annot = annot
-        self.mut_annot = annot_data
+        self.split_samples = tuple(use_samples)
+
+        # converts the categorical columns of the mutation table to plain
+        # values now that only the variants of interest are left
+        for col in variants.select_dtypes(include=['category']).columns:
+            variants[col] = variants[col].astype(object)
+
+        # gets annotation data for the genes in the expression data and for
+        # the genes whose mutations are under consideration
+        annot_rows = np.where(np.in1d(annot.gene_names, expr.columns))[0]
+        self.annot = GeneAnnot(annot.annot_data.iloc[annot_rows])
+
+        self.mut_annot = {
+            annot.gene_names[i]: {'ID': annot.gene_ids[i],
+                                  'Chr': annot.chroms[i],
+                                  'Start': annot.starts[i],
+                                  'End': annot.ends[i]}
+            for i in annot.name_rows(mut_genes) if i >= 0
+            }
 
         # gets subset of samples to use for training, and split the expression
         # and variant datasets accordingly into training/testing cohorts
@@ -264,18 +688,64 @@ class VariantCohort(LabelCohort):
             levels=mut_levels
             )
 
+        # cohorts that use all of their samples for training have their
+        # mutation tree made compact, so that it can be shared by the views
+        # of the cohort given by :meth:`split_view`
+        if test_samps is None:
+            self.train_mut.compact(use_samples)
+
         super().__init__(expr, train_samps, test_samps, cohort, cv_seed)
 
     def train_pheno(self, mtype, samps=None):
+        """Gets the mutation status of the training samples, by default in
+           the same order as the rows of :meth:`train_omics`."""
         if samps is None:
-            samps = self.train_samps
+            samps = self.train_omics().index
         return self.train_mut.status(samps, mtype)
 
     def test_pheno(self, mtype, samps=None):
+        """Gets the mutation status of the testing samples, by default in
+           the same order as the rows of :meth:`test_omics`."""
         if samps is None:
-            samps = self.test_samps
+            samps = self.test_omics().index
         return self.test_mut.status(samps, mtype)
 
+    def split_view(self, cv_seed, cv_prop=2.0/3):
+        """Gets a view of the cohort with a new training/testing split, with
+           mutation trees restricted to the view's samples.
+
+        The mutation tree of the cohort, which is made compact when the
+        cohort is constructed, is left unchanged; the trees of all views
+        share its sample registry and are found from it using bitsets of
+        their training and testing samples, see :meth:`MuTree.sample_view`.
+        Levels such as `Score_clust`, which are parsed using all of the
+        mutations of a tree, would thus not be parsed again using only the
+        mutations of the view's samples as in a cohort constructed with the
+        view's split, so views cannot be made of cohorts with such levels.
+
+        """
+        if self.train_mut.samp_index is None:
+            raise ValueError("Views can only be made of cohorts whose "
+                             "mutation tree is compact!")
+
+        for lvl in self.train_mut.get_levels():
+            lvl_info = lvl.split('_')
+
+            if (len(lvl_info) == 2
+                    and lvl_info[1].lower() in MuTree.node_parsers):
+                raise ValueError("Views cannot be made of cohorts whose "
+                                 "mutation tree has the level " + lvl
+                                 + ", which depends on all of the cohort's "
+                                 "samples!")
+
+        coh_view = super().split_view(cv_seed, cv_prop)
+        coh_view.train_mut = self.train_mut.sample_view(coh_view.train_samps)
+        if coh_view.test_samps:
+            coh_view.test_mut = self.train_mut.sample_view(
+                coh_view.test_samps)
+
+        return coh_view
+
     def mutex_test(self, mtype1, mtype2):
         """Tests the mutual exclusivity of two mutation types.
 
@@ -353,11 +823,7 @@ class MutCohort(VariantCohort):
 
         # loads copy number data, gets list of samples with CNA info
         copy_data = get_copies_firehose(cohort.split('-')[-1], mut_genes)
-        copy_samps = frozenset(
-            reduce(lambda x, y: x & y,
-                   set(tuple(copies.keys())
-                       for gn, copies in copy_data.items()))
-            )
+        copy_samps = frozenset(copy_data.columns)
 
         # removes samples that don't have CNA info
         self.samples = self.samples & copy_samps
@@ -367,62 +833,118 @@ class MutCohort(VariantCohort):
 
         # removes expression data for samples with no CNA info, removes
         # variant data for samples with no CNA info
-        self.omic_mat = self.omic_mat.loc[self.samples, :]
+        self.omic_mat = self.omic_mat.loc[
+            self.omic_mat.index.isin(list(self.samples)), :]
         self.train_mut = self.train_mut.subtree(self.train_samps)
         if cv_prop < 1.0:
             self.test_mut = self.test_mut.subtree(self.test_samps)
 
         # adds copy number alteration data to the mutation trees
-        for gn in mut_genes:
-            copy_vals = list(np.unique(list(copy_data[gn].values())))
-            copy_vals.remove(0)
-            val_labels = ['CNA_{}'.format(val) for val in copy_vals]
-
-            if gn not in self.train_mut._child:
-                self.train_mut._child[gn] = MuTree(
-                    muts=pd.DataFrame(
-                        {'Form': val_labels,
-                         'Sample': [None for _ in val_labels]}
-                        ),
-                    levels=['Form'])
-
-            if cv_prop < 1.0 and gn not in self.test_mut._child:
-                self.test_mut._child[gn] = MuTree(
-                    muts=pd.DataFrame(
-                        {'Form': val_labels,
-                         'Sample': [None for _ in val_labels]}
-                        ),
-                    levels=['Form'])
-
-            for val_lbl in val_labels:
-                self.train_mut[gn]._child[val_lbl] = set()
-                if cv_prop < 1.0:
-                    self.test_mut[gn]._child[val_lbl] = set()
-
-            for samp, val in copy_data[gn].items():
-                if val != 0:
-                    lbl_indx = copy_vals.index(val)
-
-                    if samp in self.train_samps:
-                        self.train_mut[gn]._child[val_labels[lbl_indx]].\
-                            update({samp})
-                    elif cv_prop < 1.0:
-                        self.test_mut[gn]._child[val_labels[lbl_indx]].\
-                            update({samp})
-
-            for val_lbl in val_labels:
-                if self.train_mut[gn]._child[val_lbl]:
-                    self.train_mut[gn]._child[val_lbl] = frozenset(
-                        self.train_mut[gn]._child[val_lbl])
-                else:
-                    del(self.train_mut[gn]._child[val_lbl])
-
-                if cv_prop < 1.0:
-                    if self.test_mut[gn]._child[val_lbl]:
-                        self.test_mut[gn]._child[val_lbl] = frozenset(
-                            self.test_mut[gn]._child[val_lbl])
-                    else:
-                        del(self.test_mut[gn]._child[val_lbl])
+        mtree_samps = [(self.train_mut, self.train_samps)]
+        if cv_prop < 1.0:
+            mtree_samps += [(self.test_mut, self.test_samps)]
+        self.add_copies(copy_data, mtree_samps)
+
+    @staticmethod
+    def add_copies(copy_data, mtree_samps):
+        """Adds copy number alterations to trees of variant mutations.
+
+        The CNAs of all of the genes are found and grouped by tree, gene,
+        and type of CNA using a single sort of the positions of the non-zero
+        values in the copy number array, after which each group is added to
+        its tree as a leaf node.
+
+        Args:
+            copy_data (pandas DataFrame of int8), shape = [n_genes, n_samps]
+            mtree_samps (list of tuple): Pairs of a MuTree, whose top level
+                                         is 'Gene' and whose second level is
+                                         'Form', and the set of samples whose
+                                         CNAs are to be added to it, such as
+                                         the training and testing cohorts.
+                                         The sets of samples must be
+                                         disjoint.
+
+        Returns:
+            mtrees (list of MuTree): The given trees, each with a branch at
+                                     the 'Form' level for each type of CNA
+                                     found in its samples. Compact trees
+                                     have their sample registry extended
+                                     with any of the samples not already
+                                     in it.
+
+        """
+        samp_trees = np.full(copy_data.shape[1], -1, dtype=int)
+
+        for k, (_, samps) in enumerate(mtree_samps):
+            samp_indx = copy_data.columns.get_indexer(list(samps))
+            samp_indx = samp_indx[samp_indx >= 0]
+
+            if (samp_trees[samp_indx] >= 0).any():
+                raise ValueError("The samples whose CNAs are added to "
+                                 "different trees must be disjoint!")
+            samp_trees[samp_indx] = k
+
+        # finds the positions of all the CNAs in one pass over the array,
+        # and sorts them by tree, gene, type of CNA, and sample
+        gene_indx, samp_indx = np.nonzero(copy_data.values)
+        use_cnas = samp_trees[samp_indx] >= 0
+        gene_indx, samp_indx = gene_indx[use_cnas], samp_indx[use_cnas]
+        tree_indx = samp_trees[samp_indx]
+
+        cna_vals, cna_indx = np.unique(
+            copy_data.values[gene_indx, samp_indx], return_inverse=True)
+        cna_lbls = ['CNA_{}'.format(val) for val in cna_vals]
+
+        sort_indx = np.lexsort((samp_indx, cna_indx, gene_indx, tree_indx))
+        grp_keys = np.vstack([tree_indx, gene_indx, cna_indx])[:, sort_indx]
+        copy_samps = np.asarray(copy_data.columns,
+                                dtype=object)[samp_indx[sort_indx]]
+
+        # finds where each group of CNAs of the same tree, gene, and type
+        # starts and ends in the sorted CNAs
+        grp_starts = np.concatenate([
+            [0], np.flatnonzero((np.diff(grp_keys, axis=1) != 0).any(axis=0))
+            + 1
+            ]) if len(sort_indx) else np.array([], dtype=int)
+        grp_ends = np.append(grp_starts[1:], len(sort_indx))
+
+        # compact trees missing any of the samples with CNAs have these
+        # samples added to the end of their registry
+        for k, (mtree, _) in enumerate(mtree_samps):
+            if mtree.samp_index is not None:
+                new_samps = sorted(
+                    set(copy_samps[grp_keys[0] == k])
+                    - set(mtree.samp_index)
+                    )
+
+                if new_samps:
+                    mtree.compact(mtree.samp_index.append(
+                        pd.Index(new_samps)))
+
+        for start, end in zip(grp_starts, grp_ends):
+            k, i, j = grp_keys[:, start]
+            mtree = mtree_samps[k][0]
+            gn = copy_data.index[i]
+
+            if mtree.samp_index is not None:
+                cna_samps = SampleBits.from_samples(copy_samps[start:end],
+                                                    mtree.samp_index)
+            else:
+                cna_samps = frozenset(copy_samps[start:end])
+
+            # genes without variants get a new branch containing only CNAs,
+            # genes with variants get a 'Form' branch for each type of CNA
+            if gn not in mtree._child:
+                gene_tree = MuTree.__new__(MuTree)
+                gene_tree._set_node(mtree.depth + 1, 'Form', {})
+                mtree._child[gn] = gene_tree
+
+            mtree[gn]._child[cna_lbls[j]] = cna_samps
+
+        for mtree, _ in mtree_samps:
+            mtree.clear_cache()
+
+        return [mtree for mtree, _ in mtree_samps]
 
 
 class DrugCohort(ValueCohort):
@@ -439,11 +961,15 @@ class DrugCohort(ValueCohort):
             test_expr_ (pandas DataFrame of floats)
             train_resp_ (pandas DataFrame of floats)
             test_resp_ (pandas DataFrame of floats)
+            split_samples_ (tuple of str)
 
         Examples:
 
         """
 
+    # how the expression data is filtered, see :func:`filter_omics`
+    omic_filters = {'gene_missing': 'any', 'samp_missing': 'all'}
+
     def __init__(self, cohort, drug_names, cv_seed=None, cv_prop=2.0 / 3):
         if cv_prop <= 0 or cv_prop > 1:
             raise ValueError("Improper cross-validation ratio that is "
@@ -456,20 +982,26 @@ class DrugCohort(ValueCohort):
         # TODO: choose a non-AUC measure of drug response
         drug_resp = get_drug_ioria(drug_names)
 
-        # drops cell lines (rows) w/ no expression data & genes (cols)
-        # with any missing values
-        cell_expr = cell_expr.dropna(axis=0, how='all')\
-            .dropna(axis=1, how='any')
+        # finds cell lines (rows) w/ no expression data & genes (cols)
+        # with any missing values using the memory-mapped expression array
+        samp_mask, gene_mask, self.filter_report = filter_omics(
+            cell_expr, **self.omic_filters)
 
         # drops cell lines (rows) w/ no expression data
         drug_resp = drug_resp.dropna(axis=0, how='all')
 
-        # gets set of cell lines ("samples") shared between drug_resp and
-        # cell_expr datasets
-        use_samples = set(cell_expr.index) & set(drug_resp.index)
+        # gets the cell lines ("samples") shared between drug_resp and
+        # cell_expr datasets, sorted so that the split does not depend on
+        # the order in which the set of them is iterated over
+        use_samples = list(set(cell_expr.index[samp_mask])
+                           & set(drug_resp.index))
+        use_samples.sort()
+        self.split_samples = tuple(use_samples)
 
-        # discards data for cell lines which are not in samples set
-        cell_expr = cell_expr.loc[use_samples, :]
+        # discards data for cell lines which are not in samples set, only
+        # reading the expression values that will be used from disk
+        samp_pos = np.sort(cell_expr.index.get_indexer(use_samples))
+        cell_expr = cell_expr.iloc[samp_pos, np.where(gene_mask)[0]]
         drug_resp = drug_resp.loc[use_samples, :]
 
         # TODO: query bmeg for annotation data on each drug (def in drugs.py),
@@ -482,25 +1014,43 @@ class DrugCohort(ValueCohort):
             train_samps = set(
                 random.sample(population=use_samples,
                               k=int(round(len(use_samples) * cv_prop))))
-            test_samps = use_samples - train_samps
+            test_samps = set(use_samples) - train_samps
 
-            self.train_resp = drug_resp.loc[train_samps, :]
-            self.test_resp = drug_resp.loc[test_samps, :]
+            self.train_resp = drug_resp.loc[sorted(train_samps), :]
+            self.test_resp = drug_resp.loc[sorted(test_samps), :]
 
         else:
-            train_samps = use_samples
+            train_samps = set(use_samples)
             test_samps = set()
+            self.train_resp = drug_resp
 
         super().__init__(cell_expr, train_samps, test_samps, cohort, cv_seed)
 
     def train_pheno(self, drug, samps=None):
+        """Gets the drug response of the training samples, by default in
+           the same order as the rows of :meth:`train_omics`."""
         if samps is None:
-            samps = self.train_samps
+            samps = self.train_omics().index
 
         return self.train_resp.loc[samps, drug]
 
     def test_pheno(self, drug, samps=None):
+        """Gets the drug response of the testing samples, by default in
+           the same order as the rows of :meth:`test_omics`."""
         if samps is None:
-            samps = self.test_samps
+            samps = self.test_omics().index
 
         return self.test_resp.loc[samps, drug]
+
+    def split_view(self, cv_seed, cv_prop=2.0/3):
+        """Gets a view of the cohort with a new training/testing split, with
+           drug responses split according to the view's samples."""
+        coh_view = super().split_view(cv_seed, cv_prop)
+
+        coh_view.train_resp = self.train_resp.loc[
+            sorted(coh_view.train_samps), :]
+        if coh_view.test_samps:
+            coh_view.test_resp = self.train_resp.loc[
+                sorted(coh_view.test_samps), :]
+
+        return coh_view
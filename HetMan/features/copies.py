@@ -8,47 +8,90 @@ Author: Michal Grzadkowski <grzadkow@ohsu.edu>
 
 """
 
+from . import DATA_PATH, CACHE_PATH
+from .utils import parse_tcga_barcodes, get_bmeg_client, get_file_checksum
+from .utils import write_matrix_store, read_matrix_store
+
+import numpy as np
 import pandas as pd
-from ophion import Ophion
-from . import DATA_PATH
-from functools import reduce
+import os
 
 
-def get_copies_firehose(cohort, gene_list):
+def get_copies_firehose(cohort, gene_list, use_cache=True):
     """Loads gene-level copy number alteration data from Broad Firehose.
 
+    The first time a cohort is loaded its Firehose table is converted into
+    a gene x sample matrix of int8 values which is cached and memory-mapped
+    on subsequent loads, so that retrieving the CNA data for any list of
+    genes only involves looking up the rows corresponding to these genes.
+
     Args:
         cohort (str): The name of an cohort in Firehose.
         gene_list (list): The genes for which we want CNA data.
+        use_cache (bool, optional): Whether to load the copy number matrix
+                                    from and save it to the cache.
 
     Returns:
-        copy_data (dict): A nested dictionary where the first level
-                          corresponds to a gene and the second level
-                          corresponds to sample. Note that this CNA data has
-                          been thresholded and discretized to be integers in
-                          the range [-2, 2].
+        copy_data (pandas DataFrame of int8), shape = [n_genes, n_samps]
+            The copy number alteration values of each of the genes in the
+            given list found in the Firehose table, across all of the
+            cohort's samples. Note that this CNA data has been thresholded
+            and discretized to be integers in the range [-2, 2].
 
     Examples:
         >>> copy_data1 = get_copies_firehose("BRCA", ["TP53", "PTEN"])
         >>> copy_data2 = get_copies_firehose("SKCM", ["PIK3CA"])
 
     """
-    copy_table = pd.read_csv(DATA_PATH + '/copies/' + cohort
-                             + '_all_thresholded.by_genes.txt.gz', sep='\t')
+    copy_file = (DATA_PATH + '/copies/' + cohort
+                 + '_all_thresholded.by_genes.txt.gz')
+
+    if use_cache:
+        cache_dir = os.path.join(
+            CACHE_PATH, 'copies',
+            '{}_{}'.format(cohort, get_file_checksum(copy_file))
+            )
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+            write_matrix_store(parse_copies_firehose(copy_file), cache_dir,
+                               dtype=np.int8)
+        copy_mat = read_matrix_store(cache_dir)
+
+    else:
+        copy_mat = parse_copies_firehose(copy_file).astype(np.int8)
+
+    # finds the rows of the given genes using the hashed index of gene names
+    gene_indx = copy_mat.index.get_indexer(list(gene_list))
+    gene_indx = gene_indx[gene_indx >= 0]
+
+    return pd.DataFrame(copy_mat.values[gene_indx, :],
+                        index=copy_mat.index[gene_indx],
+                        columns=copy_mat.columns)
 
-    # parse the TCGA barcodes to remove unnecessary suffixes
-    copy_table.columns = [reduce(lambda x, y: x + '-' + y,
-                                 samp.split('-', 4)[:4])
-                          if 'TCGA' in samp else samp
-                          for samp in copy_table.columns]
 
-    # filter the copy-number data for the genes in the given list
-    copy_data = {gene: (copy_table.ix[copy_table.ix[:, 0] == gene, 3:]
-                           .iloc[0, :].to_dict()
-                        if gene in list(copy_table.ix[:, 0]) else None)
-                 for gene in gene_list}
+def parse_copies_firehose(copy_file):
+    """Parses a gene-level thresholded copy number table from Firehose.
+
+    Args:
+        copy_file (str): The location of the table.
+
+    Returns:
+        copy_mat (pandas DataFrame of int), shape = [n_genes, n_samps]
+
+    """
+    copy_table = pd.read_csv(copy_file, sep='\t', index_col=0)
+
+    # parse the TCGA barcodes to remove unnecessary suffixes, keeping only
+    # the last of any barcodes that refer to the same sample
+    copy_table = copy_table.iloc[:, 2:]
+    copy_table.columns = parse_tcga_barcodes(copy_table.columns)
+    copy_table = copy_table.loc[
+        ~copy_table.index.duplicated(keep='first'),
+        ~copy_table.columns.duplicated(keep='last')
+        ]
 
-    return copy_data
+    return copy_table
 
 
 def get_copies_bmeg(cohort, gene_list):
@@ -64,7 +107,7 @@ def get_copies_bmeg(cohort, gene_list):
         >>> copy_data = get_copies_bmeg('TCGA-OV')
 
     """
-    oph = Ophion("http://bmeg.io")
+    oph = get_bmeg_client()
     copy_list = {}
 
     for gene in gene_list:
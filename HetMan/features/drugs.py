@@ -8,37 +8,297 @@ Author: Michal Grzadkowski <grzadkow@ohsu.edu>
 
 """
 
-from . import DATA_PATH
+from . import DATA_PATH, CACHE_PATH
+from .normalize import exp_rank_norm
+from .utils import (get_bmeg_client, get_file_checksum,
+                    write_column_store, read_column_store,
+                    write_matrix_store, read_matrix_store)
 
+import numpy as np
 import pandas as pd
-from scipy import stats
+import scipy.sparse as sp
 
-from ophion import Ophion
-from fuzzywuzzy import process
+import os
+import re
 import json
 
+cell_expr_file = DATA_PATH + 'drugs/ioria/Cell_line_RMA_proc_basalExp.txt.gz'
+drug_annot_file = DATA_PATH + 'drugs/ioria/drug_annot.txt.gz'
+drug_auc_file = DATA_PATH + 'drugs/ioria/drug-auc.txt.gz'
 
-def exp_norm(expr):
-    out_expr = expr.apply(
-        lambda x: stats.expon.ppf((x.rank()-1) / len(x)), 1)
-    return out_expr.fillna(0.0)
+# which version of the drug name index format is stored in the cache, to be
+# incremented whenever the features used for matching names change
+drug_index_version = 1
 
+# drug name resolvers already loaded by this process
+drug_resolvers = {}
 
-def get_expr_ioria():
-    """Get the cell-line expression data used in the Ioria landscape study."""
 
-    cell_expr = pd.read_csv(
-        DATA_PATH + 'drugs/ioria/Cell_line_RMA_proc_basalExp.txt.gz',
-        sep='\t', comment='#'
-        )
+def exp_norm(expr):
+    """Normalizes the expression values of each cell line using
+       exponential rank transformation, see
+       :func:`.normalize.exp_rank_norm`."""
+    return exp_rank_norm(expr, axis=1)
+
 
-    cell_expr = cell_expr.ix[~pd.isnull(cell_expr['GENE_SYMBOLS']), :]
+def parse_expr_ioria(expr_file):
+    """Parses the Ioria cell-line expression table into a matrix with
+       cell lines as rows and gene symbols as columns."""
+    cell_expr = pd.read_csv(expr_file, sep='\t', comment='#')
+
+    cell_expr = cell_expr.loc[~pd.isnull(cell_expr['GENE_SYMBOLS']), :]
     cell_expr.index = cell_expr['GENE_SYMBOLS']
-    cell_expr = cell_expr.ix[:, 2:].transpose()
+    cell_expr = cell_expr.iloc[:, 2:].transpose()
 
     return cell_expr
 
 
+def get_expr_ioria(use_cache=True):
+    """Get the cell-line expression data used in the Ioria landscape study.
+
+    The expression table is parsed and transposed into a cell line x gene
+    matrix of float32 values once, which is cached and memory-mapped on
+    subsequent loads.
+
+    Args:
+        use_cache (bool, optional): Whether to load the expression matrix
+                                    from and save it to the cache.
+
+    Returns:
+        cell_expr (pandas DataFrame of float32), shape = [n_cells, n_genes]
+
+    """
+    if use_cache:
+        cache_dir = os.path.join(
+            CACHE_PATH, 'drugs',
+            'basal-expr_{}'.format(get_file_checksum(cell_expr_file))
+            )
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+            write_matrix_store(parse_expr_ioria(cell_expr_file), cache_dir,
+                               dtype=np.float32)
+        cell_expr = read_matrix_store(cache_dir)
+
+    else:
+        cell_expr = parse_expr_ioria(cell_expr_file).astype(np.float32)
+
+    return cell_expr
+
+
+def drug_name_features(drug):
+    """Gets the features of a drug name used to find approximate matches.
+
+    Names are represented by their lowercase alphanumeric tokens along with
+    the character trigrams of the concatenated tokens, which makes matching
+    robust to differences in case, punctuation, and minor misspellings.
+
+    Args:
+        drug (str): A drug name.
+
+    Returns:
+        key (str): The normalized name used to find exact matches.
+        features (set of str)
+
+    Examples:
+        >>> drug_name_features('Nutlin-3a')
+            ('nutlin3a', {'#nu', 'nut', 'utl', ..., '3a#', '_nutlin', '_3a'})
+
+    """
+    tokens = re.findall('[a-z0-9]+', str(drug).lower())
+    key = ''.join(tokens)
+    padded = '#' + key + '#'
+
+    return key, ({padded[i:(i + 3)] for i in range(len(padded) - 2)}
+                 | {'_' + tk for tk in tokens})
+
+
+class DrugNameResolver(object):
+    """Matches possibly approximate drug names to a drug annotation table.
+
+    Each drug's name and each of its synonyms is a candidate for matching.
+    The candidates are indexed by their normalized names, which are used to
+    find exact matches, as well as by a sparse matrix of their name features
+    which is used to score approximate matches for a whole list of queries
+    at once using cosine similarity. The index is built once and saved to
+    the cache along with a memo of the queries resolved so far.
+
+    Args:
+        annot_file (str): The location of the drug annotation table, which
+                          must have 'Name' and 'Synonyms' fields, the latter
+                          consisting of comma-separated lists of names.
+        use_cache (bool, optional): Whether to load the name index and the
+                                    memo of past matches from the cache, and
+                                    to save them there.
+
+    Examples:
+        >>> resolver = DrugNameResolver(drug_annot_file)
+        >>> resolver.resolve(['Olaparib', 'Olaparxx'])
+            [(182, 100), (182, 56)]
+
+    """
+
+    def __init__(self, annot_file, use_cache=True):
+        self.drug_annot = pd.read_csv(annot_file, sep='\t', comment='#')
+        self.memo_file = None
+        self.memo = {}
+
+        if use_cache:
+            cache_dir = os.path.join(
+                CACHE_PATH, 'drugs', '{}_v{}_{}'.format(
+                    os.path.basename(annot_file).split('.')[0],
+                    drug_index_version, get_file_checksum(annot_file)
+                    )
+                )
+
+            if not os.path.isdir(cache_dir):
+                os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+                write_column_store(self.build_index(), cache_dir)
+            name_index = read_column_store(cache_dir)
+
+            self.memo_file = os.path.join(cache_dir, 'matches.json')
+            if os.path.isfile(self.memo_file):
+                with open(self.memo_file, 'r') as fl:
+                    self.memo = json.load(fl)
+
+        else:
+            name_index = self.build_index()
+
+        # recovers the candidate names and their annotation rows, as well as
+        # the feature matrix of the candidates from the index table
+        cand_codes = name_index['Key'].cat.codes.values
+        self.cand_keys = {key: i for i, key
+                          in enumerate(name_index['Key'].cat.categories)}
+        self.cand_rows = np.zeros(len(self.cand_keys), dtype=int)
+        self.cand_rows[cand_codes] = name_index['Row'].values
+
+        self.feat_index = {feat: i for i, feat
+                           in enumerate(name_index['Feature'].cat.categories)}
+        feat_mat = sp.csr_matrix(
+            (np.ones(len(cand_codes)),
+             (cand_codes, name_index['Feature'].cat.codes.values)),
+            shape=(len(self.cand_keys), len(self.feat_index))
+            )
+        self.feat_mat = sp.diags(
+            1.0 / np.sqrt(np.asarray(feat_mat.sum(axis=1)).ravel())
+            ) * feat_mat
+
+    def build_index(self):
+        """Finds the name features of each candidate drug name.
+
+        Returns:
+            name_index (pandas DataFrame), shape = [n_features, 3]
+                The features of each normalized candidate name, with the
+                annotation table row of the drug each name belongs to.
+
+        """
+        index_recs = []
+        cand_keys = set()
+
+        for i, (name, synonyms) in enumerate(zip(
+                self.drug_annot['Name'], self.drug_annot['Synonyms'])):
+            cand_names = [name]
+            if not pd.isnull(synonyms):
+                cand_names += synonyms.split(',')
+
+            # if more than one drug shares a name, the name is matched to
+            # the first of these drugs in the annotation table
+            for cand_name in cand_names:
+                key, features = drug_name_features(cand_name)
+
+                if key and key not in cand_keys:
+                    cand_keys |= {key}
+                    index_recs += [(key, i, feat) for feat in features]
+
+        name_index = pd.DataFrame(index_recs,
+                                  columns=['Key', 'Row', 'Feature'])
+        for col in ('Key', 'Feature'):
+            name_index[col] = name_index[col].astype('category')
+
+        return name_index
+
+    def resolve(self, drug_list):
+        """Finds the best matching annotated drug for each given drug name.
+
+        Args:
+            drug_list (list of str): Which drug names to match.
+
+        Returns:
+            drug_match (list of tuple): The annotation table row of the best
+                                        matching drug for each name, and a
+                                        score between 0 and 100 for the
+                                        match, with 100 denoting an exact
+                                        match.
+
+        """
+        new_drugs = [drug for drug in set(drug_list) if drug not in self.memo]
+        approx_drugs = []
+
+        for drug in new_drugs:
+            key, _ = drug_name_features(drug)
+
+            if key in self.cand_keys:
+                self.memo[drug] = (int(self.cand_rows[self.cand_keys[key]]),
+                                   100)
+            else:
+                approx_drugs += [drug]
+
+        # scores all the candidate names against all of the names without
+        # an exact match at once
+        if approx_drugs:
+            query_rows, query_cols, query_vals = [], [], []
+
+            for i, drug in enumerate(approx_drugs):
+                features = drug_name_features(drug)[1]
+                feat_indx = [self.feat_index[feat] for feat in features
+                             if feat in self.feat_index]
+
+                # names without any features in common with the candidates,
+                # such as those without alphanumeric characters, are left
+                # with a score of zero for every candidate
+                if not feat_indx:
+                    continue
+
+                query_rows += [i] * len(feat_indx)
+                query_cols += feat_indx
+                query_vals += [1.0 / np.sqrt(len(features))] * len(feat_indx)
+
+            query_mat = sp.csr_matrix(
+                (query_vals, (query_rows, query_cols)),
+                shape=(len(approx_drugs), len(self.feat_index))
+                )
+
+            match_scores = (query_mat * self.feat_mat.T).toarray()
+            best_cands = np.argmax(match_scores, axis=1)
+
+            for i, (drug, cand) in enumerate(zip(approx_drugs, best_cands)):
+                self.memo[drug] = (
+                    int(self.cand_rows[cand]),
+                    min(int(round(match_scores[i, cand] * 100)), 99)
+                    )
+
+        if new_drugs and self.memo_file is not None:
+            tmp_file = '{}.{}.tmp'.format(self.memo_file, os.getpid())
+
+            with open(tmp_file, 'w') as fl:
+                json.dump(self.memo, fl)
+            os.replace(tmp_file, self.memo_file)
+
+        return [tuple(self.memo[drug]) for drug in drug_list]
+
+
+def get_drug_resolver(annot_file=None):
+    """Gets the drug name resolver for an annotation table, which is only
+       loaded once per process."""
+    if annot_file is None:
+        annot_file = drug_annot_file
+
+    if annot_file not in drug_resolvers:
+        drug_resolvers[annot_file] = DrugNameResolver(annot_file)
+
+    return drug_resolvers[annot_file]
+
+
 def get_drug_ioria(drug_list):
     """Get drug response data as collected by the Ioria landscape study.
 
@@ -55,30 +315,44 @@ def get_drug_ioria(drug_list):
         >>> drug_resp2 = get_drug_ioria(['Trametinib', 'Nutlin-3a'])
         >>> drug_resp3 = get_drug_ioria(['Olaparxx', 'RD119'])
         >>> print(drug_resp3.columns)
-            ['Olaparib', 'RDEA119']
+            ['Olaparxx__Olaparib', 'RD119__RDEA119']
+        >>> print(get_drug_ioria(['Selumetinib']).columns)
+            ['Selumetinib__AZD6244']
 
     """
-    drug_annot = pd.read_csv(DATA_PATH + 'drugs/ioria/drug_annot.txt.gz',
-                             sep='\t', comment='#')
-    drug_resp = pd.read_csv(DATA_PATH + 'drugs/ioria/drug-auc.txt.gz',
-                            sep='\t', comment='#', index_col=0)
+    drug_list = list(drug_list)
+    resolver = get_drug_resolver()
+
+    # the response matrix is memory-mapped from the cache after it is
+    # loaded for the first time
+    cache_dir = os.path.join(
+        CACHE_PATH, 'drugs',
+        'drug-auc_{}'.format(get_file_checksum(drug_auc_file))
+        )
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+        write_matrix_store(pd.read_csv(drug_auc_file, sep='\t',
+                                       comment='#', index_col=0),
+                           cache_dir)
+    drug_resp = read_matrix_store(cache_dir)
 
     # gets closest matching drug names available, retrieves corresponding drug
     # IDs used in the dataset
-    drug_match = [(process.extractOne(drug, drug_annot['Name']),
-                   process.extractOne(drug, drug_annot['Synonyms']))
-                  for drug in drug_list]
-    match_indx = [mtch[0] if mtch[0][1] > mtch[1][1] else mtch[1]
-                  for mtch in drug_match]
-    drug_lbl = ['X' + str(drug_annot['Identifier'][mtch[2]])
-                for mtch in match_indx]
-
-    # filter out drugs we don't need and replace approximate
-    # names with matches
+    drug_match = resolver.resolve(drug_list)
+    drug_lbl = ['X' + str(resolver.drug_annot['Identifier'][row])
+                for row, _ in drug_match]
+
+    # filter out drugs we don't need and replace approximate names, as well
+    # as names matching one of a drug's synonyms, with matches
     drug_resp = drug_resp.loc[:, drug_lbl]
-    drug_resp.columns = [mtch[0] if mtch[1] == 100
-                         else drg + '__' + mtch[0]
-                         for drg, mtch in zip(drug_list, match_indx)]
+    drug_resp.columns = [
+        resolver.drug_annot['Name'][row]
+        if (drug_name_features(drg)[0]
+            == drug_name_features(resolver.drug_annot['Name'][row])[0])
+        else drg + '__' + resolver.drug_annot['Name'][row]
+        for drg, (row, _) in zip(drug_list, drug_match)
+        ]
 
     return drug_resp
 
@@ -95,7 +369,7 @@ def get_drug_bmeg(cohort, drug_list):
     Examples:
 
     """
-    oph = Ophion("http://bmeg.io")
+    oph = get_bmeg_client()
     drug_data = {drug: None for drug in drug_list}
 
     return drug_expr
@@ -109,7 +383,7 @@ def get_drug_annot_bmeg(drug_list):
     """
     # how to handle drug name mismatches?
 
-    oph = Ophion("http://bmeg.io")
+    oph = get_bmeg_client()
 
     # some ophion query to fetch targets for drugs in drug_list
 
@@ -8,16 +8,21 @@ Author: Michal Grzadkowski <grzadkow@ohsu.edu>
 
 """
 
-from .utils import choose_bmeg_server
+from . import CACHE_PATH
+from .utils import get_bmeg_client, get_file_checksum
+from .utils import write_matrix_store, read_matrix_store
 
 import numpy as np
 import pandas as pd
 
+import os
+import re
+import gzip
 import json
-from ophion import Ophion
+import hashlib
 
 
-def log_norm_expr(expr):
+def log_norm_expr(expr, inplace=False):
     """Log-normalizes expression data.
 
     Puts a matrix of RNA-seq expression values into log-space after adding
@@ -25,6 +30,10 @@ def log_norm_expr(expr):
 
     Args:
         expr (array of float), shape = [n_samples, n_features]
+        inplace (bool, optional): Whether to overwrite the values of the
+                                  given array instead of making a normalized
+                                  copy, default False. Requires `expr` to be
+                                  a writeable NumPy array of floats.
 
     Returns:
         norm_expr (array of float), shape = [n_samples, n_features]
@@ -36,17 +45,277 @@ def log_norm_expr(expr):
                  [ 1.32192809,  3.08746284]]
 
     """
-    log_add = np.nanmin(expr[expr > 0]) * 0.5
-    norm_expr = np.log2(expr + log_add)
+    if not inplace:
+        log_add = np.nanmin(expr[expr > 0]) * 0.5
+        norm_expr = np.log2(expr + log_add)
+
+    # finds the smallest positive value a block of rows at a time so that no
+    # temporary arrays the size of the whole matrix are created
+    else:
+        min_val = np.inf
+        for i in range(0, expr.shape[0], 256):
+            expr_blk = expr[i:(i + 256)]
+            if np.any(expr_blk > 0):
+                min_val = min(min_val, np.nanmin(expr_blk[expr_blk > 0]))
+
+        norm_expr = np.log2(np.add(expr, min_val * 0.5, out=expr), out=expr)
 
     return norm_expr
 
 
-def get_expr_bmeg(cohort):
+def assemble_expr_mat(expr_recs, genes=None, dtype=np.float32):
+    """Streams per-sample expression records into a single matrix.
+
+    Records are written straight into a preallocated array as they arrive.
+    Unless they are given, the genes used as the matrix columns are fixed
+    by the first record; values of genes first seen in later records are
+    set aside and added as new columns in one final extension of the
+    matrix, so that the peak memory used is close to that of the final
+    matrix when all records have the same genes.
+
+    Args:
+        expr_recs (iterable): Pairs of (sample, {gene: value}) records.
+        genes (list of str, optional): Which genes to use as the columns of
+                                       the matrix. Default is to use every
+                                       gene appearing in any of the records.
+        dtype (numpy dtype, optional): The type of the matrix values.
+
+    Returns:
+        samps (list of str): The samples corresponding to the matrix rows.
+        genes (list of str): The genes corresponding to the matrix columns.
+        expr_mat (numpy array), shape = [len(samps), len(genes)]
+            The expression values, with genes missing from a sample's
+            record given a value of zero.
+
+    """
+    add_genes = genes is None
+    if not add_genes:
+        genes = list(genes)
+
+    gene_indx = {}
+    samps = []
+    samp_indx = {}
+    expr_mat = None
+
+    # the values of genes not among the matrix columns, given as
+    # {gene: {sample row: value}}
+    new_vals = {}
+
+    for samp, expr_vals in expr_recs:
+        if genes is None:
+            genes = list(expr_vals)
+
+        if expr_mat is None:
+            gene_indx = {gene: i for i, gene in enumerate(genes)}
+            expr_mat = np.zeros((256, len(genes)), dtype=dtype)
+
+        # samples appearing twice overwrite their earlier values
+        if samp not in samp_indx:
+            if len(samps) == expr_mat.shape[0]:
+                expr_mat.resize((expr_mat.shape[0] * 2, expr_mat.shape[1]),
+                                refcheck=False)
+
+            samp_indx[samp] = len(samps)
+            samps += [samp]
+
+        else:
+            for gene_vals in new_vals.values():
+                gene_vals.pop(samp_indx[samp], None)
+
+        samp_row = expr_mat[samp_indx[samp]]
+        samp_row[:] = 0
+
+        # the values can be copied over directly if the record has the same
+        # genes in the same order as the matrix columns
+        if len(expr_vals) == len(genes) and list(expr_vals) == genes:
+            samp_row[:] = np.fromiter(expr_vals.values(), dtype=dtype,
+                                      count=len(genes))
+
+        else:
+            for gene, val in expr_vals.items():
+                if gene in gene_indx:
+                    samp_row[gene_indx[gene]] = val
+
+                elif add_genes:
+                    new_vals.setdefault(gene, {})[samp_indx[samp]] = val
+
+    if expr_mat is None:
+        if genes is None:
+            genes = []
+        expr_mat = np.zeros((0, len(genes)), dtype=dtype)
+
+    expr_mat.resize((len(samps), len(genes)), refcheck=False)
+
+    if new_vals:
+        new_genes = list(new_vals)
+        full_mat = np.zeros((len(samps), len(genes) + len(new_genes)),
+                            dtype=dtype)
+        full_mat[:, :len(genes)] = expr_mat
+
+        for i, gene in enumerate(new_genes, start=len(genes)):
+            if new_vals[gene]:
+                row_indx, vals = zip(*new_vals[gene].items())
+                full_mat[list(row_indx), i] = vals
+
+        genes = genes + new_genes
+        expr_mat = full_mat
+
+    return samps, genes, expr_mat
+
+
+class BmegExpression(object):
+    """Retrieves the expression records of BMEG cohorts from a BMEG server.
+
+    Args:
+        bmeg_server (str, optional): Which server to query, default is to
+                                     use the first available BMEG server.
+
+    """
+
+    def __init__(self, bmeg_server=None):
+        self.bmeg_server = bmeg_server
+
+    def cache_label(self, cohort):
+        """Identifies the server whose records are cached for a cohort.
+
+        BMEG servers do not expose which version of their data they are
+        serving, so the records of a server are cached until they are
+        removed from the cache or `use_cache` is turned off. When no server
+        is given the records are cached under a label shared by all of the
+        BMEG mirrors, so that no server has to be probed to find a cohort
+        that has already been cached.
+
+        """
+        if self.bmeg_server is None:
+            return 'bmeg'
+
+        return 'bmeg_' + re.sub('[^A-Za-z0-9.]+', '_',
+                                self.bmeg_server.split('://')[-1]).strip('_')
+
+    def query_expr(self, cohort):
+        """Gets the raw JSON records of each sample's expression."""
+        oph = get_bmeg_client(self.bmeg_server)
+
+        # TODO: filter on gene chromosome when BMEG is updated
+        return oph.query().has("gid", "project:" + cohort)\
+            .outgoing("hasMember").incoming("biosampleOfIndividual")\
+            .mark("sample").incoming("expressionForSample")\
+            .mark("expression").select(["sample", "expression"]).execute()
+
+
+class LocalExpression(object):
+    """Serves the expression records of BMEG cohorts from disk.
+
+    This is a stand-in for :class:`BmegExpression` which returns the same
+    records as the BMEG expression query, but reads them from gzipped files
+    containing one JSON record per line, as written by :meth:`save_expr`.
+    It allows for loading expression data when no BMEG server is reachable,
+    and for benchmarking without any network access.
+
+    Args:
+        data_dir (str, optional): Where the record files are stored, default
+                                  is a directory in the HetMan cache.
+
+    Examples:
+        >>> local_src = LocalExpression()
+        >>> local_src.save_expr('TCGA-BRCA', BmegExpression())
+        >>> expr_data = get_expr_bmeg('TCGA-BRCA', expr_source=local_src)
+
+    """
+
+    def __init__(self, data_dir=None):
+        if data_dir is None:
+            data_dir = os.path.join(CACHE_PATH, 'expr_records')
+        self.data_dir = data_dir
+
+    def expr_file(self, cohort):
+        return os.path.join(self.data_dir, cohort + '.json.gz')
+
+    def cache_label(self, cohort):
+        """Identifies the version of a cohort's records on disk.
+
+        The label changes whenever the records of the cohort are saved again,
+        so that matrices cached from older records are no longer used.
+
+        """
+        if not os.path.isfile(self.expr_file(cohort)):
+            raise IOError("No local expression records found for cohort "
+                          + cohort + " !")
+
+        return 'local_' + get_file_checksum(self.expr_file(cohort))
+
+    def query_expr(self, cohort):
+        """Gets the raw JSON records of each sample's expression."""
+        if not os.path.isfile(self.expr_file(cohort)):
+            raise IOError("No local expression records found for cohort "
+                          + cohort + " !")
+
+        with gzip.open(self.expr_file(cohort), 'rt') as fl:
+            for qr in fl:
+                yield qr.rstrip('\n')
+
+    def save_expr(self, cohort, expr_source):
+        """Copies a cohort's expression records from another source."""
+        os.makedirs(self.data_dir, exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(self.expr_file(cohort), os.getpid())
+
+        with gzip.open(tmp_file, 'wt') as fl:
+            for qr in expr_source.query_expr(cohort):
+                fl.write(qr.replace('\n', ' ') + '\n')
+
+        os.replace(tmp_file, self.expr_file(cohort))
+
+
+def parse_expr_records(query_results):
+    """Parses the records returned by a BMEG expression query.
+
+    Args:
+        query_results (iterable of str): The raw JSON query results.
+
+    Yields:
+        samp (str): The name of the sample.
+        expr_vals (dict): The expression values of each gene in the sample.
+
+    """
+    for qr in query_results:
+        try:
+            dt = json.loads(qr)
+
+        # ensures BMEG is running and could process the query
+        except ValueError:
+            raise IOError("BMEG could not process query, returned error:\n"
+                          + qr)
+
+        if ('expression' in dt and 'properties' in dt['expression']
+                and 'serializedExpressions'
+                in dt['expression']['properties']):
+            yield (dt['sample']['gid'].split(':')[-1],
+                   json.loads(
+                       dt['expression']['properties']['serializedExpressions']
+                       ))
+
+
+def get_expr_bmeg(cohort, expr_source=None, genes=None, use_cache=True):
     """Loads RNA-seq gene-level expression data from BMEG.
 
+    The normalized expression matrix of each cohort is cached as a
+    memory-mapped float32 array along with its sample and gene labels, so
+    that BMEG only needs to be queried the first time a cohort is loaded.
+    Matrices are cached separately for each source of expression records
+    as given by its `cache_label` method, i.e. for each BMEG server and for
+    each version of the records stored by a :class:`LocalExpression`, and
+    for each set of genes regardless of the order in which they are given.
+
     Args:
         cohort (str): The name of an individualCohort vertex in BMEG.
+        expr_source (optional): Where to get expression records from, such
+                                as a :class:`LocalExpression` instance.
+                                Default is to query a BMEG server.
+        genes (list of str, optional): Which genes to get expression for,
+                                       default is to use every gene present
+                                       in any of the samples returned.
+        use_cache (bool, optional): Whether to load the expression matrix
+                                    from and save it to the cache.
 
     Returns:
         expr_data (pandas DataFrame of float), shape = [n_samps, n_feats]
@@ -54,42 +323,63 @@ def get_expr_bmeg(cohort):
     Examples:
         >>> expr_data = get_expr_bmeg('TCGA-BRCA')
         >>> expr_data = get_expr_bmeg('TCGA-PCPG')
+        >>> expr_data = get_expr_bmeg('TCGA-PCPG',
+        >>>                           expr_source=LocalExpression())
 
     """
-    oph = Ophion(choose_bmeg_server(verbose=True))
-    expr_list = {}
+    if expr_source is None:
+        expr_source = BmegExpression()
+
+    # the genes are cached in sorted order, and are put back in the order
+    # they were given in after the matrix is loaded
+    use_genes = genes
+    if genes is not None:
+        genes = list(genes)
+        use_genes = sorted(set(genes))
 
-    # TODO: filter on gene chromosome when BMEG is updated
-    expr_query = ('oph.query().has("gid", "project:" + cohort)'
-                  '.outgoing("hasMember").incoming("biosampleOfIndividual")'
-                  '.mark("sample").incoming("expressionForSample")'
-                  '.mark("expression").select(["sample", "expression"])')
-    samp_count = eval(expr_query).count().execute()[0]
+    if use_cache:
+        cache_lbl = cohort + '__' + expr_source.cache_label(cohort)
+        if genes is not None:
+            cache_lbl += '__' + hashlib.md5(
+                '\t'.join(use_genes).encode()).hexdigest()
 
-    # ensures BMEG is running
-    if not samp_count.isnumeric():
-        raise IOError("BMEG could not process query, returned error:\n"
-                      + samp_count)
+        cache_dir = os.path.join(CACHE_PATH, 'expr_bmeg', cache_lbl)
+        if os.path.isdir(cache_dir):
+            return reorder_genes(read_matrix_store(cache_dir), genes)
+
+    # creates a sample x expression matrix and normalizes it
+    samps, use_genes, expr_mat = assemble_expr_mat(
+        parse_expr_records(expr_source.query_expr(cohort)), use_genes)
 
     # ensures the query returns data
-    if samp_count == '0':
+    if not samps:
         raise ValueError("No samples found in BMEG for cohort "
                          + cohort + " !")
 
-    # parses expression data and loads it into a list
-    for qr in eval(expr_query).execute():
-        dt = json.loads(qr)
-        if ('expression' in dt and 'properties' in dt['expression']
-                and 'serializedExpressions'
-                in dt['expression']['properties']):
-            expr_list[dt['sample']['gid']] = json.loads(
-                dt['expression']['properties']['serializedExpressions'])
+    expr_data = pd.DataFrame(log_norm_expr(expr_mat, inplace=True),
+                             index=samps, columns=use_genes, copy=False)
 
-    # creates a sample x expression matrix and normalizes it
-    expr_mat = pd.DataFrame(expr_list).transpose().fillna(0.0)
-    gene_set = expr_mat.columns
-    expr_mat.index = [x[-1] for x in expr_mat.index.str.split(':')]
-    expr_data = log_norm_expr(expr_mat.loc[:, gene_set])
+    if use_cache:
+        os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+        write_matrix_store(expr_data, cache_dir, dtype=np.float32)
+
+        # the in-memory copy is swapped for the memory-mapped one so that
+        # its pages can be shared with other processes using the same cohort
+        del expr_data, expr_mat
+        expr_data = read_matrix_store(cache_dir)
+
+    return reorder_genes(expr_data, genes)
+
+
+def reorder_genes(expr_data, genes):
+    """Puts the columns of an expression matrix in the given gene order.
+
+    The matrix is returned as-is if it is already in this order, so that
+    memory-mapped matrices are only copied when the columns have to move.
+
+    """
+    if genes is None or list(expr_data.columns) == genes:
+        return expr_data
 
-    return expr_data
+    return expr_data.loc[:, genes]
 
@@ -0,0 +1,352 @@
+"""Normalizing -omic datasets using rank transformations.
+
+This module contains the rank-based normalization shared by the expression
+and drug response loaders, as well as the normalization of new samples
+against reference distributions found using a training cohort. It only
+depends on NumPy, SciPy and pandas, so that it can be used without the
+clients needed to load the datasets themselves.
+
+See Also:
+    :module:`.expression`: Loading and processing expression datasets.
+
+Author: Michal Grzadkowski <grzadkow@ohsu.edu>
+
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+
+def average_ranks(vals):
+    """Ranks the values in each row of a matrix, averaging over ties.
+
+    The values in all of the rows are sorted at once, after which the tied
+    values in each row are found from the boundaries between runs of equal
+    values in the sorted rows. Missing values are left unranked.
+
+    Args:
+        vals (array of float), shape = [n_rows, n_cols]
+
+    Returns:
+        ranks (array of float), shape = [n_rows, n_cols]
+            The rank of each value within its row, starting from one, which
+            is missing wherever the corresponding value is missing.
+
+    Examples:
+        >>> average_ranks(np.array([[3.0, 1.0, 3.0, np.nan]]))
+                [[ 2.5,  1. ,  2.5,  nan]]
+
+    """
+    n_rows, n_cols = vals.shape
+    row_indx = np.arange(n_rows)[:, np.newaxis]
+    col_indx = np.tile(np.arange(n_cols), (n_rows, 1))
+
+    sort_indx = np.argsort(vals, axis=1, kind='mergesort')
+    sort_vals = vals[row_indx, sort_indx]
+
+    # finds where each run of tied values starts and ends in the sorted rows
+    run_start = np.ones(sort_vals.shape, dtype=bool)
+    run_start[:, 1:] = sort_vals[:, 1:] != sort_vals[:, :-1]
+    run_end = np.ones(sort_vals.shape, dtype=bool)
+    run_end[:, :-1] = run_start[:, 1:]
+
+    start_pos = np.maximum.accumulate(np.where(run_start, col_indx, 0),
+                                      axis=1)
+    end_pos = np.minimum.accumulate(
+        np.where(run_end, col_indx, n_cols)[:, ::-1], axis=1)[:, ::-1]
+
+    sort_ranks = (start_pos + end_pos) / 2.0 + 1
+    sort_ranks[np.isnan(sort_vals)] = np.nan
+
+    ranks = np.empty(vals.shape)
+    ranks[row_indx, sort_indx] = sort_ranks
+
+    return ranks
+
+
+def exp_rank_norm(expr, axis=1, chunk_size=None, out=None):
+    """Normalizes expression data using exponential rank transformation.
+
+    The values along the given axis are ranked and then mapped to the
+    quantiles of the exponential distribution corresponding to these ranks,
+    with tied values given the same averaged rank. Missing values are set to
+    zero after normalization, but still count towards the number of values
+    along the axis.
+
+    Args:
+        expr (array or DataFrame of float), shape = [n_samples, n_features]
+        axis (int, optional): Whether to rank the values in each column (0)
+                              or in each row (1), default is to use rows.
+        chunk_size (int, optional): How many rows (or columns) to normalize
+                                    at a time. Default is to normalize the
+                                    entire matrix at once; use this to
+                                    normalize memory-mapped matrices that
+                                    are larger than the available memory.
+        out (array of float, optional): Where to put the normalized values,
+                                        such as a memory-mapped array of the
+                                        same shape as `expr`.
+
+    Returns:
+        norm_expr (array or DataFrame of float)
+
+    Examples:
+        >>> exp_rank_norm(np.array([[1.0, 5.0, 3.0], [2.0, 2.0, np.nan]]))
+                [[ 0.        ,  1.09861229,  0.40546511],
+                 [ 0.18232156,  0.18232156,  0.        ]]
+        >>> norm_expr = exp_rank_norm(expr_df, axis=0, chunk_size=1000)
+
+    """
+    expr_vals = np.asarray(expr)
+    if out is None:
+        out = np.empty(expr_vals.shape)
+
+    # normalizing along columns is done by normalizing along the rows
+    # of the transposed matrices, which are only views of the originals
+    if axis == 0:
+        in_mat, out_mat = expr_vals.T, out.T
+    elif axis == 1:
+        in_mat, out_mat = expr_vals, out
+    else:
+        raise ValueError("Normalization axis must be either 0 or 1!")
+
+    if chunk_size is None:
+        chunk_size = max(in_mat.shape[0], 1)
+
+    for i in range(0, in_mat.shape[0], chunk_size):
+        ranks = average_ranks(
+            np.asarray(in_mat[i:(i + chunk_size)], dtype=float))
+
+        norm_vals = stats.expon.ppf((ranks - 1) / in_mat.shape[1])
+        norm_vals[np.isnan(norm_vals)] = 0.0
+        out_mat[i:(i + chunk_size)] = norm_vals
+
+    if isinstance(expr, pd.DataFrame):
+        out = pd.DataFrame(out, index=expr.index, columns=expr.columns,
+                           copy=False)
+
+    return out
+
+
+class QuantileReference(object):
+    """Normalizes expression data against a reference distribution per gene.
+
+    The reference distribution of each gene consists of its sorted training
+    values, which can be limited to a random sample of a fixed size that is
+    maintained using reservoir sampling as batches of training samples are
+    added. New samples are then normalized by finding the quantile of each
+    of their values within the reference of its gene using binary search,
+    so that they can be scored without re-ranking the training cohort.
+
+    Quantiles are found using averaged ranks as in
+    :func:`exp_rank_norm`, so that normalizing the training
+    samples themselves against a reference of all of their values gives the
+    same result as ranking each gene's values across these samples, apart
+    from how missing values are handled.
+
+    Args:
+        n_quantiles (int, optional): The maximum number of values to keep in
+                                     each gene's reference, default is to
+                                     keep all of them.
+        out_distr (str, optional): The name of a distribution in scipy.stats
+                                   whose quantile function is applied to the
+                                   normalized values, e.g. 'expon' or 'norm'.
+                                   Default is to return the quantiles as-is.
+        random_state (int, optional): Seed used for the reservoir sampling.
+
+    Examples:
+        >>> qref = QuantileReference(n_quantiles=500, out_distr='expon')
+        >>> qref.fit(train_expr)
+        >>> qref.save('ref.npz')
+        >>> patient_expr = read_quantile_reference('ref.npz').transform(
+        >>>     patient_expr)
+
+    """
+
+    def __init__(self, n_quantiles=None, out_distr=None, random_state=None):
+        self.n_quantiles = n_quantiles
+        self.out_distr = out_distr
+        self.random_state = np.random.RandomState(random_state)
+
+        self.genes = None
+        self.ref_vals = None
+        self.seen_counts = None
+
+    def fit(self, X):
+        """Builds the reference distributions from a set of samples.
+
+        Args:
+            X (array or DataFrame of float), shape = [n_samples, n_genes]
+
+        """
+        self.genes = None
+        self.ref_vals = None
+        self.seen_counts = None
+
+        return self.partial_fit(X)
+
+    def partial_fit(self, X):
+        """Adds a batch of samples to the reference distributions.
+
+        Args:
+            X (array or DataFrame of float), shape = [n_samples, n_genes]
+
+        """
+        expr_vals = self.align_genes(X, fitting=True)
+
+        for i in range(expr_vals.shape[1]):
+            new_vals = expr_vals[:, i][~np.isnan(expr_vals[:, i])]
+            old_count = self.seen_counts[i]
+            self.seen_counts[i] += len(new_vals)
+
+            if (self.n_quantiles is None
+                    or self.seen_counts[i] <= self.n_quantiles):
+                self.ref_vals[i] = np.sort(
+                    np.concatenate([self.ref_vals[i], new_vals]))
+
+            # when the reservoir is full, each new value replaces a random
+            # member of the reservoir with probability equal to the size of
+            # the reservoir over the number of values seen so far
+            else:
+                fill_count = max(self.n_quantiles - len(self.ref_vals[i]), 0)
+                res_vals = np.concatenate([self.ref_vals[i],
+                                           new_vals[:fill_count]])
+
+                val_indx = np.arange(old_count + fill_count,
+                                     self.seen_counts[i]) + 1
+                res_indx = np.floor(
+                    self.random_state.random_sample(len(val_indx))
+                    * val_indx
+                    ).astype(int)
+
+                use_indx = res_indx < self.n_quantiles
+                res_vals[res_indx[use_indx]] = new_vals[fill_count:][use_indx]
+                self.ref_vals[i] = np.sort(res_vals)
+
+        return self
+
+    def align_genes(self, X, fitting=False):
+        """Gets the values of a matrix for the genes of the reference."""
+        expr_vals = np.asarray(X, dtype=float)
+
+        if self.genes is None and fitting:
+            if isinstance(X, pd.DataFrame):
+                self.genes = np.array(X.columns)
+            else:
+                self.genes = np.arange(expr_vals.shape[1])
+
+            self.ref_vals = [np.array([]) for _ in self.genes]
+            self.seen_counts = np.zeros(len(self.genes), dtype=int)
+
+        elif self.genes is None:
+            raise ValueError("QuantileReference instance has not been "
+                             "fit yet!")
+
+        # genes in the reference that are not in the given data are
+        # treated as missing
+        if isinstance(X, pd.DataFrame):
+            gene_indx = X.columns.get_indexer(self.genes)
+            expr_vals = np.hstack([expr_vals,
+                                   np.full((expr_vals.shape[0], 1), np.nan)])
+            expr_vals = expr_vals[:, gene_indx]
+
+        elif expr_vals.shape[1] != len(self.genes):
+            raise ValueError("Expected a matrix with {} genes, got {} "
+                             "instead!".format(len(self.genes),
+                                               expr_vals.shape[1]))
+
+        return expr_vals
+
+    def quantiles(self, X):
+        """Finds the quantiles of values within the reference distributions.
+
+        Args:
+            X (array or DataFrame of float), shape = [n_samples, n_features]
+
+        Returns:
+            quants (array of float), shape = [n_samples, n_genes]
+                The quantile of each value within its gene's reference,
+                which is missing if the value or the reference is missing.
+
+        """
+        expr_vals = self.align_genes(X)
+        quants = np.full(expr_vals.shape, np.nan)
+
+        for i, ref_vals in enumerate(self.ref_vals):
+            if len(ref_vals):
+                low_ranks = np.searchsorted(ref_vals, expr_vals[:, i],
+                                            side='left')
+                high_ranks = np.searchsorted(ref_vals, expr_vals[:, i],
+                                             side='right')
+
+                quants[:, i] = np.maximum(
+                    (low_ranks + high_ranks - 1) / 2.0, 0) / len(ref_vals)
+
+        quants[np.isnan(expr_vals)] = np.nan
+
+        return quants
+
+    def transform(self, X):
+        """Normalizes samples using the reference distributions.
+
+        Args:
+            X (array or DataFrame of float), shape = [n_samples, n_features]
+
+        Returns:
+            norm_expr (array or DataFrame of float)
+                shape = [n_samples, n_genes]
+
+        """
+        norm_expr = self.quantiles(X)
+        if self.out_distr is not None:
+            norm_expr = getattr(stats, self.out_distr).ppf(norm_expr)
+
+        if isinstance(X, pd.DataFrame):
+            norm_expr = pd.DataFrame(norm_expr, index=X.index,
+                                     columns=self.genes, copy=False)
+
+        return norm_expr
+
+    def save(self, ref_file):
+        """Saves the reference distributions to a NumPy .npz file."""
+        if self.genes is None:
+            raise ValueError("QuantileReference instance has not been "
+                             "fit yet!")
+
+        genes = self.genes
+        if genes.dtype == object:
+            genes = genes.astype(str)
+
+        np.savez(ref_file,
+                 genes=genes, seen_counts=self.seen_counts,
+                 ref_vals=np.concatenate(self.ref_vals + [np.array([])]),
+                 ref_sizes=np.array([len(vals) for vals in self.ref_vals]),
+                 n_quantiles=-1 if self.n_quantiles is None
+                 else self.n_quantiles,
+                 out_distr='' if self.out_distr is None else self.out_distr)
+
+
+def read_quantile_reference(ref_file):
+    """Loads a reference saved using :meth:`QuantileReference.save`.
+
+    Args:
+        ref_file (str): Where the reference distributions were saved.
+
+    Returns:
+        qref (QuantileReference)
+
+    """
+    ref_data = np.load(ref_file, allow_pickle=False)
+
+    qref = QuantileReference(
+        n_quantiles=(None if ref_data['n_quantiles'] < 0
+                     else int(ref_data['n_quantiles'])),
+        out_distr=str(ref_data['out_distr']) or None
+        )
+
+    qref.genes = ref_data['genes']
+    qref.seen_counts = ref_data['seen_counts']
+    qref.ref_vals = np.split(ref_data['ref_vals'],
+                             np.cumsum(ref_data['ref_sizes'])[:-1])
+
+    return qref
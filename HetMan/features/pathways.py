@@ -1,4 +1,3 @@
-
 """Loading and processing pathway datasets.
 
 This module contains functions for retrieving gene pathway information
@@ -8,12 +7,363 @@ Author: Michal Grzadkowski <grzadkow@ohsu.edu>
 
 """
 
+import numpy as np
 import pandas as pd
-from itertools import groupby
+import scipy.sparse as sp
+
+from . import DATA_PATH, CACHE_PATH
+from .utils import get_file_checksum
+
+import os
+import json
+import shutil
 
-from . import DATA_PATH
 path_file = DATA_PATH + '/PathwayCommons9.All.hgnc.sif.gz'
 
+# which version of the pathway graph format is stored in the cache, to be
+# incremented whenever the way the graph is built from the SIF changes
+path_graph_version = 1
+
+# pathway graphs already loaded by this process
+path_graph_cache = {}
+
+
+class PathwayGraph(object):
+    """A directed graph of the pairwise gene interactions in a pathway dataset.
+
+    The interactions of each type are stored as a sparse adjacency matrix
+    in compressed row format for each direction, so that the neighbourhoods
+    of many genes can be found at once using sparse matrix products. The
+    neighbourhoods found are memoized, which allows for the same graph to be
+    shared by feature selection steps that query the same genes repeatedly.
+
+    Indexing the graph with a gene returns its neighbourhood in the nested
+    dictionary format produced by :func:`parse_sif`.
+
+    Args:
+        genes (array-like of str): The genes in the graph.
+        int_types (array-like of str): The types of interactions.
+        adj_mats (dict): A sparse matrix of shape [n_genes, n_genes] for each
+                         direction ('Up' or 'Down') and interaction type,
+                         where row i contains the genes that are upstream or
+                         downstream of gene i respectively.
+
+    Examples:
+        >>> path_graph = get_pathway_graph()
+        >>> path_graph['TP53']['Up']['controls-expression-of']
+        >>> path_graph.neighbours(['TP53', 'PTEN'], direction='Down', hops=2)
+
+    """
+
+    directions = ('Up', 'Down')
+
+    def __init__(self, genes, int_types, adj_mats):
+        self.genes = np.asarray(genes)
+        self.int_types = tuple(int_types)
+        self.adj_mats = adj_mats
+
+        self.gene_index = {gn: i for i, gn in enumerate(self.genes)}
+        self._adj_memo = {}
+        self._neighb_memo = {}
+        self._dict_memo = {}
+
+    def __contains__(self, gene):
+        return gene in self.gene_index
+
+    def __getitem__(self, gene):
+        if gene not in self._dict_memo:
+            neighb = {'Up': {}, 'Down': {}}
+
+            if gene in self.gene_index:
+                i = self.gene_index[gene]
+
+                for (pdir, tp), adj_mat in self.adj_mats.items():
+                    row_genes = adj_mat.indices[
+                        adj_mat.indptr[i]:adj_mat.indptr[i + 1]]
+
+                    if len(row_genes):
+                        neighb[pdir][tp] = set(self.genes[row_genes])
+
+            self._dict_memo[gene] = neighb
+
+        return self._dict_memo[gene]
+
+    def get_adjacency(self, direction, int_types=()):
+        """Gets the combined adjacency matrix of a set of interaction types.
+
+        Args:
+            direction (str): Either 'Up' or 'Down'.
+            int_types (iterable of str, optional): Which interaction types to
+                                                   consider, the default is
+                                                   to use all of them.
+
+        Returns:
+            adj_mat (scipy.sparse.csr_matrix), shape = [n_genes, n_genes]
+
+        """
+        if direction not in self.directions:
+            raise ValueError("Unknown pathway direction " + str(direction)
+                             + " specified!")
+
+        int_types = tuple(sorted(set(int_types) & set(self.int_types)
+                                 if int_types else self.int_types))
+
+        if (direction, int_types) not in self._adj_memo:
+            adj_mat = sp.csr_matrix((len(self.genes), len(self.genes)),
+                                    dtype=np.int32)
+
+            for tp in int_types:
+                adj_mat = adj_mat + self.adj_mats[direction, tp]
+
+            adj_mat.data[:] = 1
+            self._adj_memo[direction, int_types] = adj_mat
+
+        return self._adj_memo[direction, int_types]
+
+    def neighbours(self, genes, direction='Down', int_types=(), hops=1):
+        """Finds the genes within a number of interactions of given genes.
+
+        Args:
+            genes (iterable of str): The genes to get neighbourhoods for.
+            direction (str, optional): Whether to follow interactions
+                                       upstream ('Up') or downstream
+                                       ('Down') of the genes.
+            int_types (iterable of str, optional): Which interaction types to
+                                                   follow, the default is to
+                                                   use all of them.
+            hops (int, optional): The maximum number of interactions to
+                                  follow away from each gene.
+
+        Returns:
+            neighb (dict): The set of genes in the neighbourhood of each of
+                           the given genes.
+
+        Examples:
+            >>> path_graph.neighbours(['TP53'], direction='Up', hops=3)
+            >>> path_graph.neighbours(
+            >>>     ['PIK3CA', 'RB1'], int_types=['interacts-with'])
+
+        """
+        adj_mat = self.get_adjacency(direction, int_types)
+        int_types = tuple(sorted(int_types))
+        memo_key = direction, int_types, hops
+
+        # finds the genes whose neighbourhoods haven't been found yet
+        new_genes = sorted(set(gn for gn in genes
+                               if (gn,) + memo_key not in self._neighb_memo))
+        gene_indx = [self.gene_index[gn] for gn in new_genes
+                     if gn in self.gene_index]
+
+        if gene_indx:
+            cur_mat = sp.csr_matrix(
+                (np.ones(len(gene_indx), dtype=np.int32),
+                 (np.arange(len(gene_indx)), gene_indx)),
+                shape=(len(gene_indx), len(self.genes))
+                )
+            reach_mat = sp.csr_matrix(cur_mat.shape, dtype=np.int32)
+
+            # follows the interactions of all of the genes at once, one
+            # step at a time, keeping track of the genes reached so far
+            for _ in range(hops):
+                cur_mat = cur_mat * adj_mat
+                cur_mat.data[:] = 1
+                reach_mat = reach_mat + cur_mat
+
+            reach_mat.sum_duplicates()
+            reach_mat.eliminate_zeros()
+
+        known_genes = [gn for gn in new_genes if gn in self.gene_index]
+        for i, gn in enumerate(known_genes):
+            self._neighb_memo[(gn,) + memo_key] = frozenset(
+                self.genes[reach_mat.indices[
+                    reach_mat.indptr[i]:reach_mat.indptr[i + 1]]]
+                )
+
+        for gn in set(new_genes) - set(known_genes):
+            self._neighb_memo[(gn,) + memo_key] = frozenset()
+
+        return {gn: self._neighb_memo[(gn,) + memo_key] for gn in genes}
+
+    def select_genes(self, genes, directions=(), int_types=(), hops=1):
+        """Gets all the genes in the neighbourhoods of a set of genes.
+
+        Args:
+            genes (iterable of str): The genes to get neighbourhoods for.
+            directions (iterable of str, optional): Which directions to
+                                                    follow, the default is to
+                                                    use both of them.
+            int_types (iterable of str, optional): Which interaction types to
+                                                   follow, the default is to
+                                                   use all of them.
+            hops (int, optional): The maximum number of interactions to
+                                  follow away from each gene.
+
+        Returns:
+            select_genes (set)
+
+        """
+        select_genes = set()
+
+        for pdir in (directions or self.directions):
+            for neighb in self.neighbours(genes, pdir,
+                                          int_types, hops).values():
+                select_genes |= neighb
+
+        return select_genes
+
+
+def build_pathway_graph(sif_file):
+    """Builds a pathway graph from the interactions listed in a SIF dataset.
+
+    Args:
+        sif_file (str): The location of the SIF file.
+
+    Returns:
+        path_graph (PathwayGraph)
+
+    """
+    sif_data = pd.read_csv(sif_file,
+                           names=['UpGene', 'Type', 'DownGene'],
+                           sep='\t', header=None)
+
+    # assigns an index to each gene and interaction type
+    gene_codes, genes = pd.factorize(
+        np.concatenate([sif_data['UpGene'].values,
+                        sif_data['DownGene'].values]),
+        sort=True
+        )
+    up_codes = gene_codes[:sif_data.shape[0]]
+    down_codes = gene_codes[sif_data.shape[0]:]
+    type_codes, int_types = pd.factorize(sif_data['Type'].values, sort=True)
+
+    adj_mats = {}
+    for i, tp in enumerate(int_types):
+        type_indx = type_codes == i
+
+        down_mat = sp.csr_matrix(
+            (np.ones(np.sum(type_indx), dtype=np.int32),
+             (up_codes[type_indx], down_codes[type_indx])),
+            shape=(len(genes), len(genes))
+            )
+        down_mat.sum_duplicates()
+        down_mat.data[:] = 1
+
+        adj_mats['Down', tp] = down_mat
+        adj_mats['Up', tp] = down_mat.T.tocsr()
+
+    return PathwayGraph(genes, int_types, adj_mats)
+
+
+def write_pathway_graph(path_graph, store_dir):
+    """Saves a pathway graph as a directory of NumPy arrays.
+
+    Only the row pointers and column indices of each adjacency matrix are
+    saved, since all of the entries of the matrices are ones. As with the
+    other stores in the cache, the graph is first written to a temporary
+    directory which is then renamed.
+
+    Args:
+        path_graph (PathwayGraph): The graph to save.
+        store_dir (str): Where the graph arrays are to be saved.
+
+    """
+    tmp_dir = '{}.{}.tmp'.format(store_dir.rstrip('/'), os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    np.save(os.path.join(tmp_dir, 'genes.npy'),
+            path_graph.genes.astype(str))
+    for i, tp in enumerate(path_graph.int_types):
+        for pdir in path_graph.directions:
+            adj_mat = path_graph.adj_mats[pdir, tp]
+
+            np.save(os.path.join(tmp_dir, '{}_{}__indptr.npy'.format(pdir, i)),
+                    adj_mat.indptr)
+            np.save(os.path.join(tmp_dir,
+                                 '{}_{}__indices.npy'.format(pdir, i)),
+                    adj_mat.indices)
+
+    with open(os.path.join(tmp_dir, 'types.json'), 'w') as fl:
+        json.dump(list(path_graph.int_types), fl)
+
+    # another task may have finished writing the same graph in the meantime
+    try:
+        os.rename(tmp_dir, store_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir)
+
+
+def read_pathway_graph(store_dir):
+    """Loads a pathway graph saved using :func:`write_pathway_graph`.
+
+    Raises:
+        IOError: If no complete pathway graph exists at the given location.
+
+    """
+    types_file = os.path.join(store_dir, 'types.json')
+    if not os.path.isfile(types_file):
+        raise IOError("No pathway graph found at " + store_dir + " !")
+
+    with open(types_file, 'r') as fl:
+        int_types = json.load(fl)
+    genes = np.load(os.path.join(store_dir, 'genes.npy'))
+
+    adj_mats = {}
+    for i, tp in enumerate(int_types):
+        for pdir in PathwayGraph.directions:
+            indptr = np.load(os.path.join(
+                store_dir, '{}_{}__indptr.npy'.format(pdir, i)))
+            indices = np.load(os.path.join(
+                store_dir, '{}_{}__indices.npy'.format(pdir, i)))
+
+            adj_mats[pdir, tp] = sp.csr_matrix(
+                (np.ones(len(indices), dtype=np.int32), indices, indptr),
+                shape=(len(genes), len(genes))
+                )
+
+    return PathwayGraph(genes, int_types, adj_mats)
+
+
+def get_pathway_graph(use_cache=True):
+    """Gets the graph of gene interactions in Pathway Commons.
+
+    The graph is built from the SIF file once and saved to the cache, from
+    where it is loaded on subsequent calls; it is only loaded once per
+    process so that all the cohorts and pipelines in a process share the
+    same graph and its memoized neighbourhoods.
+
+    Args:
+        use_cache (bool, optional): Whether to load the graph from and save
+                                    it to the cache.
+
+    Returns:
+        path_graph (PathwayGraph)
+
+    Examples:
+        >>> path_graph = get_pathway_graph()
+        >>> path_graph.select_genes(['TP53'], directions=['Up'])
+
+    """
+    if path_file not in path_graph_cache:
+        if use_cache:
+            cache_dir = os.path.join(
+                CACHE_PATH, 'pathways', '{}_v{}_{}'.format(
+                    os.path.basename(path_file).split('.')[0],
+                    path_graph_version, get_file_checksum(path_file)
+                    )
+                )
+
+            if not os.path.isdir(cache_dir):
+                os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+                write_pathway_graph(build_pathway_graph(path_file), cache_dir)
+            path_graph = read_pathway_graph(cache_dir)
+
+        else:
+            path_graph = build_pathway_graph(path_file)
+
+        path_graph_cache[path_file] = path_graph
+
+    return path_graph_cache[path_file]
+
 
 def parse_sif(mut_genes):
     """Parses a SIF dataset to get the pathway neighbours of a set of genes.
@@ -35,23 +385,7 @@ def parse_sif(mut_genes):
         >>> parse_sif(['PIK3CA', 'RB1', 'ACT1'])
 
     """
-    neighb = {gene: {'Up': {}, 'Down': {}} for gene in mut_genes}
-
-    # loads pathway interaction data
-    sif_data = pd.read_csv(path_file,
-                           names=['UpGene', 'Type', 'DownGene'],
-                           sep='\t', header=None)
-
-    # sorts upstream interactions according to downstream mutated gene
-    # and interaction type
-    up_data = sif_data.loc[sif_data['DownGene'].isin(mut_genes), :]
-    for (gn, tp), dt in up_data.groupby(['DownGene', 'Type']):
-        neighb[gn]['Up'][tp] = set(dt['UpGene'])
+    path_graph = get_pathway_graph()
 
-    # sorts downstream interactions according to upstream mutated gene
-    # and interaction type
-    down_data = sif_data.loc[sif_data['UpGene'].isin(mut_genes), :]
-    for (gn, tp), dt in down_data.groupby(['UpGene', 'Type']):
-        neighb[gn]['Down'][tp] = set(dt['DownGene'])
+    return {gene: path_graph[gene] for gene in mut_genes}
 
-    return neighb
@@ -5,40 +5,438 @@ Author: Michal Grzadkowski <grzadkow@ohsu.edu>
 
 """
 
+from . import CACHE_PATH
+
+import numpy as np
+import pandas as pd
+
+import os
+import re
+import json
+import time
+import queue
+import shutil
+import hashlib
+import threading
 from ophion import Ophion
 
 
-def choose_bmeg_server(verbose=False):
-    """Chooses a BMEG server to use based on availability."""
+# list of BMEG servers to try, and how many seconds the choice of server
+# made by choose_bmeg_server is re-used for
+bmeg_server_list = ['http://bmeg.compbio.ohsu.edu', 'http://bmeg.io']
+bmeg_server_ttl = 3600
 
-    # list of BMEG servers to try
-    server_list = ['http://bmeg.compbio.ohsu.edu', 'http://bmeg.io']
-    
-    # iterate over these servers until we find one or there aren't any left
-    server_found = False
-    while not server_found and server_list:
+# the server currently chosen for this process, the Ophion clients used by
+# each thread for each server, and the clients created while probing the
+# servers that have yet to be claimed by a thread
+bmeg_server_cache = {'server': None, 'time': 0}
+bmeg_server_lock = threading.Lock()
+bmeg_client_pool = threading.local()
+bmeg_idle_clients = {}
 
-        # get a new server and intialize the query interface
-        bmeg_server = server_list.pop()
-        oph = Ophion(bmeg_server)
+# matches the first four fields of a TCGA barcode, which identify a sample
+barcode_pattern = re.compile('^(TCGA(?:-[^-]+){3})-')
 
-        # ...check if we can run a simple query...
-        try:
-            proj_count = oph.query().has(
-                "gid", "project:TCGA-BRCA").count().execute()[0]
+# parsed barcodes are remembered across calls, since the same few thousand
+# samples are parsed over and over again in datasets with millions of records
+barcode_cache = {}
+
+
+def probe_bmeg_server(bmeg_server, probe_results):
+    """Checks if a BMEG server can process a simple query.
+
+    The client used for the query is passed along with the result, so that
+    it can be re-used by the thread that chose the server.
+
+    """
+    oph = Ophion(bmeg_server)
+
+    try:
+        proj_count = oph.query().has(
+            "gid", "project:TCGA-BRCA").count().execute()[0]
+        server_ok = int(proj_count) > 0
+
+    # any error raised by the query, such as a refused connection or an
+    # unexpected response, means the server isn't usable
+    except Exception:
+        server_ok = False
+
+    probe_results.put((bmeg_server, server_ok, oph))
+
+
+def choose_bmeg_server(verbose=False, probe_timeout=30, refresh=False):
+    """Chooses a BMEG server to use based on availability.
 
-            # ...if so, check if the query returns a proper value
-            if int(proj_count) > 0:
-                server_found = True
+    All candidate servers are probed at the same time, and the first one to
+    successfully answer a simple query is chosen. The chosen server is then
+    re-used by all subsequent calls in the same process until
+    `bmeg_server_ttl` seconds have passed, and the client that probed it is
+    handed to the first thread asking :func:`get_bmeg_client` for a client.
+    No lock is held while the servers are probed, so threads which find
+    that no server has been chosen yet may each probe the servers.
 
-                if verbose:
-                    print("Choosing BMEG server {}".format(bmeg_server))
+    Args:
+        verbose (bool, optional): Whether to print the server chosen.
+        probe_timeout (float, optional): How many seconds to wait for
+                                         servers to answer.
+        refresh (bool, optional): Whether to ignore the server chosen by
+                                  earlier calls and probe the servers again.
 
-        except:
-            pass
+    Returns:
+        bmeg_server (str): The URL of the chosen server.
 
-    if not server_found:
+    """
+    with bmeg_server_lock:
+        if (not refresh and bmeg_server_cache['server'] is not None
+                and (time.time() - bmeg_server_cache['time']
+                     < bmeg_server_ttl)):
+            return bmeg_server_cache['server']
+
+    # probes each of the servers in its own background thread, so that
+    # an unresponsive server can't prevent the process from exiting
+    probe_results = queue.Queue()
+    for server in bmeg_server_list:
+        threading.Thread(target=probe_bmeg_server,
+                         args=(server, probe_results), daemon=True).start()
+
+    # waits for the first server to answer successfully, giving up when
+    # all servers have failed or the timeout has been reached
+    bmeg_server = None
+    probe_end = time.time() + probe_timeout
+    for _ in bmeg_server_list:
+        try:
+            server, server_ok, oph = probe_results.get(
+                timeout=max(probe_end - time.time(), 0))
+        except queue.Empty:
+            break
+
+        if server_ok:
+            bmeg_server = server
+            break
+
+    if bmeg_server is None:
         raise RuntimeError("No BMEG server available!")
 
+    if verbose:
+        print("Choosing BMEG server {}".format(bmeg_server))
+
+    with bmeg_server_lock:
+        bmeg_server_cache['server'] = bmeg_server
+        bmeg_server_cache['time'] = time.time()
+        bmeg_idle_clients.setdefault(bmeg_server, []).append(oph)
+
     return bmeg_server
 
+
+def get_bmeg_client(bmeg_server=None):
+    """Gets an Ophion client for querying a BMEG server.
+
+    Clients are pooled so that each thread re-uses the same client, along
+    with whatever connections it holds open, for all of its queries to a
+    given server across all of the loaders. A thread without a client for
+    the server first claims one left over from probing the servers before
+    creating a new one.
+
+    Args:
+        bmeg_server (str, optional): The URL of the server, default is to
+                                     use :func:`choose_bmeg_server`.
+
+    Returns:
+        oph (Ophion)
+
+    """
+    if bmeg_server is None:
+        bmeg_server = choose_bmeg_server()
+
+    if not hasattr(bmeg_client_pool, 'clients'):
+        bmeg_client_pool.clients = {}
+
+    if bmeg_server not in bmeg_client_pool.clients:
+        with bmeg_server_lock:
+            idle_clients = bmeg_idle_clients.get(bmeg_server)
+            oph = idle_clients.pop() if idle_clients else None
+
+        if oph is None:
+            oph = Ophion(bmeg_server)
+        bmeg_client_pool.clients[bmeg_server] = oph
+
+    return bmeg_client_pool.clients[bmeg_server]
+
+
+def parse_tcga_barcodes(barcodes):
+    """Shortens TCGA barcodes to the four fields identifying a sample.
+
+    Each unique barcode is only parsed once, both within a call and across
+    calls, and the parsed values are then broadcast back to all the records
+    they came from. Barcodes that are not TCGA barcodes with more than four
+    fields are returned as-is.
+
+    Args:
+        barcodes (array-like of str)
+
+    Returns:
+        samps (numpy array of str), shape = [len(barcodes), ]
+
+    Examples:
+        >>> parse_tcga_barcodes(['TCGA-02-0003-01A-01D-1490-08', 'Cytoband'])
+            ['TCGA-02-0003-01A', 'Cytoband']
+
+    """
+    barcode_indx, uniq_barcodes = pd.factorize(np.asarray(barcodes))
+
+    # parses the barcodes that haven't been seen before
+    new_barcodes = pd.Series(
+        [bcode for bcode in uniq_barcodes if bcode not in barcode_cache],
+        dtype=object
+        )
+
+    if len(new_barcodes):
+        new_samps = new_barcodes.str.extract(barcode_pattern, expand=False)
+        barcode_cache.update(zip(new_barcodes,
+                                 new_samps.fillna(new_barcodes)))
+
+    # missing barcodes are given an index of -1 by factorize, and are kept
+    # missing rather than being mapped to the last of the unique barcodes
+    samps = np.array([barcode_cache[bcode] for bcode in uniq_barcodes]
+                     + [np.nan], dtype=object)
+    barcode_indx[barcode_indx < 0] = len(uniq_barcodes)
+
+    return samps[barcode_indx]
+
+
+def get_file_checksum(file_path):
+    """Gets the MD5 checksum of a file.
+
+    Checksums of large files are expensive to compute, so the checksum is
+    stored in the cache directory along with the size and modification time
+    of the file, and is only re-computed when either of these change.
+
+    Args:
+        file_path (str): The location of the file.
+
+    Returns:
+        checksum (str): The hexadecimal MD5 digest of the file's contents.
+
+    """
+    file_path = os.path.abspath(file_path)
+    file_stat = os.stat(file_path)
+
+    memo_file = os.path.join(
+        CACHE_PATH, 'checksums',
+        hashlib.md5(file_path.encode()).hexdigest() + '.json'
+        )
+
+    # re-uses the checksum computed earlier if the file hasn't changed
+    if os.path.isfile(memo_file):
+        with open(memo_file, 'r') as fl:
+            memo = json.load(fl)
+
+        if (memo['size'] == file_stat.st_size
+                and memo['mtime'] == file_stat.st_mtime):
+            return memo['checksum']
+
+    file_md5 = hashlib.md5()
+    with open(file_path, 'rb') as fl:
+        for chunk in iter(lambda: fl.read(2 ** 24), b''):
+            file_md5.update(chunk)
+    checksum = file_md5.hexdigest()
+
+    # saves the checksum to a temporary file first so that other processes
+    # never read a partially written record
+    os.makedirs(os.path.dirname(memo_file), exist_ok=True)
+    tmp_file = '{}.{}.tmp'.format(memo_file, os.getpid())
+    with open(tmp_file, 'w') as fl:
+        json.dump({'size': file_stat.st_size, 'mtime': file_stat.st_mtime,
+                   'checksum': checksum}, fl)
+    os.replace(tmp_file, memo_file)
+
+    return checksum
+
+
+def write_column_store(data, store_dir):
+    """Saves a table as a directory of NumPy arrays, one for each column.
+
+    Categorical columns are saved as an array of integer codes along with an
+    array of category labels, columns of strings are saved as fixed-width
+    unicode arrays, and all other columns are saved as-is. The table
+    is first written to a temporary directory which is then renamed, so that
+    concurrent tasks writing the same store never see a partial copy.
+
+    Args:
+        data (pandas DataFrame): The table to save. Its index is discarded.
+        store_dir (str): Where the column arrays are to be saved.
+
+    """
+    tmp_dir = '{}.{}.tmp'.format(store_dir.rstrip('/'), os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    store_info = {'columns': [], 'categorical': []}
+
+    for col in data.columns:
+        store_info['columns'] += [col]
+
+        if data[col].dtype.name == 'category':
+            store_info['categorical'] += [col]
+            cats = np.asarray(data[col].cat.categories)
+            if cats.dtype == object:
+                cats = cats.astype(str)
+
+            np.save(os.path.join(tmp_dir, col + '__codes.npy'),
+                    np.asarray(data[col].cat.codes))
+            np.save(os.path.join(tmp_dir, col + '__cats.npy'), cats)
+
+        else:
+            col_vals = np.asarray(data[col])
+            if col_vals.dtype == object:
+                col_vals = col_vals.astype(str)
+
+            np.save(os.path.join(tmp_dir, col + '.npy'), col_vals)
+
+    with open(os.path.join(tmp_dir, 'columns.json'), 'w') as fl:
+        json.dump(store_info, fl)
+
+    # another task may have finished writing the same store in the meantime
+    try:
+        os.rename(tmp_dir, store_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir)
+
+
+def read_column_store(store_dir, filters=None):
+    """Loads a table saved using :func:`write_column_store`.
+
+    Args:
+        store_dir (str): Where the column arrays were saved.
+        filters (dict, optional): Lists of values keyed by column name; only
+                                  rows whose values in each of these columns
+                                  are in the corresponding list are loaded.
+                                  Default is to load all rows.
+
+    Returns:
+        data (pandas DataFrame): The table, with categorical columns
+                                 restored as pandas Categoricals.
+
+    Raises:
+        IOError: If no complete column store exists at the given location.
+
+    Examples:
+        >>> muts = read_column_store(cache_dir, {'Gene': ['TP53', 'KRAS']})
+
+    """
+    info_file = os.path.join(store_dir, 'columns.json')
+    if not os.path.isfile(info_file):
+        raise IOError("No column store found at " + store_dir + " !")
+
+    with open(info_file, 'r') as fl:
+        store_info = json.load(fl)
+
+    # the arrays are memory-mapped so that only the pages that are actually
+    # used are read from disk
+    col_arrs = {}
+    for col in store_info['columns']:
+        if col in store_info['categorical']:
+            col_arrs[col] = (
+                np.load(os.path.join(store_dir, col + '__codes.npy'),
+                        mmap_mode='r'),
+                np.load(os.path.join(store_dir, col + '__cats.npy'))
+                )
+
+        else:
+            col_arrs[col] = np.load(os.path.join(store_dir, col + '.npy'),
+                                    mmap_mode='r')
+
+    # finds which rows to keep without loading anything other than the
+    # filtered columns, comparing category codes instead of values
+    # wherever possible
+    row_indx = None
+    if filters:
+        row_mask = None
+
+        for col, vals in filters.items():
+            if col in store_info['categorical']:
+                codes, cats = col_arrs[col]
+
+                # uses a lookup table over the codes, with an extra False
+                # entry at the end for the -1 code given to missing values
+                code_mask = np.append(np.in1d(cats, list(vals)), False)
+                col_mask = code_mask[codes]
+
+            else:
+                col_mask = np.in1d(col_arrs[col], list(vals))
+
+            if row_mask is None:
+                row_mask = col_mask
+            else:
+                row_mask &= col_mask
+
+        row_indx = np.where(row_mask)[0]
+
+    data = {}
+    for col in store_info['columns']:
+        if col in store_info['categorical']:
+            codes, cats = col_arrs[col]
+            if row_indx is not None:
+                codes = codes[row_indx]
+            data[col] = pd.Categorical.from_codes(codes, cats)
+
+        elif row_indx is not None:
+            data[col] = col_arrs[col][row_indx]
+        else:
+            data[col] = col_arrs[col]
+
+    return pd.DataFrame(data, columns=store_info['columns'])
+
+
+def write_matrix_store(mat, store_dir, dtype=None):
+    """Saves a labelled matrix so that it can be memory-mapped when loaded.
+
+    The matrix values are saved as a NumPy array alongside arrays of the row
+    and column labels. As with :func:`write_column_store`, the arrays are
+    written to a temporary directory which is then renamed into place.
+
+    Args:
+        mat (pandas DataFrame), shape = [n_rows, n_cols]
+        store_dir (str): Where the matrix is to be saved.
+        dtype (numpy dtype, optional): Which type to store the values as,
+                                       default is to keep their current type.
+
+    """
+    tmp_dir = '{}.{}.tmp'.format(store_dir.rstrip('/'), os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    np.save(os.path.join(tmp_dir, 'rows.npy'),
+            np.asarray(mat.index).astype(str))
+    np.save(os.path.join(tmp_dir, 'cols.npy'),
+            np.asarray(mat.columns).astype(str))
+    np.save(os.path.join(tmp_dir, 'values.npy'),
+            np.ascontiguousarray(mat.values, dtype=dtype))
+
+    try:
+        os.rename(tmp_dir, store_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir)
+
+
+def read_matrix_store(store_dir):
+    """Loads a matrix saved using :func:`write_matrix_store`.
+
+    Args:
+        store_dir (str): Where the matrix was saved.
+
+    Returns:
+        mat (pandas DataFrame), shape = [n_rows, n_cols]
+            The matrix, whose values are a read-only view of
+            the memory-mapped array saved on disk.
+
+    Raises:
+        IOError: If no complete matrix store exists at the given location.
+
+    """
+    if not os.path.isfile(os.path.join(store_dir, 'values.npy')):
+        raise IOError("No matrix store found at " + store_dir + " !")
+
+    return pd.DataFrame(
+        np.load(os.path.join(store_dir, 'values.npy'), mmap_mode='r'),
+        index=np.load(os.path.join(store_dir, 'rows.npy')),
+        columns=np.load(os.path.join(store_dir, 'cols.npy')),
+        copy=False
+        )
@@ -14,84 +14,366 @@ Author: Michal Grzadkowski <grzadkow@ohsu.edu>
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 
+from . import CACHE_PATH
+from .utils import choose_bmeg_server, get_bmeg_client, parse_tcga_barcodes
+from .utils import get_file_checksum, write_column_store, read_column_store
+
+import os
 import json
 from re import sub as gsub
 from math import exp
-from ophion import Ophion
 
+# union_categoricals was moved to pandas.api.types in pandas 0.20
+try:
+    from pandas.api.types import union_categoricals
+except ImportError:
+    from pandas.types.concat import union_categoricals
+
+from collections.abc import Set
+from weakref import WeakValueDictionary
 from functools import reduce
-from itertools import combinations as combn
-from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product, chain
 
 from sklearn.cluster import MeanShift
 
 
 # .. functions for loading mutation data from external data sources ..
-def get_variants_mc3(syn):
+# which version of the parsed MC3 table format is stored in the cache, to be
+# incremented whenever the parsing done in get_variants_mc3 changes
+mc3_cache_version = 2
+
+
+def parse_polyphen(polyphen):
+    """Gets PolyPhen scores from MAF annotations such as 'benign(0.01)'.
+
+    Args:
+        polyphen (array-like of str)
+
+    Returns:
+        scores (numpy array of float), shape = [len(polyphen), ]
+            The parsed scores, with zero used for mutations that
+            do not have a PolyPhen annotation.
+
+    """
+    scores = pd.Series(np.asarray(polyphen), dtype=object).str.extract(
+        '\\(([0-9.]+)\\)$', expand=False)
+
+    return scores.astype(float).fillna(0.0).values
+
+
+def read_mc3_maf(maf_file, genes=None, samples=None, chunk_size=250000):
+    """Parses mutation data from an MC3 MAF file one chunk at a time.
+
+    Mutations not matching the given genes and samples are dropped from each
+    chunk before the next one is read, so that peak memory usage scales with
+    the number of mutations kept rather than the size of the MAF.
+
+    Args:
+        maf_file (str): The location of the MC3 MAF file.
+        genes (list of str, optional): Only keep mutations of these genes.
+        samples (list of str, optional): Only keep mutations in these
+                                         samples, given as TCGA barcodes
+                                         shortened to four fields.
+        chunk_size (int, optional): How many MAF records to read at a time.
+
+    Returns:
+        muts (pandas DataFrame), shape = (n_mutations, mut_levels+1)
+            The mutations, with PolyPhen scores stored as floats and each of
+            the other columns stored as a pandas Categorical. The categories
+            of the 'Sample' column list every sample in the MAF, including
+            those with no mutations of the given genes.
+
+    """
+
+    # defines which mutation annotation MAF columns to use
+    use_cols = [0, 8, 15, 36, 38, 72]
+    use_names = ['Gene', 'Form', 'Sample', 'Protein', 'Exon', 'PolyPhen']
+
+    cat_names = ['Gene', 'Form', 'Sample', 'Protein', 'Exon']
+
+    mut_chunks = []
+    all_samps = set()
+    for muts in pd.read_csv(maf_file, usecols=use_cols, sep='\t',
+                            header=None, names=use_names, dtype=str,
+                            comment='#', skiprows=1, chunksize=chunk_size):
+        all_samps |= set(muts['Sample'].unique())
+
+        if genes is not None:
+            muts = muts.loc[muts['Gene'].isin(list(genes)), :]
+
+        # parses TCGA sample barcodes and PolyPhen scores
+        muts = muts.assign(Sample=parse_tcga_barcodes(muts['Sample']))
+        if samples is not None:
+            muts = muts.loc[muts['Sample'].isin(list(samples)), :]
+        muts = muts.assign(PolyPhen=parse_polyphen(muts['PolyPhen']))
+
+        # annotation values are heavily repeated across mutations, so storing
+        # them as categories saves both memory and loading time
+        mut_chunks += [muts.astype({col: 'category' for col in cat_names})]
+
+    muts = {col: union_categoricals([chunk[col] for chunk in mut_chunks])
+            for col in cat_names}
+    muts['PolyPhen'] = np.concatenate(
+        [chunk['PolyPhen'].values for chunk in mut_chunks])
+    muts = pd.DataFrame(muts, columns=use_names)
+
+    all_samps = sorted(set(parse_tcga_barcodes(list(all_samps))))
+    muts['Sample'] = muts['Sample'].cat.set_categories(all_samps)
+
+    return muts
+
+
+def get_variants_mc3(syn, genes=None, samples=None, use_cache=True):
     """Reads ICGC mutation data from the MC3 synapse file.
 
+    The parsed mutation table is cached as a set of memory-mapped column
+    arrays keyed by the checksum of the MC3 file, so that only the first
+    call for a given version of the file has to read the raw MAF. When the
+    cache is not used, the MAF is instead streamed in chunks and only the
+    mutations of the given genes and samples are kept.
+
     Args:
         syn (Synapse): A logged-in synapseclient instance.
+        genes (list of str, optional): Only get mutations of these genes.
+        samples (list of str, optional): Only get mutations in these samples.
+        use_cache (bool, optional): Whether to load the mutation table from
+                                    and save it to the cache, default True.
 
     Returns:
         muts (pandas DataFrame), shape = (n_mutations, mut_levels+1)
             An array of mutation data, with a row for each mutation
-            appearing in an individual sample.
+            appearing in an individual sample. PolyPhen scores are returned
+            as floats and the other columns as pandas Categoricals, with the
+            categories of the 'Sample' column listing every sample in the
+            MC3 dataset.
 
     Examples:
         >>> import synapseclient
         >>> syn = synapseclient.Synapse()
         >>> syn.login()
         >>> muts = get_variants_mc3(syn)
+        >>> tp53_muts = get_variants_mc3(syn, genes=['TP53'])
 
     """
     mc3 = syn.get('syn7824274')
 
-    # defines which mutation annotation MAF columns to use
-    use_cols = [0, 8, 15, 36, 38, 72]
-    use_names = ['Gene', 'Form', 'Sample', 'Protein', 'Exon', 'PolyPhen']
+    if not use_cache:
+        return read_mc3_maf(mc3.path, genes, samples)
+
+    # parses the full mutation table if this version of the MC3 file has not
+    # been seen before, and saves it to the cache
+    cache_dir = os.path.join(
+        CACHE_PATH, 'mc3', 'v{}_{}'.format(
+            mc3_cache_version, get_file_checksum(mc3.path))
+        )
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+        write_column_store(read_mc3_maf(mc3.path), cache_dir)
+
+    # loads the mutations of the given genes and samples from the cache
+    mut_filters = {}
+    if genes is not None:
+        mut_filters['Gene'] = genes
+    if samples is not None:
+        mut_filters['Sample'] = samples
+    muts = read_column_store(cache_dir, mut_filters)
 
-    # imports mutation data into a DataFrame, parses TCGA sample barcodes
-    # and PolyPhen scores
-    muts = pd.read_csv(mc3.path, usecols=use_cols, sep='\t', header=None,
-                       names=use_names, comment='#', skiprows=1)
-    muts['Sample'] = [reduce(lambda x, y: x + '-' + y, s.split('-', 4)[:4])
-                      for s in muts['Sample']]
-    muts['PolyPhen'] = [gsub('\)$', '', gsub('^.*\(', '', x))
-                        if x != '.' else 0 for x in muts['PolyPhen']]
+    for col in muts.select_dtypes(include=['category']).columns:
+        if col != 'Sample':
+            muts[col] = muts[col].cat.remove_unused_categories()
 
     return muts
 
 
-def get_variants_bmeg(sample_list, gene_list, mut_fields=("term", )):
-    """Gets variants from BMEG."""
+def get_variants_bmeg(sample_list, gene_list, mut_fields=("term", ),
+                      batch_size=50, parallel_jobs=8):
+    """Gets variants from BMEG.
+
+    Samples are split into blocks which are each retrieved using a single
+    query, with several blocks being queried concurrently.
+
+    Args:
+        sample_list (list of str): Which samples to get variants for.
+        gene_list (list of str): Which genes to get variants for.
+        mut_fields (tuple of str, optional): Which variant properties to get.
+        batch_size (int, optional): How many samples to include in each query.
+        parallel_jobs (int, optional): How many queries to run at once.
+
+    Returns:
+        muts (pandas DataFrame), shape = [n_mutations, len(mut_fields) + 2]
+            A table with a row for each variant found in one of the samples,
+            with 'Sample', 'Gene' and mutation property columns, in the
+            format expected by MuTree.
 
-    oph = Ophion("http://bmeg.io")
-    mut_list = {samp: {} for samp in sample_list}
+    Examples:
+        >>> muts = get_variants_bmeg(['TCGA-02-0003-01A'], ['TP53', 'PTEN'])
+        >>> mtree = MuTree(muts, levels=['Gene', 'term'])
+
+    """
+    bmeg_server = choose_bmeg_server()
     gene_lbls = ["gene:" + gn for gn in gene_list]
 
-    print(oph.query().has("gid", "biosample:" + sample_list[0])
-          .incoming("variantInBiosample")
-          .outEdge("variantInGene").mark("variant")
-          .inVertex().has("gid", oph.within(gene_lbls)).count().execute())
-          # .mark("gene").select(["gene", "variant"]).count().execute())
+    sample_list = list(sample_list)
+    samp_blocks = [sample_list[i:(i + batch_size)]
+                   for i in range(0, len(sample_list), batch_size)]
+
+    def query_block(samp_blk):
+        oph = get_bmeg_client(bmeg_server)
+
+        return [json.loads(i) for i in oph.query().has(
+            "gid", oph.within(["biosample:" + samp for samp in samp_blk]))
+                .mark("sample").incoming("variantInBiosample")
+                .outEdge("variantInGene").mark("variant")
+                .inVertex().has("gid", oph.within(gene_lbls))
+                .mark("gene").select(["sample", "gene", "variant"]).execute()]
+
+    # adds the variants found in each block of samples to the columns of the
+    # mutation table as soon as the block's query returns
+    mut_cols = ('Sample', 'Gene') + tuple(mut_fields)
+    mut_data = {col: [] for col in mut_cols}
+
+    with ThreadPoolExecutor(max_workers=parallel_jobs) as executor:
+        for blk_muts in executor.map(query_block, samp_blocks):
+
+            for dt in blk_muts:
+                mut_data['Sample'] += [dt["sample"]["gid"].split(':', 1)[-1]]
+                mut_data['Gene'] += [dt["gene"]["properties"]["symbol"]]
+
+                for fld in mut_fields:
+                    mut_data[fld] += [dt["variant"]["properties"].get(fld)]
 
-    for samp in sample_list:
-        for i in oph.query().has("gid", "biosample:" + samp)\
-                .incoming("variantInBiosample")\
-                .outEdge("variantInGene").mark("variant")\
-                .inVertex().has("gid", oph.within(gene_lbls))\
-                .mark("gene").select(["gene", "variant"]).execute():
-            dt = json.loads(i)
-            gene_name = dt["gene"]["properties"]["symbol"]
-            mut_list[samp][gene_name] = {
-                k: v for k, v in dt["variant"]["properties"].items()
-                if k in mut_fields}
+    return pd.DataFrame(mut_data, columns=mut_cols)
 
-    mut_table = pd.DataFrame(mut_list)
 
-    return mut_table
+# the number of set bits in each possible byte, used to count the samples in
+# a packed bitset
+byte_popcounts = np.array([bin(i).count('1') for i in range(256)],
+                          dtype=np.uint8)
+
+
+class SampleBits(Set):
+    """An immutable set of samples stored as a packed bitset.
+
+    Each sample is represented by its position in a registry of samples,
+    such as the samples of a cohort, with the set being stored as an array of
+    64-bit words in which the bits of the samples in the set are turned on.
+    Unions, intersections and differences of sets over the same registry are
+    thus computed using word-level operations instead of by hashing samples.
+    Sets can otherwise be used like frozensets of sample IDs.
+
+    Args:
+        bits (array of uint64): The packed bits of the samples in the set.
+        samp_index (pandas Index): The registry of samples.
+
+    Examples:
+        >>> samp_index = pd.Index(['S1', 'S2', 'S3', 'S4'])
+        >>> samps1 = SampleBits.from_samples(['S1', 'S3'], samp_index)
+        >>> samps2 = SampleBits.from_samples(['S3', 'S4'], samp_index)
+        >>> sorted(samps1 | samps2)
+            ['S1', 'S3', 'S4']
+        >>> len(samps1 & samps2)
+            1
+
+    """
+
+    __slots__ = ('bits', 'samp_index')
+
+    def __init__(self, bits, samp_index):
+        bits.flags.writeable = False
+        self.bits = bits
+        self.samp_index = samp_index
+
+    @classmethod
+    def from_mask(cls, samp_mask, samp_index):
+        """Packs a boolean mask over the samples in a registry."""
+        bit_mask = np.zeros(-(-len(samp_index) // 64) * 64, dtype=bool)
+        bit_mask[:len(samp_index)] = samp_mask
+
+        return cls(np.packbits(bit_mask).view(np.uint64), samp_index)
+
+    @classmethod
+    def from_samples(cls, samps, samp_index):
+        """Packs the given samples, ignoring those not in the registry."""
+        samp_indx = samp_index.get_indexer(list(samps))
+        samp_mask = np.zeros(len(samp_index), dtype=bool)
+        samp_mask[samp_indx[samp_indx >= 0]] = True
+
+        return cls.from_mask(samp_mask, samp_index)
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return frozenset(it)
+
+    def to_mask(self):
+        """Unpacks the set into a boolean mask over the registry."""
+        return np.unpackbits(self.bits.view(np.uint8))[
+            :len(self.samp_index)].astype(bool)
+
+    def _same_index(self, other):
+        return (isinstance(other, SampleBits)
+                and (other.samp_index is self.samp_index
+                     or other.samp_index.equals(self.samp_index)))
+
+    def __len__(self):
+        return int(byte_popcounts[self.bits.view(np.uint8)].sum())
+
+    def __bool__(self):
+        return bool(self.bits.any())
+
+    def __iter__(self):
+        return iter(self.samp_index[self.to_mask()])
+
+    def __contains__(self, samp):
+        try:
+            samp_loc = self.samp_index.get_loc(samp)
+        except (KeyError, TypeError):
+            return False
+
+        return bool(self.bits.view(np.uint8)[samp_loc // 8]
+                    & (0x80 >> (samp_loc % 8)))
+
+    def __or__(self, other):
+        if self._same_index(other):
+            return SampleBits(self.bits | other.bits, self.samp_index)
+        else:
+            return super().__or__(other)
+
+    def __and__(self, other):
+        if self._same_index(other):
+            return SampleBits(self.bits & other.bits, self.samp_index)
+        else:
+            return super().__and__(other)
+
+    def __sub__(self, other):
+        if self._same_index(other):
+            return SampleBits(self.bits & ~other.bits, self.samp_index)
+        else:
+            return super().__sub__(other)
+
+    def __xor__(self, other):
+        if self._same_index(other):
+            return SampleBits(self.bits ^ other.bits, self.samp_index)
+        else:
+            return super().__xor__(other)
+
+    def __eq__(self, other):
+        if self._same_index(other):
+            return np.array_equal(self.bits, other.bits)
+        else:
+            return super().__eq__(other)
+
+    def __hash__(self):
+        return hash(frozenset(self))
+
+    def __reduce__(self):
+        return SampleBits, (np.array(self.bits), self.samp_index)
+
+    def __repr__(self):
+        return 'SampleBits({})'.format(set(self))
 
 
 class MuTree(object):
@@ -128,11 +410,19 @@ class MuTree(object):
     keys of the MuTree.mut_fields object, in which case they will be defined
     by the corresponding MuType.muts_<level> method.
 
+    A tree can also be made compact, in which case its leaf nodes are stored
+    as SampleBits over a registry of samples such as those of a cohort, and
+    the union of the samples in each of its branches is cached, so that
+    retrieving the samples of a mutation sub-type only involves word-level
+    operations on the bitsets of the matching branches.
+
     Attributes:
         depth (int): How many mutation levels are above the tree
                      in the hierarchy.
         mut_level (str): The mutation annotation level described by the top
                          level of the tree.
+        samp_index (pandas Index): The registry of samples used by a compact
+                                   tree, None otherwise.
 
     Args:
         muts (pandas DataFrame), shape = [n_muts, ]
@@ -171,9 +461,30 @@ class MuTree(object):
         'Location': ('Protein', ),
         }
 
+    # parsing labels whose values for a mutation depend on which other
+    # mutations are parsed along with it, and which are thus parsed
+    # separately for the mutations of each node rather than for all of them
+    node_parsers = ('clust', )
+
+    # the attributes of each node of the tree, see MuTree._set_node
+    __slots__ = ('depth', 'mut_level', '_child', 'samp_index', '_samp_bits',
+                 '_samps_cache', '_cache_hits', '_cache_misses')
+
     @classmethod
-    def split_muts(cls, muts, lvl_name):
-        """Splits mutations into tree branches for a given level."""
+    def level_labels(cls, muts, lvl_name):
+        """Gets the branch of a mutation level each mutation belongs to.
+
+        Args:
+            muts (pandas DataFrame), shape = [n_muts, ]
+            lvl_name (str): A field in the mutation table, possibly with a
+                            parsing label, or a custom mutation level.
+
+        Returns:
+            lvl_labels (array of object), shape = [n_muts, ]
+                The value of the level for each mutation, with missing values
+                for mutations that do not have a value at this level.
+
+        """
 
         # level names have to consist of a base level name and an optional
         # parsing label separated by an underscore
@@ -189,35 +500,36 @@ class MuTree(object):
             parse_fx = 'parse_' + parse_lbl
 
             if parse_fx in cls.__dict__:
-                muts = eval('cls.' + parse_fx)(muts, lvl_info[0])
+                muts = getattr(cls, parse_fx)(muts, lvl_info[0])
 
             else:
                 raise ValueError("Custom parse label " + parse_lbl + " must "
                                  + "have a corresponding <" + parse_fx +
                                  "> method defined in " + cls.__name__ + "!")
 
-        # splits mutations according to values of the specified level
-        if isinstance(muts, tuple):
-            if np.all(pd.isnull(val) for _, val in muts):
-                split_muts = {}
-            else:
-                split_muts = muts
-        elif lvl_name in muts:
-            split_muts = dict(tuple(muts.groupby(lvl_name)))
+        if lvl_name in muts:
+            lvl_labels = np.asarray(muts[lvl_name], dtype=object)
 
         # if the specified level is not a column in the mutation table,
         # we assume it's a custom mutation level
         else:
             split_fx = 'muts_' + lvl_info[0].lower()
-            if split_fx in cls.__dict__:
-                split_muts = eval('cls.' + split_fx)(muts)
-            else:
-                raise ValueError("Custom mutation level " + lvl_name
-                                     + " must have a corresponding <"
-                                     + split_fx + "> method defined in "
-                                     + cls.__name__ + "!")
 
-        return split_muts
+            if split_fx not in cls.__dict__:
+                raise ValueError("Unknown mutation level " + lvl_name
+                                 + " which is not in the given mutation data"
+                                 + " frame and not a custom-defined level!")
+
+            if not np.all([x in muts for x in cls.mut_fields[lvl_info[0]]]):
+                raise ValueError("For mutation level " + lvl_info[0] + ", "
+                                 + str(cls.mut_fields[lvl_info[0]])
+                                 + " need to be provided as fields.")
+
+            lvl_labels = np.full(len(muts), None, dtype=object)
+            for lbl, lbl_muts in getattr(cls, split_fx)(muts).items():
+                lvl_labels[muts.index.get_indexer(lbl_muts.index)] = lbl
+
+        return lvl_labels
 
     """Functions for defining custom mutation levels.
 
@@ -314,95 +626,156 @@ class MuTree(object):
 
         return new_muts
 
-    def __new__(cls, muts, levels=('Gene', 'Form'), **kwargs):
-        """Given a list of mutations and a set of mutation levels, determines
-           whether a mutation tree should be built, or a frozenset returned,
+    def __new__(cls, muts=None, levels=('Gene', 'Form'), **kwargs):
+        """Builds a tree from the given mutations, or returns a frozenset of
+           the mutations' samples if none of the given levels have values,
            presumably as a branch of another MuTree.
 
-        """
-        if 'Sample' not in muts:
-            raise ValueError("Mutation table must have a 'Sample' field!")
+        The mutations are sorted once according to their values at all of
+        the levels, so that the mutations under each node of the tree are a
+        contiguous range of the sorted table, which is split into the ranges
+        of the node's branches at the first level that has values for any of
+        the node's mutations. Levels whose parsing labels are listed in
+        `node_parsers` are instead parsed for each node's range of mutations
+        when the node is built, after which the range is sorted again.
 
-        # initializes branch search variables
-        muts_left = False
-        lvls_left = list(levels)
-
-        # look for a level at which MuTree branches can be sprouted until we
-        # are either out of levels or we have found such a level
-        while lvls_left and not muts_left:
-            cur_lvl = lvls_left.pop(0).split('_')[0]
-
-            # if the level is a field in the mutation DataFrame, check if any
-            # mutations have non-null values...
-            if cur_lvl in muts:
-                muts_left = not np.all(pd.isnull(muts[cur_lvl]))
-
-            # ...otherwise, check if the fields corresponding to the custom
-            # level have any non-null values...
-            elif cur_lvl in cls.mut_fields:
-                if not np.all([x in muts for x in cls.mut_fields[cur_lvl]]):
-                    raise ValueError("For mutation level " + cur_lvl + ", "
-                                     + str(cls.mut_fields[cur_lvl])
-                                     + " need to be provided as fields.")
-
-                else:
-                    muts_left = not np.all(pd.isnull(
-                        muts.loc[:, cls.mut_fields[cur_lvl]]))
-
-            else:
-                raise ValueError("Unknown mutation level " + cur_lvl
-                                 + " which is not in the given mutation data"
-                                 + " frame and not a custom-defined level!")
-
-        # if we have found a level at which branches can be built,
-        # continue with instantiating the MuTree...
-        if muts_left:
-            return super(MuTree, cls).__new__(cls)
-
-        # ...otherwise, return a set of samples as a leaf node
-        else:
-            return frozenset(muts['Sample'])
-
-    def __init__(self, muts, levels=('Gene', 'Form'), **kwargs):
-        if 'depth' in kwargs:
-            self.depth = kwargs['depth']
-        else:
-            self.depth = 0
-
-        # intializes mutation hierarchy construction variables
-        lvls_left = list(levels)
-        self._child = {}
-        rel_depth = 0
-
-        # look for a mutation level at which we can create branches until we
-        # have found such a level, note that we know such a level exists
-        # because of the check performed in the __new__ method
-        while lvls_left and not self._child:
+        """
+        # trees being unpickled or copied are created without any mutations
+        # and then have their attributes restored
+        if muts is None:
+            mtree = super(MuTree, cls).__new__(cls)
+            mtree._set_node(0, None, {})
 
-            # get the split of the mutations given the current level
-            cur_lvl = lvls_left.pop(0)
-            splat_muts = self.split_muts(muts, cur_lvl)
+            return mtree
 
-            # if the mutations can be split, set the current mutation
-            # level of the tree...
-            if splat_muts:
-                self.mut_level = levels[rel_depth]
+        if 'Sample' not in muts:
+            raise ValueError("Mutation table must have a 'Sample' field!")
+        muts = muts.reset_index(drop=True)
+
+        def get_codes(lvl):
+            lvl_info = lvl.split('_')
+
+            # levels parsed separately within each node only have their
+            # missing values found here, in the field that is to be parsed
+            if (len(lvl_info) == 2
+                    and lvl_info[1].lower() in cls.node_parsers):
+                if lvl_info[0] not in muts:
+                    raise ValueError("Unknown mutation level " + lvl
+                                     + " whose field " + lvl_info[0]
+                                     + " is not in the given mutation data"
+                                     + " frame!")
+
+                return np.where(pd.isnull(muts[lvl_info[0]]), -1, 0), None
+
+            return pd.factorize(cls.level_labels(muts, lvl), sort=True)
+
+        # gets integer codes for the values of the mutations at each level,
+        # with missing values given a code of -1
+        lvl_codes, lvl_uniqs = zip(
+            *[get_codes(lvl) for lvl in levels]) if levels else ((), ())
+
+        # sorts the mutations by the first level, then by the second level,
+        # and so on, and counts how many mutations have values at each level
+        # up to each position in the sorted table
+        sort_indx = np.lexsort(lvl_codes[::-1]) if levels else np.arange(0)
+        samps = np.asarray(muts['Sample'], dtype=object)
+        if levels:
+            samps = samps[sort_indx]
+
+        lvl_codes = [codes[sort_indx] for codes in lvl_codes]
+        lvl_counts = [np.concatenate([[0], np.cumsum(codes >= 0)])
+                      for codes in lvl_codes]
+
+        def parse_range(j, start, end):
+            """Parses a level for a range of the sorted mutations, and then
+               sorts the range according to the parsed values."""
+            rng = slice(start, end)
+            codes, uniqs = pd.factorize(cls.level_labels(
+                muts.iloc[sort_indx[rng]], levels[j]), sort=True)
+
+            rng_indx = np.lexsort([lvl_codes[k][rng]
+                                   for k in range(len(levels) - 1, j, -1)]
+                                  + [codes])
+            for vals in [samps, sort_indx] + lvl_codes[(j + 1):]:
+                vals[rng] = vals[rng][rng_indx]
+
+            lvl_codes[j][rng] = codes[rng_indx]
+            for k in range(j + 1, len(levels)):
+                lvl_counts[k][(start + 1):(end + 1)] = (
+                    lvl_counts[k][start]
+                    + np.cumsum(lvl_codes[k][rng] >= 0)
+                    )
 
-                # ...and also set up the children nodes of the tree, which can
-                # either all be frozensets corresponding to leaf nodes...
-                if isinstance(splat_muts, tuple):
-                    self._child = dict(splat_muts)
+            return uniqs
 
-                # ...or a mixture of further MuTrees and leaf nodes
-                else:
-                    self._child = {nm: MuTree(mut, lvls_left,
-                                              depth=self.depth+1)
-                                   for nm, mut in splat_muts.items()}
+        def build_node(start, end, lvl_i, depth):
+            for j in range(lvl_i, len(levels)):
+                if lvl_counts[j][end] > lvl_counts[j][start]:
+                    break
 
-            # if the mutations cannot be split at this level, move on to the
-            # next level and keep track of how many levels we have skipped
+            # the mutations in this range form a leaf node if none of the
+            # remaining levels have values for them
             else:
-                rel_depth += 1
+                return frozenset(samps[start:end])
+
+            # mutations without a value at this level are sorted first and
+            # are left out of the node's branches
+            lvl_start = start + np.searchsorted(lvl_codes[j][start:end], 0)
+            brch_uniqs = lvl_uniqs[j]
+
+            if brch_uniqs is None:
+                brch_uniqs = parse_range(j, lvl_start, end)
+                lvl_start += np.searchsorted(lvl_codes[j][lvl_start:end], 0)
+
+            splits = (np.flatnonzero(np.diff(lvl_codes[j][lvl_start:end]))
+                      + lvl_start + 1).tolist()
+
+            node = super(MuTree, cls).__new__(cls)
+            node._set_node(depth, levels[j], {
+                brch_uniqs[lvl_codes[j][brch_start]]: build_node(
+                    brch_start, brch_end, j + 1, depth + 1)
+                for brch_start, brch_end in zip([lvl_start] + splits,
+                                                splits + [end])
+                })
+
+            return node
+
+        return build_node(0, len(muts), 0, kwargs.get('depth', 0))
+
+    def __init__(self, muts=None, levels=('Gene', 'Form'), **kwargs):
+        """Trees are built by MuTree.__new__."""
+        pass
+
+    def _set_node(self, depth, mut_level, child):
+        """Sets the attributes of a node of a tree."""
+        self.depth = depth
+        self.mut_level = mut_level
+        self._child = child
+
+        # trees are not compact unless MuTree.compact is called
+        self.samp_index = None
+        self._samp_bits = None
+
+        # the samples of the MuTypes already looked up in the tree, see
+        # MuType.get_samples, and how often the lookups were found there
+        self._samps_cache = None
+        self._cache_hits = 0
+        self._cache_misses = 0
+
+    def __getstate__(self):
+        return {'depth': self.depth, 'mut_level': self.mut_level,
+                '_child': self._child, 'samp_index': self.samp_index,
+                '_samp_bits': self._samp_bits}
+
+    def __setstate__(self, state):
+        """Restores a pickled tree, including trees pickled before the
+           attributes of nodes were stored in slots."""
+        if isinstance(state, tuple):
+            state = dict(state[0] or {}, **state[1])
+
+        self._set_node(state['depth'], state['mut_level'], state['_child'])
+        self.samp_index = state.get('samp_index')
+        self._samp_bits = state.get('_samp_bits')
 
     def __iter__(self):
         """Allows iteration over mutation categories at the current level, or
@@ -473,8 +846,112 @@ class MuTree(object):
 
         return levels
 
+    def compact(self, samp_index=None):
+        """Stores the leaf nodes of the tree as bitsets over a sample registry.
+
+        Args:
+            samp_index (list or pandas Index, optional)
+                The registry of samples, which must include all of the
+                samples in the tree. The default is to use the samples in
+                the tree, sorted by name.
+
+        Returns:
+            self
+
+        Examples:
+            >>> # use the samples of a cohort as the registry
+            >>> cdata = VariantCohort(...)
+            >>> cdata.train_mut.compact(sorted(cdata.samples))
+
+        """
+        if samp_index is None:
+            samp_index = sorted(self.get_samples())
+        if not isinstance(samp_index, pd.Index):
+            samp_index = pd.Index(samp_index)
+
+        if not samp_index.is_unique:
+            raise ValueError("Samples in the registry must be unique!")
+        if (samp_index.get_indexer(list(self.get_samples())) < 0).any():
+            raise ValueError("The sample registry must include all of the "
+                             "samples in the tree!")
+
+        self._compact_branches(samp_index)
+        return self
+
+    def _compact_branches(self, samp_index):
+        for nm, mut in self:
+            if isinstance(mut, MuTree):
+                mut._compact_branches(samp_index)
+            else:
+                self._child[nm] = SampleBits.from_samples(mut, samp_index)
+
+        self.samp_index = samp_index
+        self._update_bits()
+
+    def _update_bits(self):
+        """Caches the union of the samples in the branches of a compact tree.
+        """
+        branch_bits = [mut.get_samples().bits if isinstance(mut, MuTree)
+                       else mut.bits for _, mut in self]
+
+        if branch_bits:
+            self._samp_bits = SampleBits(
+                np.bitwise_or.reduce(branch_bits, axis=0), self.samp_index)
+
+        else:
+            self._samp_bits = SampleBits.from_mask(
+                np.zeros(len(self.samp_index), dtype=bool), self.samp_index)
+
+    def clear_cache(self):
+        """Clears the samples of MuTypes cached by this tree and its branches.
+
+        This has to be done whenever the branches of the tree are changed in
+        place, which MuTree.subtree does automatically. Any new leaf nodes
+        or branches of a compact tree are also made compact.
+
+        """
+        self._samps_cache = None
+
+        for nm, mut in self:
+            if isinstance(mut, MuTree):
+                if self.samp_index is not None and mut.samp_index is None:
+                    mut._compact_branches(self.samp_index)
+                else:
+                    mut.clear_cache()
+
+            elif (self.samp_index is not None
+                    and not isinstance(mut, SampleBits)):
+                self._child[nm] = SampleBits.from_samples(
+                    mut, self.samp_index)
+
+        if self.samp_index is not None:
+            self._update_bits()
+
+    def cache_info(self):
+        """Gets how often the samples of MuTypes were found in the cache.
+
+        Returns:
+            cache_info (dict): The number of lookups found in the cache
+                               ('hits'), the number of lookups not found
+                               ('misses'), and the number of MuTypes in the
+                               cache ('size'). The counts are kept after the
+                               cache is cleared.
+
+        Examples:
+            >>> for mtype in mtypes:
+            >>>     mtree.status(samps, mtype)
+            >>> mtree.cache_info()
+                {'hits': 1922, 'misses': 62, 'size': 62}
+
+        """
+        return {'hits': self._cache_hits, 'misses': self._cache_misses,
+                'size': len(self._samps_cache or {})}
+
     def get_samples(self):
         """Gets the set of unique samples contained within the tree."""
+        if self._samp_bits is not None:
+            return self._samp_bits
+
         samps = set()
 
         for nm, mut in self:
@@ -518,25 +995,98 @@ class MuTree(object):
             >>> new_tree = mtree.subtree(mtree.get_samples() - {'TCGA-04'})
 
         """
+        # in compact trees, intersections with the given samples are found
+        # using their bitset over the tree's sample registry
+        if self._samp_bits is not None:
+            if not (isinstance(samps, SampleBits)
+                    and samps.samp_index is self.samp_index):
+                samps = SampleBits.from_samples(samps, self.samp_index)
+        else:
+            samps = frozenset(samps)
+
         new_child = self._child.copy()
         for nm, mut in self:
 
+            # branches without any of the given samples are removed
             if isinstance(mut, MuTree):
-                new_samps = mut.get_samples() & set(samps)
+                new_samps = mut.get_samples() & samps
                 if new_samps:
                     new_child[nm] = mut.subtree(new_samps)
+                else:
+                    del new_child[nm]
 
-            elif isinstance(mut, frozenset):
-                new_samps = mut & frozenset(samps)
+            elif isinstance(mut, (frozenset, SampleBits)):
+                new_samps = mut & samps
                 if new_samps:
                     new_child[nm] = new_samps
+                else:
+                    del new_child[nm]
 
             else:
                 pass
 
         self._child = new_child
+        self._samps_cache = None
+        if self._samp_bits is not None:
+            self._update_bits()
+
         return self
 
+    def sample_view(self, samps):
+        """Gets a copy of a compact tree that only has the given samples.
+
+        Unlike :meth:`subtree`, the tree itself is left unchanged, and none
+        of its leaf nodes or its sample registry are copied. The copy shares
+        the registry, and each of its leaf nodes is the intersection of the
+        corresponding leaf of this tree with a bitset of the given samples,
+        so that many copies of the same tree restricted to different samples,
+        such as the training and testing samples of each split of a cohort,
+        can be made using only word-level operations. Levels parsed using
+        all of the tree's mutations, such as `Score_clust`, keep the values
+        they were given in this tree, and are thus not the same as in a tree
+        built using only the mutations of the given samples.
+
+        Args:
+            samps (list or set or SampleBits)
+
+        Returns:
+            mtree_view (MuTree)
+
+        Examples:
+            >>> mtree = MuTree(...).compact()
+            >>> train_mut = mtree.sample_view(train_samps)
+            >>> test_mut = mtree.sample_view(test_samps)
+
+        """
+        if self.samp_index is None:
+            raise ValueError("Only compact trees can be restricted to a "
+                             "subset of samples without being modified!")
+
+        if not (isinstance(samps, SampleBits)
+                and samps.samp_index is self.samp_index):
+            samps = SampleBits.from_samples(samps, self.samp_index)
+
+        return self._view_branches(samps)
+
+    def _view_branches(self, samps):
+        mtree_view = MuTree.__new__(type(self))
+        mtree_view._set_node(self.depth, self.mut_level, {})
+        mtree_view.samp_index = self.samp_index
+
+        # branches without any of the given samples are left out
+        for nm, mut in self:
+            if isinstance(mut, MuTree):
+                if mut.get_samples() & samps:
+                    mtree_view._child[nm] = mut._view_branches(samps)
+
+            else:
+                new_samps = mut & samps
+                if new_samps:
+                    mtree_view._child[nm] = new_samps
+
+        mtree_view._update_bits()
+        return mtree_view
+
     def get_overlap(self, mtype1, mtype2):
         """Gets the proportion of samples in one mtype that also fall under
            another, taking the maximum of the two possible mtype orders.
@@ -698,9 +1248,160 @@ class MuTree(object):
 
         return sub_mtypes
 
+    def iter_combtypes(self,
+                       mtype=None, sub_levels=None, min_size=1,
+                       max_size=None, comb_sizes=(1, 2), sub_mtypes=None,
+                       unique_samps=False):
+        """Lazily finds the MuTypes that combine multiple branches of the tree.
+
+        Combinations of branches are enumerated using the bitsets of the
+        samples in each branch, with the branches added to a combination one
+        at a time. Branches with more than the maximum number of samples are
+        left out before any combinations are made. A combination is not
+        extended any further as soon as it has more than the maximum number
+        of samples, since adding branches can only add samples, or as soon as
+        it can no longer reach the minimum number of samples using the
+        branches not yet considered. When only one MuType is returned for
+        each set of samples, branches that add no samples to a combination
+        are also skipped, as the combinations they lead to have the same
+        samples as combinations with fewer branches. MuTypes are only
+        created for the combinations that are returned.
+
+        Note that these bounds only cut combinations that cannot be
+        returned; when many branches can be combined without going over the
+        maximum, the number of MuTypes returned itself grows exponentially.
+
+        Args:
+            mtype (MuType), optional
+                A set of mutations of which the returned MuTypes must be a
+                subset. The default is to use all MuTypes within this MuTree.
+            sub_levels (list of str), optional
+                The levels of the leaf nodes of the returned MuTypes. The
+                default is to use all levels of the MuTree.
+            min_size (int), optional
+                The minimum number of samples in each returned MuType.
+            max_size (int), optional
+                The maximum number of samples in each returned MuType. The
+                default is not to use a maximum.
+            comb_sizes (list of int), optional
+                The number of branches that each returned MuType can combine.
+                The default is to consider combinations of up to two branches.
+            sub_mtypes (list of MuType), optional
+                The branches to combine. The default is to use the subtypes
+                of this tree given by the mtype and sub_levels arguments.
+            unique_samps (bool), optional
+                Whether to only return the first MuType found for each set of
+                samples, instead of every distinct MuType.
+
+        Yields:
+            comb_mtype (MuType)
+
+        Examples:
+            >>> # get the first twenty MuTypes combining up to four branches
+            >>> # that have between twenty and one hundred samples
+            >>> mtree = MuTree(...)
+            >>> list(islice(mtree.iter_combtypes(
+            >>>     min_size=20, max_size=100, comb_sizes=(1, 2, 3, 4)), 20))
+
+        """
+        if sub_mtypes is None:
+            sub_mtypes = self.subtypes(mtype, sub_levels)
+        sub_mtypes = sorted(sub_mtypes)
+        comb_sizes = sorted(set(csize for csize in comb_sizes if csize > 0))
+
+        # gets the bitset of the samples in each branch over the registry
+        # used by this tree, or over the tree's samples if it isn't compact
+        if self.samp_index is not None:
+            samp_index = self.samp_index
+        else:
+            samp_index = pd.Index(sorted(self.get_samples()))
+
+        def count_bits(bits):
+            return int(byte_popcounts[bits.view(np.uint8)].sum())
+
+        use_mtypes = []
+        sub_bits = []
+        for sub_mtype in sub_mtypes:
+            sub_samps = sub_mtype.get_samples(self)
+
+            if not (isinstance(sub_samps, SampleBits)
+                    and sub_samps.samp_index is samp_index):
+                sub_samps = SampleBits.from_samples(sub_samps, samp_index)
+
+            if max_size is None or count_bits(sub_samps.bits) <= max_size:
+                use_mtypes += [sub_mtype]
+                sub_bits += [sub_samps.bits]
+
+        # finds the samples in each branch and all of the branches after it,
+        # which bound how many samples a combination can end up with
+        empty_bits = SampleBits.from_mask(
+            np.zeros(len(samp_index), dtype=bool), samp_index).bits
+        rest_bits = [empty_bits]
+        for bits in sub_bits[::-1]:
+            rest_bits = [bits | rest_bits[0]] + rest_bits
+
+        def extend_comb(comb, comb_bits, comb_count, csizes, skip_same):
+            start = comb[-1] + 1 if comb else 0
+
+            # leaves enough branches to reach the smallest size still needed
+            need_size = min(csize for csize in csizes if csize > len(comb))
+            for i in range(start, len(sub_bits) - need_size + len(comb) + 1):
+                if count_bits(comb_bits | rest_bits[i]) < min_size:
+                    break
+
+                new_bits = comb_bits | sub_bits[i]
+                new_count = count_bits(new_bits)
+                if max_size is not None and new_count > max_size:
+                    continue
+                if skip_same and comb and new_count == comb_count:
+                    continue
+
+                new_comb = comb + (i, )
+                if len(new_comb) in csizes and new_count >= min_size:
+                    yield new_comb, new_bits
+
+                if len(new_comb) < csizes[-1]:
+                    yield from extend_comb(new_comb, new_bits, new_count,
+                                           csizes, skip_same)
+
+        # when only one MuType is returned for each set of samples, the
+        # combinations are enumerated from fewest to most branches, so that
+        # the simplest MuType is returned for each set of samples; otherwise
+        # combinations of all sizes are found in one pass over the branches
+        if not comb_sizes or not sub_bits:
+            comb_iter = iter(())
+
+        elif unique_samps:
+            comb_iter = chain.from_iterable(
+                extend_comb((), empty_bits, 0, [csize],
+                            set(range(1, csize)) <= set(comb_sizes))
+                for csize in comb_sizes
+                )
+
+        else:
+            comb_iter = extend_comb((), empty_bits, 0, comb_sizes, False)
+
+        found_keys = set()
+        for comb, comb_bits in comb_iter:
+            if unique_samps:
+                comb_key = comb_bits.tobytes()
+                if comb_key in found_keys:
+                    continue
+
+            comb_mtype = reduce(lambda x, y: x | y,
+                                [use_mtypes[i] for i in comb])
+            if not unique_samps:
+                comb_key = comb_mtype
+                if comb_key in found_keys:
+                    continue
+
+            found_keys.add(comb_key)
+            yield comb_mtype
+
     def combtypes(self,
                   mtype=None, sub_levels=None,
-                  min_size=1, comb_sizes=(1, 2)):
+                  min_size=1, comb_sizes=(1, 2), max_size=None,
+                  unique_samps=False):
         """Gets all MuTypes that combine multiple branches of the tree.
 
         Args:
@@ -716,6 +1417,12 @@ class MuTree(object):
             comb_sizes (list of int), optional
                 The number of branches that each returned MyType can combine.
                 The default is to consider combinations of up to two branches.
+            max_size (int), optional
+                The maximum number of samples in each returned MuType. The
+                default is not to use a maximum.
+            unique_samps (bool), optional
+                Whether to only return one MuType for each set of samples,
+                see MuTree.iter_combtypes.
 
         Returns:
             comb_mtypes (set of MuType)
@@ -730,22 +1437,25 @@ class MuTree(object):
             >>> mtree.combtypes(min_size=20, sub_levels=['Type'])
 
         """
-        comb_mtypes = set()
-        all_subs = self.subtypes(mtype, sub_levels)
-
-        for csize in comb_sizes:
-            for kc in combn(all_subs, csize):
-                new_set = reduce(lambda x, y: x | y, kc)
+        return set(self.iter_combtypes(mtype, sub_levels, min_size=min_size,
+                                       max_size=max_size,
+                                       comb_sizes=comb_sizes,
+                                       unique_samps=unique_samps))
 
-                if len(new_set.get_samples(self)) >= min_size:
-                    comb_mtypes |= {new_set}
-
-        return comb_mtypes
-
-    def treetypes(self, mtype=None, sub_levels=None, min_size=1):
+    def treetypes(self, mtype=None, sub_levels=None, min_size=1,
+                  max_size=None, unique_samps=False):
         """Get all MuTypes that combine any number of sub-branches
            of a mutation level.
 
+        Combinations of branches with more than max_size samples are not
+        returned and are not extended with further branches, see
+        MuTree.iter_combtypes; unique_samps further keeps only one MuType
+        for each set of samples at each mutation level. Since any number of
+        branches can be combined, the number of MuTypes returned grows
+        exponentially with the number of branches at each of the given
+        levels that fit within these bounds, so that levels with many small
+        branches such as 'Protein' are best left out of sub_levels.
+
         """
         tree_mtypes = set()
 
@@ -761,7 +1471,8 @@ class MuTree(object):
                 tree_mtypes |= self.combtypes(
                     mtype=mtype, sub_levels=[self.mut_level],
                     comb_sizes=range(1, max(2, len(self._child))),
-                    min_size=min_size
+                    min_size=min_size, max_size=max_size,
+                    unique_samps=unique_samps
                     )
 
             for (nm, branch), (_, btype) in filter(
@@ -774,13 +1485,15 @@ class MuTree(object):
                     tree_mtypes |= set(
                         MuType({(self.mut_level, nm): tree_mtype})
                         for tree_mtype in branch.treetypes(
-                            btype, sub_levels, min_size)
+                            btype, sub_levels, min_size, max_size,
+                            unique_samps)
                         )
 
         else:
             tree_mtypes |= reduce(
                 lambda x,y: x | y,
-                [branch.treetypes(btype, sub_levels, min_size)
+                [branch.treetypes(btype, sub_levels, min_size, max_size,
+                                  unique_samps)
                  for (nm, branch), (lbl, btype) in product(self, mtype)
                  if (isinstance(branch, MuTree)
                      and nm == lbl and len(branch) > min_size
@@ -811,8 +1524,84 @@ class MuTree(object):
             mtype = MuType(self.allkey())
         samp_list = mtype.get_samples(self)
 
+        # compact trees look up the samples' positions in the registry
+        if isinstance(samp_list, SampleBits):
+            samp_indx = self.samp_index.get_indexer(list(samples))
+
+            return (samp_indx >= 0) & samp_list.to_mask()[samp_indx]
+
         return np.array([s in samp_list for s in samples])
 
+    def status_matrix(self, samples, mtypes, sparse=False):
+        """Finds if each sample has a mutation of each of the given types.
+
+        The samples of each type are found as bitsets over the sample
+        registry of a compact tree, or over the samples in the tree
+        otherwise, which are then unpacked together so that the status of
+        every sample for every type is found in one vectorized step.
+
+        Args:
+            samples (list): Which samples' mutation status is to be retrieved,
+                            with the rows of the returned matrix being in
+                            the same order as these samples.
+            mtypes (list of MuType): The sets of mutations whose membership
+                                     we want to test.
+            sparse (bool, optional): Whether to return a sparse matrix.
+
+        Returns:
+            stat_mat (array of bool or scipy.sparse.csc_matrix)
+                shape = [len(samples), len(mtypes)]
+                For each input sample, whether or not it has a mutation in
+                each of the given sets.
+
+        Examples:
+            >>> mtypes = list(mtree.subtypes(min_size=20))
+            >>> stat_mat = mtree.status_matrix(samps, mtypes)
+            >>> stat_mat[:, 3] == mtree.status(samps, mtypes[3])
+                array([ True,  True, ...,  True], dtype=bool)
+
+        """
+        samples = list(samples)
+        mtypes = list(mtypes)
+
+        if self.samp_index is not None:
+            samp_index = self.samp_index
+        else:
+            samp_index = pd.Index(sorted(self.get_samples()))
+
+        # gets the packed bits of each mutation type's samples
+        type_bits = np.zeros((len(mtypes), -(-len(samp_index) // 64)),
+                             dtype=np.uint64)
+        for j, mtype in enumerate(mtypes):
+            type_samps = mtype.get_samples(self)
+
+            if not (isinstance(type_samps, SampleBits)
+                    and type_samps.samp_index is samp_index):
+                type_samps = SampleBits.from_samples(type_samps, samp_index)
+            type_bits[j] = type_samps.bits
+
+        # unpacks the bits of the registry samples that were asked for, while
+        # samples not in the registry have no mutations
+        samp_indx = samp_index.get_indexer(samples)
+        samp_rows = np.where(samp_indx >= 0)[0]
+        type_mat = np.unpackbits(type_bits.view(np.uint8), axis=1)[
+            :, samp_indx[samp_rows]]
+
+        if sparse:
+            type_indx, row_indx = np.nonzero(type_mat)
+
+            stat_mat = sp.csc_matrix(
+                (np.ones(len(row_indx), dtype=bool),
+                 (samp_rows[row_indx], type_indx)),
+                shape=(len(samples), len(mtypes))
+                )
+
+        else:
+            stat_mat = np.zeros((len(samples), len(mtypes)), dtype=bool)
+            stat_mat[samp_rows, :] = type_mat.T
+
+        return stat_mat
+
 
 class MuType(object):
     """A particular type of mutation defined by annotation properties.
@@ -840,6 +1629,11 @@ class MuType(object):
     has at least one of the mutation sub-types contained within it, as opposed
     to all of them.
 
+    MuTypes cannot be modified once they are created, and set keys that
+    define the same mutation subtypes always give the same MuType object,
+    whose hash is found when it is first created. MuTypes can thus be
+    compared and used in sets and as dictionary keys at little cost.
+
     Arguments:
         set_key (dict): Defines the mutation sub-types included in this set.
 
@@ -867,7 +1661,21 @@ class MuType(object):
 
     """
 
-    def __init__(self, set_key):
+    __slots__ = ('cur_level', '_child', '_sorted', '_hash', '__weakref__')
+
+    # the MuTypes in use by this process, so that MuTypes with the same
+    # structure are represented by the same object
+    _interned = WeakValueDictionary()
+
+    def __new__(cls, set_key=None):
+        """Finds the canonical representation of the given set key, and
+           returns the MuType with this representation if one exists."""
+
+        # MuTypes being unpickled from before they were interned are created
+        # without a key and then have their attributes restored
+        if set_key is None:
+            return super(MuType, cls).__new__(cls)
+
         level = set(k for k, _ in set_key.keys())
 
         # gets the property hierarchy level of this mutation type after making
@@ -877,9 +1685,9 @@ class MuType(object):
                              "mutation levels!")
 
         elif len(level) == 0:
-            self.cur_level = None
+            cur_level = None
         else:
-            self.cur_level = tuple(level)[0]
+            cur_level = tuple(level)[0]
 
         # gets the subsets of mutations defined at this level, and
         # their further subdivisions if they exist
@@ -895,51 +1703,93 @@ class MuType(object):
         # or if they have the same keys:
         #   (missense, splice):M1, missense:M2, splice:M2
         #    => (missense, splice):(M1, M2)
-        uniq_ch = set(children.values())
-        uniq_vals = tuple((frozenset(i for j in
-                                     [k for k, v in children.items()
-                                      if v == ch] for i in j), ch)
-                          for ch in uniq_ch)
+        uniq_vals = {}
+        for k, ch in children.items():
+            uniq_vals[ch] = uniq_vals.get(ch, frozenset()) | frozenset(k)
 
         # adds the children nodes of this MuTree
-        self._child = {}
-        for val, ch in uniq_vals:
+        child = {}
+        for ch, val in uniq_vals.items():
 
-            if val in self._child:
-                if ch is None or self._child[val] is None:
-                    self._child[val] = None
+            if val in child:
+                if ch is None or child[val] is None:
+                    child[val] = None
                 else:
-                    self._child[val] |= ch
+                    child[val] |= ch
 
             else:
-                self._child[val] = ch
+                child[val] = ch
+
+        # returns the MuType with the same structure if it is already in use
+        intern_key = (cls, cur_level, frozenset(child.items()))
+        mtype = cls._interned.get(intern_key)
+
+        if mtype is None:
+            mtype = super(MuType, cls).__new__(cls)
+            mtype._set_child(cur_level, child)
+            cls._interned[intern_key] = mtype
+
+        return mtype
+
+    def _set_child(self, cur_level, child):
+        """Sets the subtypes of a new MuType, along with its sorted entries
+           and its hash, which are used as-is for the rest of its life."""
+        object.__setattr__(self, 'cur_level', cur_level)
+        object.__setattr__(self, '_child', child)
+
+        object.__setattr__(self, '_sorted', tuple(sorted(
+            [(l, v) for k, v in child.items() for l in k],
+            key=lambda x: x[0]
+            )))
+        object.__setattr__(self, '_hash',
+                           hash((cur_level, frozenset(child.items()))))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MuTypes cannot be modified!")
+
+    def __delattr__(self, name):
+        raise AttributeError("MuTypes cannot be modified!")
+
+    def __reduce__(self):
+        return MuType, ({(self.cur_level, tuple(sorted(k))): ch
+                         for k, ch in self._child.items()}, )
+
+    def __setstate__(self, state):
+        """Restores a MuType pickled before MuTypes were interned."""
+        if isinstance(state, tuple):
+            state = state[-1]
+
+        self._set_child(state['cur_level'], state['_child'])
 
     def __iter__(self):
         """Returns an expanded representation of the set structure."""
-        return iter(sorted(
-            [(l, v) for k, v in self._child.items() for l in k],
-            key=lambda x: x[0]
-            ))
+        return iter(self._sorted)
 
     def __eq__(self, other):
         """Two MuTypes are equal if and only if they have the same set
            of children MuTypes for the same subsets."""
 
-        # if one of the two objects is not a MuType they are not equal
-        if isinstance(self, MuType) ^ isinstance(other, MuType):
-            eq = False
+        # MuTypes are interned, so equal MuTypes are usually the same object
+        if self is other:
+            eq = True
 
-        # MuTypes for different mutation levels are not equal
-        elif self.cur_level != other.cur_level:
+        # if one of the two objects is not a MuType they are not equal
+        elif not isinstance(other, MuType):
             eq = False
 
         # MuTypes with the same mutation levels are equal if and only if
         # they have the same mutation subtypes for the same level entries
         else:
-            eq = (self._child == other._child)
+            eq = (self._hash == other._hash
+                  and self.cur_level == other.cur_level
+                  and self._child == other._child)
 
         return eq
 
+    def __hash__(self):
+        """MuType hashes are found once, when the MuType is created."""
+        return self._hash
+
     def __repr__(self):
         """Shows the hierarchy of mutation properties contained
            within the MuType."""
@@ -1151,21 +2001,6 @@ class MuType(object):
         else:
             return None
 
-    def __hash__(self):
-        """MuType hashes are defined in an analagous fashion to those of
-           tuples, see for instance http://effbot.org/zone/python-hash.htm"""
-        value = 0x163125
-
-        for k, v in self:
-            value += eval(hex((int(value) * 1000007) & 0xFFFFFFFF)[:-1])
-            value ^= hash(k) ^ hash(v)
-            value ^= len(self._child)
-
-        if value == -1:
-            value = -2
-
-        return value
-
     def get_levels(self):
         """Gets all the levels present in this type and its children."""
         levels = {self.cur_level}
@@ -1179,20 +2014,53 @@ class MuType(object):
     def get_samples(self, mtree):
         """Gets the samples contained in branch(es) of a MuTree.
 
+        The samples found for each MuType are cached by the MuTree, so that
+        repeated lookups of the same MuType are only done once for as long
+        as the MuTree is not changed, see MuTree.cache_info.
+
         Args:
             mtree (MuTree): A hierarchy of mutations present in samples.
 
         Returns:
-            samps (set): The samples in the MuTree that have the mutation(s)
-                         specified by this MuType.
-                         .
+            samps (frozenset or SampleBits): The samples in the MuTree that
+                                             have the mutation(s) specified
+                                             by this MuType.
+
         """
         if not isinstance(mtree, MuTree):
             raise TypeError("Can't retrieve samples from something that is "
                             "not a MuTree!")
 
+        if mtree._samps_cache is None:
+            mtree._samps_cache = {}
+
+        samps = mtree._samps_cache.get(self)
+        if samps is None:
+            mtree._cache_misses += 1
+
+            samps = self._get_samples(mtree)
+            if not isinstance(samps, SampleBits):
+                samps = frozenset(samps)
+            mtree._samps_cache[self] = samps
+
+        else:
+            mtree._cache_hits += 1
+
+        return samps
+
+    def _get_samples(self, mtree):
+        """Finds the samples in a MuTree without using its cache."""
+
+        # samples from compact trees are combined as bitsets
+        if mtree.samp_index is not None:
+            samps = SampleBits.from_mask(
+                np.zeros(len(mtree.samp_index), dtype=bool),
+                mtree.samp_index
+                )
+        else:
+            samps = set()
+
         # if this MuType has the same mutation level as the MuTree...
-        samps = set()
         if self.cur_level == mtree.mut_level:
 
             # ...find the mutation entries in the MuTree that match the
@@ -1200,13 +2068,13 @@ class MuType(object):
             for (nm, mut), (k, v) in product(mtree, self):
                 if k == nm:
                     
-                    if isinstance(mut, frozenset):
+                    if isinstance(mut, (frozenset, SampleBits)):
                             samps |= mut
                     elif isinstance(mut, MuTree):
                         if v is None:
                             samps |= mut.get_samples()
                         else:
-                            samps |= v.get_samples(mut)
+                            samps |= v._get_samples(mut)
                     else:
                         raise ValueError("get_samples error!")
 
@@ -1214,7 +2082,7 @@ class MuType(object):
             for _, mut in mtree:
                 if (isinstance(mut, MuTree)
                         and mut.get_levels() & self.get_levels()):
-                    samps |= self.get_samples(mut)
+                    samps |= self._get_samples(mut)
 
         return samps
 
@@ -8,6 +8,8 @@ in downstream prediction algorithms.
 
 # Author: Michal Grzadkowski <grzadkow@ohsu.edu>
 
+from ..features.pathways import PathwayGraph
+
 from itertools import chain
 import numpy as np
 from sklearn.feature_selection.base import SelectorMixin
@@ -35,6 +37,19 @@ class PathwaySelect(SelectorMixin):
         if self.path_keys is None:
             select_genes = set(X.columns)
 
+        # pathway graphs can find the neighbourhoods of all of the mutated
+        # genes at once, and remember them for subsequent fits; as with the
+        # neighbourhood dictionaries, a key with neither directions nor
+        # interaction types selects no genes
+        elif isinstance(path_obj, PathwayGraph):
+            select_genes = set()
+
+            for path_key in self.path_keys:
+                for pdirs, ptypes in path_key:
+                    if len(pdirs) > 0 or len(ptypes) > 0:
+                        select_genes |= path_obj.select_genes(
+                            mut_genes, directions=pdirs, int_types=ptypes)
+
         else:
             select_genes = set()
 
@@ -0,0 +1,28 @@
+"""Fixtures shared by the unit tests of HetMan.
+
+Every module in :module:`..features` copies the location of the cache when
+it is imported, so the copy in each of the modules loaded by the tests is
+pointed to a temporary directory, which keeps the tests from writing
+checksum memos and cached datasets into the checkout.
+
+"""
+
+from .. import features
+
+import sys
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_path(tmpdir, monkeypatch):
+    """Points the cache of every loaded features module to a temporary
+       directory."""
+    cache_dir = str(tmpdir.join('cache'))
+
+    for mod_name, mod in list(sys.modules.items()):
+        if ((mod_name == features.__name__
+                or mod_name.startswith(features.__name__ + '.'))
+                and hasattr(mod, 'CACHE_PATH')):
+            monkeypatch.setattr(mod, 'CACHE_PATH', cache_dir)
+
+    return cache_dir
@@ -0,0 +1,108 @@
+"""Unit tests for loading gene annotation data.
+
+This file contains unit tests for:
+    parse_gencode: parsing the records of protein-coding genes on non-sex
+                   chromosomes from a GTF file
+    GeneAnnot: looking up the annotation of genes by ID and by name
+
+The GTF file used here is a small hand-made file saved to a temporary
+directory.
+
+See Also:
+    :module:`..features.annot`: Contains the functions that are tested here.
+
+"""
+
+from ..features.annot import parse_gencode, GeneAnnot
+
+import pytest
+
+
+def gtf_record(chrom, rec_type, start, end, gene_id, gene_type, gene_name):
+    """Formats an annotation record the way Gencode GTF files do."""
+    return '\t'.join([
+        chrom, 'HAVANA', rec_type, str(start), str(end), '.', '+', '.',
+        'gene_id "{}"; transcript_id "{}"; gene_type "{}"; '
+        'gene_status "KNOWN"; gene_name "{}"; level 2;'.format(
+            gene_id, gene_id, gene_type, gene_name)
+        ])
+
+
+def make_gtf():
+    """Creates the records of a GTF file with genes for each filter.
+
+    TP53 and PTEN are protein-coding genes on autosomes, the former having
+    a transcript record as well. MIR21 is not protein-coding, AR is on a sex
+    chromosome, and MT-CO1 is on the mitochondrial chromosome.
+
+    """
+    return ['##description: evidence-based annotation of the human genome',
+            '##provider: GENCODE',
+            gtf_record('chr17', 'gene', 7661779, 7687550,
+                       'ENSG00000141510.16', 'protein_coding', 'TP53'),
+            gtf_record('chr17', 'transcript', 7661779, 7687538,
+                       'ENSG00000141510.16', 'protein_coding', 'TP53'),
+            gtf_record('chr17', 'gene', 59841266, 59841337,
+                       'ENSG00000284190.1', 'miRNA', 'MIR21'),
+            gtf_record('chrX', 'gene', 67544021, 67730619,
+                       'ENSG00000169083.15', 'protein_coding', 'AR'),
+            gtf_record('chr10', 'gene', 87863113, 87971930,
+                       'ENSG00000171862.9', 'protein_coding', 'PTEN'),
+            gtf_record('chrM', 'gene', 5904, 7445,
+                       'ENSG00000198804.2', 'protein_coding', 'MT-CO1')]
+
+
+@pytest.fixture
+def gtf_file(tmpdir):
+    """Saves the GTF records to a temporary directory."""
+    gtf_file = tmpdir.join('annot.gtf')
+    gtf_file.write('\n'.join(make_gtf()) + '\n')
+
+    return str(gtf_file)
+
+
+class TestCaseGencode:
+    """Tests for parsing and indexing Gencode annotation data."""
+
+    def test_parse(self, gtf_file):
+        """Are only protein-coding genes on autosomes kept, with their
+           IDs stripped of their versions?"""
+        annot_data = parse_gencode(gtf_file)
+
+        assert annot_data.columns.tolist() == [
+            'ID', 'gene_name', 'chr', 'Start', 'End']
+        assert annot_data['ID'].tolist() == [
+            'ENSG00000141510', 'ENSG00000171862']
+        assert annot_data['gene_name'].tolist() == ['TP53', 'PTEN']
+        assert annot_data['chr'].tolist() == ['chr17', 'chr10']
+        assert annot_data['Start'].tolist() == [7661779, 87863113]
+        assert annot_data['End'].tolist() == [7687550, 87971930]
+
+    def test_lookup(self, gtf_file):
+        """Can genes be looked up by their unversioned IDs?"""
+        annot = GeneAnnot(parse_gencode(gtf_file))
+
+        assert len(annot) == 2
+        assert list(annot) == ['ENSG00000141510', 'ENSG00000171862']
+        assert 'ENSG00000141510' in annot
+        assert 'ENSG00000141510.16' not in annot
+        assert 'ENSG00000169083' not in annot
+
+        assert annot['ENSG00000171862'] == {
+            'chr': 'chr10', 'Start': 87863113, 'End': 87971930,
+            'gene_name': 'PTEN', 'gene_type': 'protein_coding'
+            }
+
+        with pytest.raises(KeyError):
+            annot['ENSG00000284190']
+
+    def test_name_rows(self, gtf_file):
+        """Are genes found by name, with -1 for genes not annotated?"""
+        annot = GeneAnnot(parse_gencode(gtf_file))
+        name_rows = annot.name_rows(['PTEN', 'AR', 'TP53', 'MIR21', 'ZZZ'])
+
+        assert name_rows.dtype == int
+        assert name_rows.tolist() == [1, -1, 0, -1, -1]
+        assert (annot.gene_names[name_rows[name_rows >= 0]].tolist()
+                == ['PTEN', 'TP53'])
+        assert annot.name_rows([]).tolist() == []
@@ -0,0 +1,204 @@
+
+"""Unit tests for querying BMEG.
+
+This file contains unit tests for:
+    choose_bmeg_server, get_bmeg_client: picking a BMEG server and pooling
+                                         the Ophion clients used to query it
+    get_variants_bmeg: retrieving variants in concurrent blocks of samples
+
+The tests run against a stand-in Ophion client which answers queries from
+a small table of variants instead of connecting to a server.
+
+See Also:
+    :module:`..features.utils`, :module:`..features.variants`: Contain the
+        functions that are tested here.
+
+"""
+
+from ..features import utils, variants
+
+import pandas as pd
+
+import pytest
+import json
+import threading
+
+
+class FakeOphion(object):
+    """A stand-in for the Ophion client of a BMEG server.
+
+    Attributes:
+        server (str): The URL of the server.
+        muts (list of tuple): The (sample, gene, form) variants the server
+                              knows about.
+        up (bool): Whether the server answers queries.
+
+    """
+
+    # the blocks of samples queried across all clients, in the order the
+    # queries were made
+    sample_queries = []
+    query_lock = threading.Lock()
+
+    def __init__(self, server, muts=(), up=True):
+        self.server = server
+        self.muts = muts
+        self.up = up
+
+    def within(self, vals):
+        return list(vals)
+
+    def query(self):
+        return FakeQuery(self)
+
+
+class FakeQuery(object):
+    """A stand-in for an Ophion query which records the filters applied."""
+
+    def __init__(self, oph):
+        self.oph = oph
+        self.gids = []
+        self.counted = False
+
+    def has(self, key, vals):
+        self.gids += [vals]
+        return self
+
+    def count(self):
+        self.counted = True
+        return self
+
+    def __getattr__(self, step):
+        return lambda *args: self
+
+    def execute(self):
+        if not self.oph.up:
+            raise ConnectionError(
+                "Server {} is down!".format(self.oph.server))
+
+        if self.counted:
+            return [1]
+
+        samps, genes = self.gids
+        with FakeOphion.query_lock:
+            FakeOphion.sample_queries += [samps]
+
+        return [json.dumps({'sample': {'gid': 'biosample:' + samp},
+                            'gene': {'properties': {'symbol': gene}},
+                            'variant': {'properties': {'term': form}}})
+                for samp, gene, form in self.oph.muts
+                if 'biosample:' + samp in samps and 'gene:' + gene in genes]
+
+
+@pytest.fixture(scope='function')
+def bmeg_servers(monkeypatch):
+    """Replaces the BMEG servers with stand-ins, the first of which is down.
+    """
+    servers = {'http://down': FakeOphion('http://down', up=False),
+               'http://up': FakeOphion(
+                   'http://up', muts=[('S1', 'TP53', 'Missense'),
+                                      ('S2', 'TP53', 'Nonsense'),
+                                      ('S2', 'PTEN', 'Silent'),
+                                      ('S4', 'TTN', 'Missense'),
+                                      ('S5', 'PTEN', 'Missense')])}
+
+    # counts how many clients are created for each server
+    client_counts = {server: 0 for server in servers}
+
+    def make_client(server):
+        client_counts[server] += 1
+        return servers[server]
+
+    monkeypatch.setattr(utils, 'Ophion', make_client)
+    monkeypatch.setattr(utils, 'bmeg_server_list', list(servers))
+    monkeypatch.setattr(utils, 'bmeg_server_cache',
+                        {'server': None, 'time': 0})
+    monkeypatch.setattr(utils, 'bmeg_client_pool', threading.local())
+    monkeypatch.setattr(utils, 'bmeg_idle_clients', {})
+    monkeypatch.setattr(FakeOphion, 'sample_queries', [])
+
+    return servers, client_counts
+
+
+class TestCaseBmegServer:
+    """Tests for choosing a BMEG server and pooling its clients."""
+
+    def test_choose(self, bmeg_servers):
+        """Is the server that answers the probe query chosen and re-used?"""
+        servers, client_counts = bmeg_servers
+
+        # the probe of the server that is down can finish at any time, so
+        # only the clients of the server that is up are counted
+        assert utils.choose_bmeg_server() == 'http://up'
+        assert client_counts['http://up'] == 1
+
+        assert utils.choose_bmeg_server() == 'http://up'
+        assert client_counts['http://up'] == 1
+
+        assert utils.choose_bmeg_server(refresh=True) == 'http://up'
+        assert client_counts['http://up'] == 2
+
+    def test_unavailable(self, bmeg_servers, monkeypatch):
+        """Is an error raised when no server answers?"""
+        servers, _ = bmeg_servers
+        monkeypatch.setattr(servers['http://up'], 'up', False)
+
+        with pytest.raises(RuntimeError):
+            utils.choose_bmeg_server()
+
+    def test_reuse_probe(self, bmeg_servers):
+        """Is the client that probed the chosen server re-used, once?"""
+        servers, client_counts = bmeg_servers
+
+        assert utils.get_bmeg_client() is servers['http://up']
+        assert client_counts['http://up'] == 1
+
+        thread = threading.Thread(target=utils.get_bmeg_client,
+                                  args=('http://up', ))
+        thread.start()
+        thread.join()
+        assert client_counts['http://up'] == 2
+
+    def test_pool(self, bmeg_servers):
+        """Does each thread re-use its own client for each server?"""
+        servers, client_counts = bmeg_servers
+
+        oph = utils.get_bmeg_client('http://up')
+        assert utils.get_bmeg_client('http://up') is oph
+        assert client_counts['http://up'] == 1
+
+        thread = threading.Thread(target=utils.get_bmeg_client,
+                                  args=('http://up', ))
+        thread.start()
+        thread.join()
+        assert client_counts['http://up'] == 2
+
+
+class TestCaseBmegVariants:
+    """Tests for retrieving variants from BMEG."""
+
+    def test_blocks(self, bmeg_servers):
+        """Are variants retrieved for every block of samples?"""
+        muts = variants.get_variants_bmeg(
+            ['S1', 'S2', 'S3', 'S4', 'S5'], ['TP53', 'PTEN'],
+            batch_size=2, parallel_jobs=3
+            )
+
+        assert sorted(FakeOphion.sample_queries) == [
+            ['biosample:S1', 'biosample:S2'],
+            ['biosample:S3', 'biosample:S4'],
+            ['biosample:S5']
+            ]
+
+        assert list(muts.columns) == ['Sample', 'Gene', 'term']
+        assert muts.values.tolist() == [['S1', 'TP53', 'Missense'],
+                                        ['S2', 'TP53', 'Nonsense'],
+                                        ['S2', 'PTEN', 'Silent'],
+                                        ['S5', 'PTEN', 'Missense']]
+
+    def test_empty(self, bmeg_servers):
+        """Is an empty table returned when there are no variants?"""
+        muts = variants.get_variants_bmeg(['S3'], ['TP53'])
+
+        assert isinstance(muts, pd.DataFrame)
+        assert muts.shape == (0, 3)
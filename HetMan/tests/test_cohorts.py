@@ -0,0 +1,481 @@
+
+"""Unit tests for cohorts of -omic datasets.
+
+This file contains unit tests for:
+    filter_omics: choosing the samples and features of an -omic dataset
+    MutCohort.add_copies: adding copy number alterations to mutation trees
+    OmicCohort.split_view: splitting a loaded cohort into training and
+                           testing cohorts that share its mutation tree
+                           without changing it
+    VariantCohort.test_pheno: getting the mutation statuses of samples in
+                              the order of the -omic dataset
+    DrugCohort.split_view: splitting a drug response cohort the same way as
+                           its constructor does
+
+The cohorts tested here are assembled from small hand-made tables instead of
+being loaded from TCGA, so the steps of the constructors that filter the
+datasets are repeated by :func:`make_cohort`.
+
+See Also:
+    :module:`..features.cohorts`: Contains the classes that are tested here.
+
+"""
+
+from ..features import cohorts
+from ..features.cohorts import (filter_omics, OmicCohort, VariantCohort,
+                                MutCohort, DrugCohort)
+from ..features.variants import MuType, MuTree
+
+import numpy as np
+import pandas as pd
+
+import pytest
+import random
+
+
+def make_omics():
+    """Creates an -omic dataset with features and samples for each filter.
+
+    Feature B has no variance, feature D isn't annotated and F has a small
+    variance, while features C and E have one missing value each. Sample S3
+    is only missing a value for B, and sample S5 is missing all values.
+
+    """
+    return pd.DataFrame(
+        [[1.0, 1.0, 0.0, 5.0, 0.0, 0.0],
+         [2.0, 1.0, np.nan, 5.0, 1.0, 0.01],
+         [3.0, np.nan, 2.0, 5.0, 2.0, 0.0],
+         [4.0, 1.0, 4.0, 5.0, np.nan, 0.01],
+         [np.nan] * 6],
+        index=['S1', 'S2', 'S3', 'S4', 'S5'],
+        columns=['A', 'B', 'C', 'D', 'E', 'F']
+        )
+
+
+def make_cohort(split_samps=None):
+    """Assembles a variant cohort that uses all of its samples for training.
+
+    Args:
+        split_samps (set of str, optional): If given, samples not in this
+                                            set are removed after the split,
+                                            as MutCohort does for samples
+                                            without CNA data.
+
+    """
+    samps = ['S{:02d}'.format(i) for i in range(20)]
+    omic_mat = pd.DataFrame(
+        np.random.RandomState(101).randn(20, 6),
+        index=samps[::-1], columns=['G{}'.format(i) for i in range(6)]
+        )
+
+    muts = pd.DataFrame({
+        'Sample': samps[::2] + samps[1::3],
+        'Gene': ['TP53'] * 10 + ['PTEN'] * 7,
+        'Form': (['Missense', 'Nonsense'] * 5
+                 + ['Missense', 'Silent', 'Frame_Shift'] * 2 + ['Silent'])
+        })
+
+    cdata = VariantCohort.__new__(VariantCohort)
+    cdata.split_samples = tuple(samps)
+    OmicCohort.__init__(cdata, omic_mat, set(samps), None, 'TEST', None)
+
+    if split_samps is not None:
+        cdata.samples = cdata.samples & split_samps
+        cdata.train_samps = cdata.train_samps & split_samps
+        cdata.omic_mat = cdata.omic_mat.loc[
+            cdata.omic_mat.index.isin(list(cdata.samples)), :]
+
+    cdata.train_mut = MuTree(
+        muts.loc[muts['Sample'].isin(samps), :], levels=['Gene', 'Form']
+        ).compact(samps)
+
+    if split_samps is not None:
+        cdata.train_mut.subtree(cdata.train_samps)
+
+    return cdata
+
+
+class TestCaseFilterOmics:
+    """Tests for filtering the samples and features of -omic datasets."""
+
+    def test_variant(self):
+        """Are features removed using variance and annotation, and then
+           samples using the missing values of the remaining features?"""
+        samp_mask, gene_mask, filter_report = filter_omics(
+            make_omics(), min_var=0.005, samp_missing='any',
+            use_genes=['A', 'B', 'C', 'E', 'F']
+            )
+
+        assert samp_mask.tolist() == [True, False, True, False, False]
+        assert gene_mask.tolist() == [True, False, True, False, True, False]
+        assert filter_report == {'unannotated_genes': ['D'],
+                                 'low_var_genes': ['B', 'F'],
+                                 'missing_samps': ['S2', 'S4', 'S5']}
+
+    def test_variant_baseline(self):
+        """Are the same samples and features kept as when the expression
+           data of a VariantCohort was filtered using pandas, including
+           samples missing values of features that aren't annotated?"""
+        rs = np.random.RandomState(211)
+        omic_mat = pd.DataFrame(rs.randn(40, 30) * rs.random_sample(30) / 4)
+        omic_mat[rs.random_sample(omic_mat.shape) < 0.02] = np.nan
+        use_genes = rs.choice(30, 20, replace=False).tolist()
+
+        samp_mask, gene_mask, _ = filter_omics(
+            omic_mat, min_var=0.005, samp_missing='any', use_genes=use_genes)
+
+        base_mat = omic_mat.loc[
+            :, omic_mat.apply(lambda x: np.var(x) > 0.005)].dropna()
+        base_mat = base_mat.loc[:, base_mat.columns.isin(use_genes)]
+
+        assert omic_mat.index[samp_mask].tolist() == base_mat.index.tolist()
+        assert (omic_mat.columns[gene_mask].tolist()
+                == base_mat.columns.tolist())
+
+    def test_drug(self):
+        """Are empty samples removed before features with missing values?"""
+        samp_mask, gene_mask, filter_report = filter_omics(
+            make_omics(), gene_missing='any', samp_missing='all')
+
+        assert samp_mask.tolist() == [True, True, True, True, False]
+        assert gene_mask.tolist() == [True, False, False, True, False, True]
+        assert filter_report == {'missing_samps': ['S5'],
+                                 'missing_genes': ['B', 'C', 'E']}
+
+    @pytest.mark.parametrize('min_var', [0, 0.005, 0.7, 1.5, 3])
+    def test_variance(self, min_var):
+        """Is the variance of features found using their non-missing values?
+        """
+        omic_mat = make_omics()
+        samp_mask, gene_mask, filter_report = filter_omics(
+            omic_mat, min_var=min_var)
+
+        assert samp_mask.all()
+        assert gene_mask.tolist() == (omic_mat.var(ddof=0)
+                                      > min_var).tolist()
+        assert (filter_report['low_var_genes']
+                == omic_mat.columns[~gene_mask].tolist())
+
+    @pytest.mark.parametrize('block_size', [1, 2, 3, 7, 1000])
+    def test_blocks(self, block_size):
+        """Are the filters the same however many rows are read at a time?
+        """
+        rs = np.random.RandomState(block_size)
+        omic_mat = pd.DataFrame(rs.randn(40, 30) * rs.random_sample(30))
+        omic_mat[rs.random_sample(omic_mat.shape) < 0.03] = np.nan
+        omic_mat.iloc[[3, 17], :] = np.nan
+
+        for filters in [{'min_var': 0.2, 'samp_missing': 'any'},
+                        {'gene_missing': 'any', 'samp_missing': 'all'},
+                        {'min_var': 0.1, 'samp_missing': 'all'}]:
+            samp_mask, gene_mask, filter_report = filter_omics(
+                omic_mat, block_size=block_size, **filters)
+            full_samps, full_genes, full_report = filter_omics(
+                omic_mat, block_size=omic_mat.shape[0], **filters)
+
+            assert (samp_mask == full_samps).all()
+            assert (gene_mask == full_genes).all()
+            assert filter_report == full_report
+
+    def test_memmap(self, tmpdir):
+        """Can a read-only memory-mapped float32 dataset be filtered?"""
+        omic_mat = make_omics()
+        mat_file = str(tmpdir.join('omics.npy'))
+        np.save(mat_file, omic_mat.values.astype(np.float32))
+
+        mmap_mat = pd.DataFrame(np.load(mat_file, mmap_mode='r'),
+                                index=omic_mat.index,
+                                columns=omic_mat.columns, copy=False)
+        samp_mask, gene_mask, filter_report = filter_omics(
+            mmap_mat, min_var=0.005, samp_missing='any', block_size=2)
+
+        assert samp_mask.tolist() == [True, False, True, False, False]
+        assert gene_mask.tolist() == [True, False, True, False, True, False]
+        assert filter_report == {'low_var_genes': ['B', 'D', 'F'],
+                                 'missing_samps': ['S2', 'S4', 'S5']}
+
+    def test_unknown(self):
+        """Are unknown missing value filters rejected?"""
+        with pytest.raises(ValueError):
+            filter_omics(make_omics(), samp_missing='some')
+        with pytest.raises(ValueError):
+            filter_omics(make_omics(), gene_missing='all')
+
+
+class TestCaseAddCopies:
+    """Tests for adding copy number alterations to mutation trees."""
+
+    def make_copies(self):
+        """Creates the CNAs of three genes in six samples."""
+        return pd.DataFrame(
+            np.array([[-2, 0, 1, 0, -2, 2],
+                      [0, -1, -1, 0, 2, 0],
+                      [0, 0, 0, 0, 0, 0]], dtype=np.int8),
+            index=['TP53', 'PTEN', 'MYC'],
+            columns=['S{:02d}'.format(i) for i in range(6)]
+            )
+
+    def make_mtree(self, samps):
+        """Creates a tree with the TP53 variants of the given samples."""
+        muts = pd.DataFrame({
+            'Sample': ['S00', 'S01', 'S03'], 'Gene': ['TP53'] * 3,
+            'Form': ['Missense', 'Missense', 'Nonsense']
+            })
+
+        return MuTree(muts.loc[muts['Sample'].isin(samps), :],
+                      levels=['Gene', 'Form'])
+
+    @pytest.mark.parametrize('compact', [False, True])
+    def test_copies(self, compact):
+        """Are CNAs added as branches of genes with and without variants?"""
+        samps = ['S{:02d}'.format(i) for i in range(6)]
+        mtree = self.make_mtree(samps)
+
+        if compact:
+            mtree.compact(pd.Index(samps))
+        tp53_samps = set(MuType({('Gene', 'TP53'): None}).get_samples(mtree))
+
+        # the CNAs of the last sample are not to be added
+        mtree, = MutCohort.add_copies(self.make_copies(),
+                                      [(mtree, samps[:5])])
+        assert sorted(mtree._child) == ['PTEN', 'TP53']
+        assert mtree['PTEN'].mut_level == 'Form'
+        assert mtree['PTEN'].depth == 1
+
+        assert {lbl: set(lbl_samps) for lbl, lbl_samps in mtree['TP53']} == {
+            'Missense': {'S00', 'S01'}, 'Nonsense': {'S03'},
+            'CNA_-2': {'S00', 'S04'}, 'CNA_1': {'S02'}
+            }
+        assert {lbl: set(lbl_samps) for lbl, lbl_samps in mtree['PTEN']} == {
+            'CNA_-1': {'S01', 'S02'}, 'CNA_2': {'S04'}
+            }
+
+        assert (set(MuType({('Gene', 'TP53'): None}).get_samples(mtree))
+                == tp53_samps | {'S02', 'S04'})
+        assert set(MuType({('Form', 'CNA_2'): None}).get_samples(
+            mtree)) == {'S04'}
+
+    @pytest.mark.parametrize('compact', [False, True])
+    def test_split(self, compact):
+        """Are the CNAs of training and testing samples added to their own
+           trees in a single call, extending the registries of compact trees
+           that are missing samples with CNAs?"""
+        train_samps = {'S00', 'S02', 'S04'}
+        test_samps = {'S01', 'S03', 'S05'}
+        train_mut = self.make_mtree(train_samps)
+        test_mut = self.make_mtree(test_samps)
+
+        if compact:
+            train_mut.compact()
+            test_mut.compact()
+
+        train_mut, test_mut = MutCohort.add_copies(
+            self.make_copies(),
+            [(train_mut, train_samps), (test_mut, test_samps)]
+            )
+
+        assert {lbl: set(lbl_samps)
+                for lbl, lbl_samps in train_mut['TP53']} == {
+                    'Missense': {'S00'}, 'CNA_-2': {'S00', 'S04'},
+                    'CNA_1': {'S02'}
+                    }
+        assert {lbl: set(lbl_samps)
+                for lbl, lbl_samps in train_mut['PTEN']} == {
+                    'CNA_-1': {'S02'}, 'CNA_2': {'S04'}
+                    }
+
+        assert {lbl: set(lbl_samps)
+                for lbl, lbl_samps in test_mut['TP53']} == {
+                    'Missense': {'S01'}, 'Nonsense': {'S03'}, 'CNA_2': {'S05'}
+                    }
+        assert {lbl: set(lbl_samps)
+                for lbl, lbl_samps in test_mut['PTEN']} == {
+                    'CNA_-1': {'S01'}
+                    }
+
+        assert set(train_mut.get_samples()) == {'S00', 'S02', 'S04'}
+        assert set(test_mut.get_samples()) == {'S01', 'S03', 'S05'}
+        if compact:
+            assert set(train_mut.samp_index) == {'S00', 'S02', 'S04'}
+            assert set(test_mut.samp_index) == {'S01', 'S03', 'S05'}
+
+    def test_overlap(self):
+        """Is an error raised when the trees' samples overlap?"""
+        with pytest.raises(ValueError):
+            MutCohort.add_copies(
+                self.make_copies(),
+                [(self.make_mtree({'S00', 'S01'}), {'S00', 'S01'}),
+                 (self.make_mtree({'S01', 'S02'}), {'S01', 'S02'})]
+                )
+
+
+class TestCaseSplitView:
+    """Tests for splitting a cohort into training and testing cohorts."""
+
+    @pytest.mark.parametrize('cv_seed', [3, 19, 101])
+    def test_split(self, cv_seed):
+        """Does a view split the samples the way the constructor does?"""
+        cdata = make_cohort()
+        coh_view = cdata.split_view(cv_seed=cv_seed)
+
+        random.seed(a=cv_seed)
+        train_samps = set(random.sample(population=sorted(cdata.samples),
+                                        k=13))
+
+        assert coh_view.train_samps == train_samps
+        assert coh_view.test_samps == cdata.samples - train_samps
+
+    @pytest.mark.parametrize('cv_seed', [3, 19, 101])
+    def test_removed(self, cv_seed):
+        """Are samples removed after splitting left out of the same split?"""
+        cdata = make_cohort(split_samps={'S{:02d}'.format(i)
+                                         for i in range(20) if i % 7})
+        coh_view = cdata.split_view(cv_seed=cv_seed)
+
+        random.seed(a=cv_seed)
+        train_samps = set(random.sample(
+            population=list(cdata.split_samples), k=13))
+
+        assert coh_view.train_samps == train_samps & cdata.samples
+        assert coh_view.test_samps == cdata.samples - train_samps
+        assert (coh_view.train_mut.get_samples()
+                <= coh_view.train_samps)
+        assert (coh_view.test_mut.get_samples()
+                <= coh_view.test_samps)
+
+    def test_shared(self):
+        """Do the mutation trees of views share the cohort's tree and its
+           sample registry instead of copying them?"""
+        cdata = make_cohort()
+        mtype = MuType({('Gene', 'TP53'): {('Form', 'Missense'): None}})
+        base_samps = set(mtype.get_samples(cdata.train_mut))
+        coh_views = [cdata.split_view(cv_seed=cv_seed)
+                     for cv_seed in [3, 19, 101]]
+
+        assert set(mtype.get_samples(cdata.train_mut)) == base_samps
+        assert set(cdata.train_mut.get_samples()) <= cdata.train_samps
+
+        for coh_view in coh_views:
+            assert coh_view.train_mut.samp_index is cdata.train_mut.samp_index
+            assert coh_view.test_mut.samp_index is cdata.train_mut.samp_index
+
+            assert (set(mtype.get_samples(coh_view.train_mut))
+                    == base_samps & coh_view.train_samps)
+            assert (set(mtype.get_samples(coh_view.test_mut))
+                    == base_samps & coh_view.test_samps)
+
+
+    def test_unchanged(self):
+        """Is the cohort's own tree left as it was when views are made?"""
+        cdata = make_cohort()
+        samp_index = cdata.train_mut.samp_index
+        base_leaves = {(gn, frm): set(samps)
+                       for gn, gene_tree in cdata.train_mut
+                       for frm, samps in gene_tree}
+
+        for cv_seed in [3, 19, 101]:
+            cdata.split_view(cv_seed=cv_seed)
+
+        assert cdata.train_mut.samp_index is samp_index
+        assert {(gn, frm): set(samps)
+                for gn, gene_tree in cdata.train_mut
+                for frm, samps in gene_tree} == base_leaves
+
+    def test_not_compact(self):
+        """Is an error raised when the cohort's tree isn't compact?"""
+        cdata = make_cohort()
+        cdata.train_mut = MuTree(
+            pd.DataFrame({'Sample': ['S00'], 'Gene': ['TP53'],
+                          'Form': ['Missense']}),
+            levels=['Gene', 'Form']
+            )
+
+        with pytest.raises(ValueError):
+            cdata.split_view(cv_seed=3)
+
+    def test_clust(self):
+        """Is an error raised when the cohort's tree has a level that
+           depends on all of its samples?"""
+        cdata = make_cohort()
+        cdata.train_mut = MuTree(
+            pd.DataFrame({'Sample': ['S00', 'S01', 'S02'],
+                          'Gene': ['TP53'] * 3,
+                          'Score': [0.1, 0.5, 0.9]}),
+            levels=['Gene', 'Score_clust']
+            ).compact(cdata.split_samples)
+
+        with pytest.raises(ValueError):
+            cdata.split_view(cv_seed=3)
+
+
+class TestCaseDrugSplit:
+    """Tests for splitting a drug response cohort."""
+
+    @pytest.fixture
+    def drug_data(self, monkeypatch):
+        """Replaces the cell line datasets with small hand-made tables."""
+        samps = ['C{:02d}'.format(i) for i in range(15)]
+        cell_expr = pd.DataFrame(
+            np.random.RandomState(37).randn(15, 4),
+            index=samps[::-1], columns=['G{}'.format(i) for i in range(4)]
+            )
+        drug_resp = pd.DataFrame(
+            np.random.RandomState(41).rand(15, 2),
+            index=samps, columns=['DrugA', 'DrugB']
+            )
+
+        monkeypatch.setattr(cohorts, 'get_expr_ioria', lambda: cell_expr)
+        monkeypatch.setattr(cohorts, 'get_drug_ioria',
+                            lambda drug_names: drug_resp[drug_names])
+
+        return cell_expr, drug_resp
+
+    @pytest.mark.parametrize('cv_seed', [3, 19, 101])
+    def test_split(self, drug_data, cv_seed):
+        """Does a view split the cell lines the way the constructor does?"""
+        drug_names = ['DrugA', 'DrugB']
+        cdata = DrugCohort('TEST', drug_names, cv_seed=cv_seed)
+        coh_view = DrugCohort('TEST', drug_names,
+                              cv_prop=1.0).split_view(cv_seed=cv_seed)
+
+        random.seed(a=cv_seed)
+        train_samps = set(random.sample(
+            population=sorted(drug_data[0].index), k=10))
+
+        assert cdata.split_samples == tuple(sorted(drug_data[0].index))
+        assert cdata.train_samps == train_samps
+        assert coh_view.train_samps == train_samps
+        assert coh_view.test_samps == cdata.test_samps
+
+        for drug in drug_names:
+            assert (coh_view.train_pheno(drug).tolist()
+                    == cdata.train_pheno(drug).tolist())
+            assert (coh_view.test_pheno(drug).tolist()
+                    == cdata.test_pheno(drug).tolist())
+
+
+class TestCaseVariantPheno:
+    """Tests for getting the mutation statuses of a cohort's samples."""
+
+    @pytest.mark.parametrize('mtype', [
+        MuType({('Gene', 'TP53'): None}),
+        MuType({('Gene', 'PTEN'): {('Form', 'Silent'): None}}),
+        MuType({('Form', 'Missense'): None})
+        ])
+    def test_order(self, mtype):
+        """Do the statuses line up with the rows of the -omic dataset?"""
+        coh_view = make_cohort().split_view(cv_seed=19)
+
+        train_samps = mtype.get_samples(coh_view.train_mut)
+        assert (coh_view.train_pheno(mtype).tolist()
+                == [samp in train_samps
+                    for samp in coh_view.train_omics().index])
+
+        test_samps = mtype.get_samples(coh_view.test_mut)
+        assert (coh_view.test_pheno(mtype).tolist()
+                == [samp in test_samps
+                    for samp in coh_view.test_omics().index])
+
+        test_stats = coh_view.test_mut.status_matrix(
+            coh_view.test_omics().index, [mtype])
+        assert (test_stats[:, 0] == coh_view.test_pheno(mtype)).all()
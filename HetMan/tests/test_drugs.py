@@ -0,0 +1,142 @@
+"""Unit tests for loading drug response datasets.
+
+This file contains unit tests for:
+    DrugNameResolver: matching possibly approximate drug names to the drugs
+                      of an annotation table, and remembering the matches
+    get_drug_ioria: labelling drug responses with the names they were
+                    matched to
+
+The annotation table and response matrix used here are small hand-made
+tables saved to a temporary directory.
+
+See Also:
+    :module:`..features.drugs`: Contains the functions that are tested here.
+
+"""
+
+from ..features import drugs
+from ..features.drugs import DrugNameResolver, get_drug_ioria
+
+import numpy as np
+import pandas as pd
+
+import os
+import warnings
+import pytest
+
+
+def make_annot():
+    """Creates a drug annotation table in the format of the Ioria study.
+
+    Nutlin-3a has punctuation in its name, AZD6244 is also known by the
+    synonym Selumetinib, and Olaparib has no synonyms.
+
+    """
+    return pd.DataFrame({
+        'Identifier': [1003, 1017, 1062, 1526],
+        'Name': ['Nutlin-3a', 'Olaparib', 'AZD6244', 'RDEA119'],
+        'Synonyms': ['Nutlin 3a', np.nan, 'Selumetinib, ARRY-142886',
+                     'Refametinib, BAY-869766'],
+        })
+
+
+@pytest.fixture
+def annot_file(tmpdir):
+    """Saves the drug annotation table to a temporary directory."""
+    annot_file = str(tmpdir.join('drug_annot.txt'))
+    make_annot().to_csv(annot_file, sep='\t', index=False)
+
+    return annot_file
+
+
+@pytest.fixture
+def ioria_files(annot_file, tmpdir, monkeypatch):
+    """Points the Ioria drug datasets to hand-made tables."""
+    auc_file = str(tmpdir.join('drug-auc.txt'))
+    pd.DataFrame(np.arange(12, dtype=float).reshape(3, 4),
+                 index=['CellA', 'CellB', 'CellC'],
+                 columns=['X1003', 'X1017', 'X1062', 'X1526']).to_csv(
+                     auc_file, sep='\t')
+
+    monkeypatch.setattr(drugs, 'drug_annot_file', annot_file)
+    monkeypatch.setattr(drugs, 'drug_auc_file', auc_file)
+    monkeypatch.setattr(drugs, 'drug_resolvers', {})
+
+    return annot_file, auc_file
+
+
+class TestCaseResolver:
+    """Tests for matching drug names to an annotation table."""
+
+    @pytest.mark.parametrize('use_cache', [True, False])
+    def test_exact(self, annot_file, use_cache):
+        """Are names matching a drug's name exactly given a full score?"""
+        resolver = DrugNameResolver(annot_file, use_cache=use_cache)
+
+        assert (resolver.resolve(['Olaparib', 'AZD6244', 'Nutlin-3a'])
+                == [(1, 100), (2, 100), (0, 100)])
+
+    def test_normalized(self, annot_file):
+        """Are differences in case and punctuation ignored?"""
+        resolver = DrugNameResolver(annot_file)
+
+        assert (resolver.resolve(['olaparib', 'AZD-6244', 'Nutlin 3A'])
+                == [(1, 100), (2, 100), (0, 100)])
+
+    def test_synonym(self, annot_file):
+        """Are names matching one of a drug's synonyms given a full
+           score?"""
+        resolver = DrugNameResolver(annot_file)
+
+        assert (resolver.resolve(['Selumetinib', 'ARRY142886', 'Refametinib'])
+                == [(2, 100), (2, 100), (3, 100)])
+
+    def test_approximate(self, annot_file):
+        """Are misspelled names matched to the closest drug with a partial
+           score?"""
+        resolver = DrugNameResolver(annot_file)
+        drug_match = resolver.resolve(['Olaparxx', 'RD119', 'Selumetnib'])
+
+        assert [row for row, _ in drug_match] == [1, 3, 2]
+        assert all(0 < score < 100 for _, score in drug_match)
+
+    def test_memo(self, annot_file, cache_path):
+        """Are matches remembered by resolvers loaded later on?"""
+        drug_list = ['Olaparxx', 'Selumetinib', 'Olaparib']
+        drug_match = DrugNameResolver(annot_file).resolve(drug_list)
+
+        resolver = DrugNameResolver(annot_file)
+        assert set(resolver.memo) == set(drug_list)
+        assert resolver.memo_file.startswith(cache_path)
+
+        resolver.feat_mat = None
+        assert resolver.resolve(drug_list) == drug_match
+
+    def test_no_features(self, annot_file):
+        """Are names without any alphanumeric characters given a score of
+           zero without dividing by zero?"""
+        resolver = DrugNameResolver(annot_file)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            drug_match = resolver.resolve(['---', 'Olaparxx'])
+
+        assert drug_match[0][1] == 0
+        assert drug_match[1][0] == 1
+
+
+class TestCaseIoria:
+    """Tests for labelling the drug responses of the Ioria study."""
+
+    def test_labels(self, ioria_files):
+        """Are only names matching a drug's name exactly used as labels
+           on their own?"""
+        drug_resp = get_drug_ioria(
+            ['Olaparib', 'nutlin-3a', 'Selumetinib', 'Olaparxx'])
+
+        assert drug_resp.columns.tolist() == [
+            'Olaparib', 'Nutlin-3a', 'Selumetinib__AZD6244',
+            'Olaparxx__Olaparib'
+            ]
+        assert drug_resp.index.tolist() == ['CellA', 'CellB', 'CellC']
+        assert drug_resp.iloc[:, 2].tolist() == [2.0, 6.0, 10.0]
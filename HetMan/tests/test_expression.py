@@ -0,0 +1,318 @@
+"""Unit tests for loading and processing expression datasets.
+
+This file contains unit tests for:
+    assemble_expr_mat: streaming per-sample expression records into a matrix
+    get_expr_bmeg: caching expression matrices loaded from a local source
+    average_ranks, exp_rank_norm: exponential rank normalization, which is
+                                  checked against ranking each row or column
+                                  of a DataFrame using pandas
+    QuantileReference: normalizing samples against the reference
+                       distributions of a training cohort
+
+See Also:
+    :module:`..features.expression`, :module:`..features.normalize`: Contain
+        the functions that are tested here.
+
+"""
+
+from ..features import expression
+from ..features.expression import (assemble_expr_mat, get_expr_bmeg,
+                                   BmegExpression, LocalExpression)
+from ..features.normalize import (average_ranks, exp_rank_norm,
+                                  QuantileReference, read_quantile_reference)
+from ..features.utils import write_matrix_store
+
+import numpy as np
+import pandas as pd
+from scipy.stats import expon
+
+import os
+import gzip
+import json
+import pytest
+
+
+def make_records():
+    """Creates expression records whose genes vary from sample to sample.
+
+    Sample S2 has a gene that isn't in the first record, sample S3 is
+    missing one of the genes of the first record, and sample S1 appears
+    twice, with its second record replacing the first.
+
+    """
+    return [('S1', {'A': 1.0, 'B': 2.0}),
+            ('S2', {'A': 3.0, 'B': 4.0, 'C': 5.0}),
+            ('S3', {'B': 6.0}),
+            ('S1', {'A': 7.0, 'B': 8.0})]
+
+
+def write_records(data_dir, cohort):
+    """Saves expression records in the format read by LocalExpression."""
+    os.makedirs(data_dir, exist_ok=True)
+
+    with gzip.open(os.path.join(data_dir, cohort + '.json.gz'), 'wt') as fl:
+        for samp, expr_vals in make_records():
+            fl.write(json.dumps({
+                'sample': {'gid': 'biosample:' + samp},
+                'expression': {'properties': {
+                    'serializedExpressions': json.dumps(expr_vals)}}
+                }) + '\n')
+
+
+def make_expr(seed=101):
+    """Creates an expression matrix with many ties and missing values."""
+    rs = np.random.RandomState(seed)
+    expr_mat = rs.randint(0, 6, size=(30, 12)).astype(float)
+    expr_mat[rs.random_sample(expr_mat.shape) < 0.15] = np.nan
+    expr_mat[:, 3] = np.nan
+    expr_mat[4, :] = 2.0
+
+    return pd.DataFrame(expr_mat,
+                        index=['S{}'.format(i) for i in range(30)],
+                        columns=['G{}'.format(i) for i in range(12)])
+
+
+def pandas_exp_norm(expr, axis):
+    """Normalizes a matrix the way it was done before exp_rank_norm."""
+    ranks = expr.rank(axis=axis) - 1
+
+    return pd.DataFrame(expon.ppf(ranks / expr.shape[axis]),
+                        index=expr.index, columns=expr.columns).fillna(0.0)
+
+
+class TestCaseAssembleExpr:
+    """Tests for assembling expression matrices from records."""
+
+    def test_union(self):
+        """Are all genes in any record used, with missing values zeroed?"""
+        samps, genes, expr_mat = assemble_expr_mat(make_records())
+
+        assert samps == ['S1', 'S2', 'S3']
+        assert genes == ['A', 'B', 'C']
+        assert expr_mat.shape == (3, 3)
+
+        expr_vals = {(samp, gene): expr_mat[i, j]
+                     for i, samp in enumerate(samps)
+                     for j, gene in enumerate(genes)}
+        assert expr_vals == {('S1', 'A'): 7.0, ('S1', 'B'): 8.0,
+                             ('S1', 'C'): 0.0, ('S2', 'A'): 3.0,
+                             ('S2', 'B'): 4.0, ('S2', 'C'): 5.0,
+                             ('S3', 'A'): 0.0, ('S3', 'B'): 6.0,
+                             ('S3', 'C'): 0.0}
+
+    def test_new_genes(self):
+        """Are genes first seen in later records dropped when the samples
+           they were seen in are overwritten?"""
+        samps, genes, expr_mat = assemble_expr_mat(
+            make_records() + [('S2', {'B': 9.0}),
+                              ('S4', {'D': 1.0, 'A': 2.0})]
+            )
+
+        assert samps == ['S1', 'S2', 'S3', 'S4']
+        assert genes == ['A', 'B', 'C', 'D']
+        assert expr_mat.tolist() == [[7.0, 8.0, 0.0, 0.0],
+                                     [0.0, 9.0, 0.0, 0.0],
+                                     [0.0, 6.0, 0.0, 0.0],
+                                     [2.0, 0.0, 0.0, 1.0]]
+
+    def test_genes(self):
+        """Are only the given genes used, in the given order?"""
+        samps, genes, expr_mat = assemble_expr_mat(make_records(),
+                                                   genes=['C', 'A'])
+
+        assert samps == ['S1', 'S2', 'S3']
+        assert genes == ['C', 'A']
+        assert expr_mat.tolist() == [[0.0, 7.0], [5.0, 3.0], [0.0, 0.0]]
+
+    def test_many(self):
+        """Are rows labelled correctly when the matrix has to be grown?"""
+        samps = ['S{:04d}'.format(i) for i in range(1000)][::-1]
+        samps_out, genes, expr_mat = assemble_expr_mat(
+            (samp, {'A': float(samp[1:]), 'B': 1.0}) for samp in samps)
+
+        assert samps_out == samps
+        assert expr_mat.shape == (1000, 2)
+        assert np.array_equal(expr_mat[:, genes.index('A')],
+                              [float(samp[1:]) for samp in samps])
+
+    def test_empty(self):
+        """Is an empty matrix returned when there are no records?"""
+        samps, genes, expr_mat = assemble_expr_mat([], genes=['A', 'B'])
+
+        assert samps == []
+        assert genes == ['A', 'B']
+        assert expr_mat.shape == (0, 2)
+
+
+class TestCaseExprCache:
+    """Tests for caching expression matrices, using the temporary cache
+       given by the cache_path fixture in conftest.py."""
+
+    def test_gene_order(self, cache_path):
+        """Is one matrix cached for a set of genes given in any order, with
+           the columns returned in the order they were given?"""
+        local_src = LocalExpression(os.path.join(cache_path, 'records'))
+        write_records(local_src.data_dir, 'TCGA-X')
+
+        expr_ca = get_expr_bmeg('TCGA-X', expr_source=local_src,
+                                genes=['C', 'A'])
+        expr_ac = get_expr_bmeg('TCGA-X', expr_source=local_src,
+                                genes=['A', 'C'])
+
+        assert list(expr_ca.columns) == ['C', 'A']
+        assert list(expr_ac.columns) == ['A', 'C']
+        assert np.array_equal(expr_ca.values, expr_ac.values[:, ::-1])
+        assert len(os.listdir(os.path.join(cache_path, 'expr_bmeg'))) == 1
+
+    def test_offline(self, cache_path, monkeypatch):
+        """Can a cached BMEG cohort be loaded without a BMEG server?"""
+        expr = pd.DataFrame([[1.0, 2.0], [3.0, 4.0]],
+                            index=['S1', 'S2'], columns=['A', 'B'])
+        write_matrix_store(expr, os.path.join(
+            cache_path, 'expr_bmeg',
+            'TCGA-X__' + BmegExpression().cache_label('TCGA-X')
+            ))
+
+        def no_client(bmeg_server=None):
+            raise IOError("No BMEG server should be queried!")
+
+        monkeypatch.setattr(expression, 'get_bmeg_client', no_client)
+        expr_data = get_expr_bmeg('TCGA-X')
+
+        assert list(expr_data.index) == ['S1', 'S2']
+        assert np.array_equal(expr_data.values, expr.values)
+
+
+class TestCaseRankNorm:
+    """Tests for exponential rank normalization."""
+
+    def test_ranks(self):
+        """Are tied values given their average rank, and missing values
+           left unranked?"""
+        ranks = average_ranks(np.array([[3.0, 1.0, 3.0, np.nan, 3.0],
+                                        [np.nan, np.nan, 0.0, 0.0, -1.0]]))
+
+        assert np.allclose(ranks, [[3.0, 1.0, 3.0, np.nan, 3.0],
+                                   [np.nan, np.nan, 2.5, 2.5, 1.0]],
+                           equal_nan=True)
+
+    def test_ranks_pandas(self):
+        """Are the ranks of each row the same as those found by pandas?"""
+        expr = make_expr()
+
+        assert np.allclose(average_ranks(expr.values),
+                           expr.rank(axis=1).values, equal_nan=True)
+
+    @pytest.mark.parametrize('axis', [0, 1])
+    def test_norm(self, axis):
+        """Are rows and columns normalized as with pandas, including those
+           with ties and with missing values?"""
+        expr = make_expr()
+        norm_expr = exp_rank_norm(expr, axis=axis)
+
+        assert isinstance(norm_expr, pd.DataFrame)
+        assert norm_expr.index.equals(expr.index)
+        assert norm_expr.columns.equals(expr.columns)
+        assert np.allclose(norm_expr.values,
+                           pandas_exp_norm(expr, axis).values)
+
+    @pytest.mark.parametrize('chunk_size', [1, 5, 12, 50])
+    def test_chunks(self, chunk_size):
+        """Does normalizing the columns a few at a time into a given output
+           array give the same values as normalizing them all at once?"""
+        expr = make_expr()
+        out = np.full(expr.shape, -1.0)
+
+        norm_vals = exp_rank_norm(expr.values, axis=0,
+                                  chunk_size=chunk_size, out=out)
+        assert norm_vals is out
+        assert np.allclose(out, pandas_exp_norm(expr, 0).values)
+
+    def test_axis(self):
+        """Is an error raised when an unknown axis is given?"""
+        with pytest.raises(ValueError):
+            exp_rank_norm(make_expr(), axis=2)
+
+
+class TestCaseQuantileReference:
+    """Tests for normalizing samples against reference distributions."""
+
+    def test_full(self):
+        """Does normalizing the training samples against a reference of all
+           of their values give the same result as ranking them?"""
+        expr = make_expr().fillna(1.0)
+        qref = QuantileReference(out_distr='expon').fit(expr)
+
+        assert np.allclose(qref.transform(expr).values,
+                           exp_rank_norm(expr, axis=0).values)
+
+    def test_batches(self):
+        """Does fitting a reference in batches give the same result as
+           fitting it on all of the samples at once?"""
+        expr = make_expr()
+        qref = QuantileReference().fit(expr)
+        batch_ref = QuantileReference().fit(expr.iloc[:7, :])
+        batch_ref.partial_fit(expr.iloc[7:, :])
+
+        for ref_vals, batch_vals in zip(qref.ref_vals, batch_ref.ref_vals):
+            assert np.array_equal(ref_vals, batch_vals)
+        assert np.array_equal(qref.seen_counts,
+                              expr.notnull().sum().values)
+
+    def test_reservoir(self):
+        """Is the reference limited to the given size when more samples are
+           seen, and is the sample kept the same when using the same seed?"""
+        expr = pd.concat([make_expr(seed) for seed in range(10)])
+        expr.index = range(expr.shape[0])
+        qrefs = [QuantileReference(n_quantiles=50, random_state=seed)
+                 for seed in [7, 7, 8]]
+
+        for qref in qrefs:
+            qref.fit(expr.iloc[:40, :])
+            for i in range(40, expr.shape[0], 65):
+                qref.partial_fit(expr.iloc[i:(i + 65), :])
+
+        assert np.array_equal(qrefs[0].seen_counts,
+                              expr.notnull().sum().values)
+
+        for i, gene in enumerate(expr.columns):
+            gene_vals = expr[gene].dropna()
+            ref_vals = qrefs[0].ref_vals[i]
+
+            assert len(ref_vals) == min(len(gene_vals), 50)
+            assert np.all(np.diff(ref_vals) >= 0)
+            assert set(ref_vals) <= set(gene_vals)
+            assert np.array_equal(ref_vals, qrefs[1].ref_vals[i])
+
+        assert any(not np.array_equal(vals1, vals2)
+                   for vals1, vals2 in zip(qrefs[0].ref_vals,
+                                           qrefs[2].ref_vals))
+
+    def test_save(self, tmpdir):
+        """Are the reference distributions unchanged after being saved and
+           loaded?"""
+        expr = make_expr()
+        qref = QuantileReference(n_quantiles=20, out_distr='norm',
+                                 random_state=3).fit(expr)
+
+        ref_file = str(tmpdir.join('ref.npz'))
+        qref.save(ref_file)
+        new_ref = read_quantile_reference(ref_file)
+
+        assert new_ref.n_quantiles == 20
+        assert new_ref.out_distr == 'norm'
+        assert list(new_ref.genes) == list(expr.columns)
+        assert np.array_equal(new_ref.seen_counts, qref.seen_counts)
+        for ref_vals, new_vals in zip(qref.ref_vals, new_ref.ref_vals):
+            assert np.array_equal(ref_vals, new_vals)
+
+        new_expr = make_expr(seed=202)
+        assert np.allclose(new_ref.quantiles(new_expr),
+                           qref.quantiles(new_expr), equal_nan=True)
+        assert np.allclose(new_ref.transform(new_expr).values,
+                           qref.transform(new_expr).values, equal_nan=True)
+
+    def test_unfit(self):
+        """Is an error raised when using a reference that isn't fit?"""
+        with pytest.raises(ValueError):
+            QuantileReference().transform(make_expr())
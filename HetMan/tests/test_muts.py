@@ -77,6 +77,48 @@ class MtreeTester(object):
         return muts, mtree, self.mut_levels
 
 
+def brute_treetypes(mtree, sub_levels, min_size):
+    """Finds the MuTypes given by MuTree.treetypes without using any bounds.
+
+    Every combination of branches at each of the given levels is built using
+    itertools, with branches recursed into in the same way as in
+    MuTree.treetypes, so that the bounds used by the tree can be checked
+    by filtering the MuTypes found here.
+
+    """
+    tree_mtypes = set()
+
+    if mtree.mut_level in sub_levels:
+        if len(mtree._child) > 1 or (len(mtree._child) == 1
+                                     and mtree.mut_level == sub_levels[0]):
+            lvl_mtypes = [MuType({(mtree.mut_level, nm): None})
+                          for nm, _ in mtree]
+
+            tree_mtypes |= set(
+                reduce(lambda x, y: x | y, kc)
+                for kc in chain.from_iterable(
+                    combn(lvl_mtypes, csize)
+                    for csize in range(1, max(2, len(mtree._child))))
+                )
+
+        for nm, branch in mtree:
+            if (isinstance(branch, MuTree) and len(branch) > min_size
+                    and set(sub_levels) & branch.get_levels()):
+                tree_mtypes |= set(
+                    MuType({(mtree.mut_level, nm): tree_mtype})
+                    for tree_mtype in brute_treetypes(
+                        branch, sub_levels, min_size)
+                    )
+
+    else:
+        for nm, branch in mtree:
+            if (isinstance(branch, MuTree) and len(branch) > min_size
+                    and set(sub_levels) & branch.get_levels()):
+                tree_mtypes |= brute_treetypes(branch, sub_levels, min_size)
+
+    return tree_mtypes
+
+
 @pytest.fixture(scope='function')
 def mtype_tester(request):
     """Create a set of mutation subtypes."""
@@ -287,6 +329,246 @@ class TestCaseBasicMuTree:
             for vals, mut in muts.groupby(lvl_set):
                 assert set(mtree[vals].get_samples()) == set(mut['Sample'])
 
+    def test_pickle(self, mtree_tester):
+        """Can the tree be pickled and restored?"""
+        muts, mtree, mut_lvls = mtree_tester.get_muts_mtree()
+        new_tree = pickle.loads(pickle.dumps(mtree))
+
+        assert new_tree.get_levels() == mtree.get_levels()
+        assert new_tree.allkey() == mtree.allkey()
+
+        assert new_tree.get_samples() == mtree.get_samples()
+
+        for nm, mut in mtree:
+            if isinstance(mut, MuTree):
+                assert new_tree[nm].get_samples() == mut.get_samples()
+            else:
+                assert new_tree[nm] == mut
+
+    def test_subtree(self, mtree_tester):
+        """Can the tree be restricted to a subset of its samples?"""
+        muts, mtree, mut_lvls = mtree_tester.get_muts_mtree()
+        sub_samps = set(sorted(mtree.get_samples())[::2])
+        sub_tree = pickle.loads(pickle.dumps(mtree)).subtree(sub_samps)
+
+        assert sub_tree.get_samples() == mtree.get_samples() & sub_samps
+        assert mtree.get_samples() != sub_tree.get_samples()
+
+        for nm, mut in mtree:
+            if isinstance(mut, MuTree):
+                branch_samps = mut.get_samples() & sub_samps
+            else:
+                branch_samps = mut & sub_samps
+
+            if branch_samps:
+                assert (MuType({(mtree.mut_level, nm): None}).get_samples(
+                    sub_tree) == branch_samps)
+            else:
+                assert nm not in sub_tree._child
+
+    def test_compact(self, mtree_tester):
+        """Can the tree store its samples as bitsets?"""
+        muts, mtree, mut_lvls = mtree_tester.get_muts_mtree()
+        samp_list = sorted(mtree.get_samples()) + ['dummy1', 'dummy2']
+        cmp_tree = pickle.loads(pickle.dumps(mtree)).compact(samp_list)
+
+        assert cmp_tree.allkey() == mtree.allkey()
+        assert cmp_tree.get_samples() == mtree.get_samples()
+        assert (cmp_tree.status(samp_list) == mtree.status(samp_list)).all()
+
+        for mtype in mtree.subtypes():
+            assert mtype.get_samples(cmp_tree) == mtype.get_samples(mtree)
+            assert (cmp_tree.status(samp_list, mtype)
+                    == mtree.status(samp_list, mtype)).all()
+
+        sub_samps = set(samp_list[::3])
+        cmp_tree.subtree(sub_samps)
+        assert cmp_tree.get_samples() == mtree.get_samples() & sub_samps
+
+        new_tree = pickle.loads(pickle.dumps(cmp_tree))
+        assert new_tree.get_samples() == cmp_tree.get_samples()
+
+    def test_sample_view(self, mtree_tester):
+        """Can a compact tree be restricted to a subset of its samples
+           without being changed?"""
+        muts, mtree, mut_lvls = mtree_tester.get_muts_mtree()
+        samp_list = sorted(mtree.get_samples())
+        cmp_tree = pickle.loads(pickle.dumps(mtree)).compact(samp_list)
+
+        with pytest.raises(ValueError):
+            mtree.sample_view(samp_list)
+
+        for sub_samps in [set(samp_list[::2]), set(samp_list[1::3]), set()]:
+            view_tree = cmp_tree.sample_view(sub_samps)
+            sub_tree = pickle.loads(pickle.dumps(mtree)).subtree(sub_samps)
+
+            assert view_tree.samp_index is cmp_tree.samp_index
+            assert view_tree.get_samples() == sub_tree.get_samples()
+            assert view_tree.allkey() == sub_tree.allkey()
+
+            for mtype in mtree.subtypes():
+                assert (mtype.get_samples(view_tree)
+                        == mtype.get_samples(sub_tree))
+
+        assert cmp_tree.get_samples() == mtree.get_samples()
+        assert cmp_tree.allkey() == mtree.allkey()
+
+    def test_combtypes(self, mtree_tester):
+        """Can we find the combinations of branches of the tree?"""
+        muts, mtree, mut_lvls = mtree_tester.get_muts_mtree()
+        sub_mtypes = mtree.subtypes(sub_levels=mut_lvls[:2])
+        min_size, max_size = 2, len(mtree.get_samples()) // 2
+
+        comb_mtypes = set()
+        for kc in chain(combn(sub_mtypes, 1), combn(sub_mtypes, 2)):
+            new_mtype = reduce(lambda x, y: x | y, kc)
+            comb_size = len(new_mtype.get_samples(mtree))
+
+            if min_size <= comb_size <= max_size:
+                comb_mtypes |= {new_mtype}
+
+        assert mtree.combtypes(sub_levels=mut_lvls[:2], min_size=min_size,
+                               max_size=max_size) == comb_mtypes
+
+        uniq_mtypes = list(mtree.iter_combtypes(
+            sub_levels=mut_lvls[:2], min_size=min_size, max_size=max_size,
+            unique_samps=True
+            ))
+        uniq_samps = set(frozenset(mtype.get_samples(mtree))
+                         for mtype in uniq_mtypes)
+
+        assert len(uniq_samps) == len(uniq_mtypes)
+        assert uniq_samps == set(frozenset(mtype.get_samples(mtree))
+                                 for mtype in comb_mtypes)
+
+    def test_treetypes(self, mtree_tester):
+        """Are the bounds on combinations of branches applied to all levels
+           of the tree?"""
+        muts, mtree, mut_lvls = mtree_tester.get_muts_mtree()
+        min_size, max_size = 2, len(mtree.get_samples()) // 2
+
+        # the samples of the MuTypes are found using a compact copy of the
+        # tree, which is much quicker than using the tree itself
+        cmp_tree = pickle.loads(pickle.dumps(mtree)).compact()
+        tree_mtypes = set(
+            mtype for mtype in brute_treetypes(mtree, mut_lvls[:2], min_size)
+            if min_size <= len(mtype.get_samples(cmp_tree)) <= max_size
+            )
+
+        bound_mtypes = mtree.treetypes(sub_levels=mut_lvls[:2],
+                                       min_size=min_size, max_size=max_size)
+        uniq_mtypes = mtree.treetypes(sub_levels=mut_lvls[:2],
+                                      min_size=min_size, max_size=max_size,
+                                      unique_samps=True)
+
+        assert bound_mtypes == tree_mtypes
+        assert cmp_tree.treetypes(sub_levels=mut_lvls[:2], min_size=min_size,
+                                  max_size=max_size) == tree_mtypes
+
+        assert uniq_mtypes <= bound_mtypes
+        assert (set(mtype.get_samples(cmp_tree).bits.tobytes()
+                    for mtype in uniq_mtypes)
+                == set(mtype.get_samples(cmp_tree).bits.tobytes()
+                       for mtype in bound_mtypes))
+
+    @pytest.mark.parametrize('comb_sizes', [(1, 2, 3), (2, 3), (2, ), (3, )])
+    def test_unique_combs(self, mtree_tester, comb_sizes):
+        """Is every set of samples found when only one MuType is returned
+           for each set, with the fewest branches used to get each set?"""
+        muts, mtree, mut_lvls = mtree_tester.get_muts_mtree()
+
+        # in this tree the samples of Form C are a subset of those of Form A,
+        # so that A | C has the same samples as Form A by itself
+        nest_tree = MuTree(
+            pd.DataFrame({'Sample': ['S1', 'S2', 'S3', 'S1', 'S4'],
+                          'Gene': ['TP53'] * 5,
+                          'Form': ['A', 'A', 'B', 'C', 'D']}),
+            levels=['Gene', 'Form']
+            )
+
+        for use_tree, use_lvls in [(mtree, mut_lvls[:1]),
+                                   (nest_tree, ['Form'])]:
+            sub_mtypes = sorted(use_tree.subtypes(sub_levels=use_lvls))
+            min_size, max_size = 2, len(use_tree.get_samples()) // 2 + 1
+
+            comb_samps = {}
+            for kc in chain.from_iterable(combn(sub_mtypes, csize)
+                                          for csize in comb_sizes):
+                samps = frozenset(reduce(lambda x, y: x | y,
+                                         kc).get_samples(use_tree))
+
+                if min_size <= len(samps) <= max_size:
+                    comb_samps[samps] = min(comb_samps.get(samps, len(kc)),
+                                            len(kc))
+
+            uniq_mtypes = list(use_tree.iter_combtypes(
+                sub_mtypes=sub_mtypes, comb_sizes=comb_sizes,
+                min_size=min_size, max_size=max_size, unique_samps=True
+                ))
+            uniq_samps = [frozenset(mtype.get_samples(use_tree))
+                          for mtype in uniq_mtypes]
+
+            assert len(set(uniq_samps)) == len(uniq_samps)
+            assert set(uniq_samps) == set(comb_samps)
+            for mtype, samps in zip(uniq_mtypes, uniq_samps):
+                assert len(mtype.subkeys()) == comb_samps[samps]
+
+    def test_status_matrix(self, mtree_tester):
+        """Can we get the mutation status of many types at once?"""
+        muts, mtree, mut_lvls = mtree_tester.get_muts_mtree()
+        mtypes = sorted(mtree.subtypes())
+        samp_list = ['dummy1'] + sorted(mtree.get_samples())[::-2]
+
+        stat_mat = mtree.status_matrix(samp_list, mtypes)
+        assert stat_mat.shape == (len(samp_list), len(mtypes))
+        assert not stat_mat[0].any()
+
+        for j, mtype in enumerate(mtypes):
+            assert (stat_mat[:, j] == mtree.status(samp_list, mtype)).all()
+
+        assert (mtree.status_matrix(samp_list, mtypes, sparse=True).toarray()
+                == stat_mat).all()
+        assert (mtree.compact().status_matrix(samp_list, mtypes)
+                == stat_mat).all()
+
+        # the rows follow the order the samples are given in
+        assert (mtree.status_matrix(pd.Index(samp_list[::-1]), mtypes)
+                == stat_mat[::-1]).all()
+
+    def test_cache(self, mtree_tester):
+        """Are the samples of MuTypes cached until the tree is changed?"""
+        muts, mtree, mut_lvls = mtree_tester.get_muts_mtree()
+        mtypes = sorted(mtree.subtypes())
+        samp_lists = [mtype.get_samples(mtree) for mtype in mtypes]
+        cache_info = mtree.cache_info()
+
+        for mtype, samps in zip(mtypes, samp_lists):
+            assert mtype.get_samples(mtree) == samps
+
+        assert mtree.cache_info()['size'] == len(mtypes)
+        assert (mtree.cache_info()['hits']
+                == cache_info['hits'] + len(mtypes))
+        assert mtree.cache_info()['misses'] == cache_info['misses']
+
+        sub_samps = set(sorted(mtree.get_samples())[::2])
+        mtree.subtree(sub_samps)
+        assert mtree.cache_info()['size'] == 0
+
+        for mtype, samps in zip(mtypes, samp_lists):
+            assert mtype.get_samples(mtree) == samps & sub_samps
+
+    def test_build(self, mtree_tester):
+        """Do the branches of the tree match the grouped mutations?"""
+        muts, mtree, mut_lvls = mtree_tester.get_muts_mtree()
+
+        if mtree.mut_level in muts:
+            for lbl, lbl_muts in muts.groupby(mtree.mut_level):
+                assert mtree.get_samples() >= set(lbl_muts['Sample'])
+                assert (MuType({(mtree.mut_level, lbl): None}).get_samples(
+                    mtree) == set(lbl_muts['Sample']))
+
+        assert not hasattr(mtree, '__dict__')
+
     def test_allkeys(self, mtree_tester):
         """Can we retrieve the mutation set key of the tree?"""
         muts, mtree, mut_lvls = mtree_tester.get_muts_mtree()
@@ -345,6 +627,16 @@ class TestCaseBasicMuType:
         for mtype1, mtype2 in product(mtypes, repeat=2):
             assert (mtype1 == mtype2) == (hash(mtype1) == hash(mtype2))
 
+    def test_interning(self, mtype_tester):
+        """Are MuTypes with the same sub-types the same immutable object?"""
+        for mtype in mtype_tester.get_types():
+            assert MuType({(mtype.cur_level, k): v
+                           for k, v in mtype}) is mtype
+            assert pickle.loads(pickle.dumps(mtype)) is mtype
+
+            with pytest.raises(AttributeError):
+                mtype.cur_level = 'Gene'
+
 
 class TestCaseMuTypeBinary:
     """Tests the binary operators defined for MuTypes."""
@@ -442,7 +734,7 @@ class TestCaseMuTypeBinary:
 
             assert sorted(mtypes) == sorted(list(reversed(mtypes)))
             assert (sorted([mtypes[1], mtypes[5]])
-                    == sorted([mtypes[5], mtypes[1]))
+                    == sorted([mtypes[5], mtypes[1]]))
 
     @pytest.mark.parametrize('mtype_tester', ['binary'],
                              indirect=True, scope="function")
@@ -590,6 +882,29 @@ class TestCaseMuTreeLevels:
             mtype = MuType({('Gene', gene): {('Form', form): None}})
             assert mtype.get_samples(mtree) == set(mut['Sample'])
 
+    def test_clust_parse(self):
+        """Is the _clust mutation level parsed separately for each gene?"""
+        with open(DATA_PATH + 'muts_large.p', 'rb') as fl:
+            muts = pickle.load(fl).iloc[:600].copy()
+
+        # scores of mutations are spread around different values in each
+        # gene, and are missing for TTN mutations
+        muts['Score'] = (np.arange(muts.shape[0]) % 4 / 4
+                         + muts['Gene'].str.len() / 40)
+        muts.loc[muts['Gene'] == 'TTN', 'Score'] = np.nan
+        mtree = MuTree(muts, levels=['Gene', 'Score_clust', 'Form'])
+
+        for gene, gene_muts in muts.groupby('Gene'):
+            if gene == 'TTN':
+                assert mtree[gene].mut_level == 'Form'
+
+            else:
+                gene_tree = MuTree(gene_muts, levels=['Score_clust'])
+                assert mtree[gene].mut_level == 'Score_clust'
+
+                assert ({lbl: mut.get_samples() for lbl, mut in mtree[gene]}
+                        == {lbl: set(samps) for lbl, samps in gene_tree})
+
 
 class TestCaseAdvancedMuTree:
     """Tests for advanced functionality of MuTypes."""
@@ -0,0 +1,157 @@
+"""Unit tests for pathway graphs and pathway-based feature selection.
+
+This file contains unit tests for:
+    PathwayGraph: finding the multi-hop neighbourhoods of genes using the
+                  sparse adjacency matrices of a pathway graph
+    PathwaySelect: selecting the genes in the neighbourhoods of mutated
+                   genes, using either a pathway graph or the nested
+                   dictionaries produced by parse_sif
+
+The graph tested here is built from a small hand-made SIF file, and the
+neighbourhoods it finds are compared against those found by following the
+interactions listed in the graph's dictionary output.
+
+See Also:
+    :module:`..features.pathways`: Contains the pathway graph.
+    :module:`..predict.selection`: Contains the feature selection step.
+
+"""
+
+from ..features.pathways import (PathwayGraph, build_pathway_graph,
+                                 write_pathway_graph, read_pathway_graph)
+from ..predict.selection import PathwaySelect
+
+import pandas as pd
+
+import pytest
+from itertools import chain
+
+
+# the interactions in the pathway graph, which include a cycle, a gene
+# interacting with itself and an interaction listed twice
+sif_interactions = [
+    ('TP53', 'controls-expression-of', 'MDM2'),
+    ('MDM2', 'controls-state-change-of', 'TP53'),
+    ('TP53', 'controls-expression-of', 'CDKN1A'),
+    ('CDKN1A', 'interacts-with', 'CDK2'),
+    ('CDK2', 'controls-state-change-of', 'RB1'),
+    ('RB1', 'interacts-with', 'E2F1'),
+    ('E2F1', 'controls-expression-of', 'E2F1'),
+    ('PTEN', 'controls-state-change-of', 'AKT1'),
+    ('PIK3CA', 'controls-state-change-of', 'AKT1'),
+    ('AKT1', 'controls-state-change-of', 'MDM2'),
+    ('AKT1', 'controls-state-change-of', 'MDM2'),
+    ]
+
+int_types = ('controls-expression-of', 'controls-state-change-of',
+             'interacts-with')
+
+
+@pytest.fixture(scope='module')
+def path_graph(tmpdir_factory):
+    """Builds a pathway graph from the interactions listed above."""
+    sif_file = str(tmpdir_factory.mktemp('pathways').join('test.sif'))
+    pd.DataFrame(sif_interactions).to_csv(sif_file, sep='\t',
+                                          header=False, index=False)
+
+    return build_pathway_graph(sif_file)
+
+
+def dict_neighbours(path_graph, gene, direction, int_types=(), hops=1):
+    """Follows interactions from a gene using the graph's dictionary output.
+    """
+    reached = set()
+    cur_genes = {gene}
+
+    for _ in range(hops):
+        cur_genes = set(chain(*[
+            genes for gn in cur_genes
+            for tp, genes in path_graph[gn][direction].items()
+            if not int_types or tp in int_types
+            ]))
+        reached |= cur_genes
+
+    return reached
+
+
+class TestCasePathwayGraph:
+    """Tests for finding neighbourhoods in pathway graphs."""
+
+    def test_dict(self, path_graph):
+        """Does indexing the graph give the interactions of a gene?"""
+        assert path_graph['TP53'] == {
+            'Up': {'controls-state-change-of': {'MDM2'}},
+            'Down': {'controls-expression-of': {'MDM2', 'CDKN1A'}}
+            }
+
+        assert path_graph['MDM2']['Up'] == {
+            'controls-expression-of': {'TP53'},
+            'controls-state-change-of': {'AKT1'}
+            }
+        assert path_graph['BRAF'] == {'Up': {}, 'Down': {}}
+
+    @pytest.mark.parametrize('hops', [1, 2, 3, 5])
+    @pytest.mark.parametrize('direction', ['Up', 'Down'])
+    @pytest.mark.parametrize('use_types', [(), ('controls-expression-of', ),
+                                           ('controls-state-change-of',
+                                            'interacts-with')])
+    def test_neighbours(self, path_graph, hops, direction, use_types):
+        """Do the multi-hop neighbourhoods found using sparse products
+           match those found by following interactions one at a time?"""
+        genes = sorted(set(chain(*[(up, down)
+                                   for up, _, down in sif_interactions])))
+        neighbs = path_graph.neighbours(genes + ['BRAF'], direction,
+                                        use_types, hops)
+
+        for gene in genes:
+            assert neighbs[gene] == dict_neighbours(
+                path_graph, gene, direction, use_types, hops)
+        assert neighbs['BRAF'] == set()
+
+    def test_memo(self, path_graph):
+        """Are neighbourhoods re-used by later queries of the same genes?"""
+        neighbs = path_graph.neighbours(['PTEN', 'CDK2'], 'Down', hops=2)
+        assert neighbs == {'PTEN': {'AKT1', 'MDM2'}, 'CDK2': {'RB1', 'E2F1'}}
+
+        assert path_graph.neighbours(
+            ['CDK2'], 'Down', hops=2)['CDK2'] is neighbs['CDK2']
+        assert path_graph.neighbours(
+            ['CDK2'], 'Down', hops=1)['CDK2'] == {'RB1'}
+
+    def test_store(self, path_graph, tmpdir):
+        """Is the graph unchanged after being saved and loaded?"""
+        store_dir = str(tmpdir.join('graph'))
+        write_pathway_graph(path_graph, store_dir)
+        new_graph = read_pathway_graph(store_dir)
+
+        assert isinstance(new_graph, PathwayGraph)
+        assert new_graph.int_types == int_types
+        for gene in path_graph.genes:
+            assert new_graph[gene] == path_graph[gene]
+
+
+class TestCasePathwaySelect:
+    """Tests for selecting genes using pathway neighbourhoods."""
+
+    @pytest.mark.parametrize('path_key', [
+        ((), ()),
+        ((), ('controls-state-change-of', )),
+        (('Up', ), ()),
+        (('Down', ), ('controls-expression-of', 'interacts-with')),
+        ])
+    def test_graph(self, path_graph, path_key):
+        """Does selecting genes using the graph give the same genes as
+           using the neighbourhood dictionaries of the mutated genes?"""
+        expr = pd.DataFrame(columns=path_graph.genes)
+        mut_genes = ['TP53', 'AKT1']
+
+        graph_select = PathwaySelect(path_keys={(path_key, )}).fit(
+            expr, path_obj=path_graph, mut_genes=mut_genes)
+        dict_select = PathwaySelect(path_keys={(path_key, )}).fit(
+            expr, path_obj={gene: path_graph[gene] for gene in mut_genes},
+            mut_genes=mut_genes
+            )
+
+        assert graph_select.select_genes == dict_select.select_genes
+        if path_key == ((), ()):
+            assert graph_select.select_genes == set()